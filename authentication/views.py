@@ -5,7 +5,10 @@ from rest_framework import generics
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework.response import Response
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from product.mixins import get_guest_token
+from product.utils.cart_service import merge_guest_cart
 from . import serializers
 from .permissions import IsOwnerOrAdmin, IsAnonymous
 from .utils.otp_service import OTPService
@@ -19,6 +22,20 @@ class TokenObtainPairView(TokenObtainPairView):
     serializer_class = serializers.CustomTokenObtainPairSerializer
     permission_classes = [permissions.AllowAny]
 
+    def get_serializer(self, *args, **kwargs):
+        # kept for post, which merges the guest cart into the cart of its user
+        self.serializer = super().get_serializer(*args, **kwargs)
+        return self.serializer
+
+    def post(self, request, *args, **kwargs):
+        response = super().post(request, *args, **kwargs)
+        # the cart filled before logging in becomes part of the user cart
+        guest_token = get_guest_token(request)
+        if guest_token:
+            merge_guest_cart(guest_token, self.serializer.user.id)
+            response.delete_cookie(settings.GUEST_CART_COOKIE)
+        return response
+
 
 class UsersApiView(generics.ListCreateAPIView):
     """
@@ -30,6 +30,9 @@ DEBUG = env('DEBUG', cast=bool, default=False)
 
 ALLOWED_HOSTS = env.list('ALLOWED_HOSTS', default=[])
 
+# absolute links outside of a request, e.g. in the catalog feed
+SITE_URL = env('SITE_URL', cast=str, default='http://localhost:8000')
+
 
 # Application Definition
 DJANGO_APPS = [
@@ -172,7 +175,7 @@ REST_FRAMEWORK = {
         'anon': '100/day',
         'user': '1000/day',
     },
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'product.pagination.KeysetPagination',
     'PAGE_SIZE': 10,
 }
 
@@ -249,6 +252,19 @@ CACHES = {
     },
 }
 
+# Cart
+# 'db' writes every cart change to CartItem, 'cache' serves carts from the cache
+# and writes them behind to CartItem, CART_FLUSH_DELAY seconds after a change
+CART_STORAGE = env('CART_STORAGE', cast=str, default='db')
+CART_FLUSH_DELAY = env('CART_FLUSH_DELAY', cast=int, default=30)
+# anonymous carts, held only in the cache and merged into the user cart on login
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_TIMEOUT = env('GUEST_CART_TIMEOUT', cast=int, default=60 * 60 * 24 * 7)
+
+# Stock
+# a pending order holds its stock this long, then the sweeper cancels it
+STOCK_RESERVATION_TTL = env('STOCK_RESERVATION_TTL', cast=int, default=60 * 15)
+
 # Celery
 CELERY_BROKER_URL = env('CELERY_BROKER_URL', cast=str)
 CELERY_RESULT_BACKEND = env('CELERY_BROKER_URL', cast=str)
@@ -256,6 +272,16 @@ CELERY_ACCEPT_CONTENT = env('CELERY_ACCEPT_CONTENT', cast=list)
 CELERY_TASK_SERIALIZER = env('CELERY_TASK_SERIALIZER', cast=str)
 CELERY_RESULT_SERIALIZER = env('CELERY_RESULT_SERIALIZER', cast=str)
 CELERY_TIMEZONE = os.environ.get('TIME_ZONE')
+CELERY_BEAT_SCHEDULE = {
+    'generate-catalog-feed': {
+        'task': 'product.tasks.generate_catalog_feed',
+        'schedule': 60 * 10,
+    },
+    'release-expired-reservations': {
+        'task': 'product.tasks.release_expired_reservations',
+        'schedule': 60,
+    },
+}
 
 # TOTP
 TOTP_INTERVAL = eval(env('TOTP_INTERVAL', cast=str))
@@ -3,16 +3,41 @@ from .models import (
     Category, Product, ProductImage, ProductAttribute,
     Coupon, ProductCoupon, CategoryCoupon,
     Review, Cart, CartItem,
-    Order, OrderItem, Payment
+    Order, OrderItem, Payment, StockReservation
 )
 from taggit.admin import TagAdmin
+from django.utils.translation import gettext_lazy as _
+from .utils.category_service import subtree_filter
 
 
 # Category
+class CategorySubtreeFilter(admin.SimpleListFilter):
+    title = _('Category')
+    parameter_name = 'category_tree'
+    path_field = 'category__path'
+
+    def lookups(self, request, model_admin):
+        categories = Category.objects.order_by('path').only('id', 'name', 'path')
+        return [(c.pk, '— ' * (c.path.count('/') - 1) + c.name) for c in categories]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        path = Category.objects.filter(
+            pk=self.value()).values_list('path', flat=True).first()
+        return queryset.filter(subtree_filter([path] if path else [], self.path_field))
+
+
+class ParentSubtreeFilter(CategorySubtreeFilter):
+    title = _('Parent Category')
+    parameter_name = 'parent_tree'
+    path_field = 'path'
+
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug', 'parent', 'is_active')
-    list_filter = ('is_active',)
+    list_filter = ('is_active', ParentSubtreeFilter)
     search_fields = ('name', 'slug')
     prepopulated_fields = {'slug': ('name',)}
 
@@ -33,8 +58,8 @@ class ProductAttributeInline(admin.TabularInline):
 @admin.register(Product)
 class ProductAdmin(TagAdmin):
     list_display = ('name', 'sku', 'category', 'price',
-                    'stock', 'is_available', 'created_at')
-    list_filter = ('is_available', 'category', 'tags')
+                    'stock', 'carts_count', 'is_available', 'created_at')
+    list_filter = ('is_available', CategorySubtreeFilter, 'tags')
     search_fields = ('name', 'sku', 'description')
     inlines = [ProductImageInline, ProductAttributeInline]
     prepopulated_fields = {'slug': ('name',)}
@@ -90,12 +115,18 @@ class OrderItemInline(admin.TabularInline):
     readonly_fields = ('price',)
 
 
+class StockReservationInline(admin.TabularInline):
+    model = StockReservation
+    extra = 0
+    readonly_fields = ('product', 'quantity', 'expires_at')
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status', 'total_amount', 'created_at')
     list_filter = ('status', 'created_at')
     search_fields = ('user__email', 'id')
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, StockReservationInline]
 
 
 # Payment
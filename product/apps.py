@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ProductApiConfig(AppConfig):
@@ -7,3 +8,21 @@ class ProductApiConfig(AppConfig):
 
     def ready(self):
         from . import signals
+        post_migrate.connect(create_search_index, sender=self)
+        post_migrate.connect(fill_category_paths, sender=self)
+
+
+def create_search_index(sender, **kwargs):
+    # the full-text table is backend specific, so it is created here and not in a migration
+    from .utils.search_service import setup_search_index, rebuild_search_index
+    # a new table misses the products saved before it, they are indexed once here
+    if setup_search_index():
+        rebuild_search_index()
+
+
+def fill_category_paths(sender, **kwargs):
+    # the categories saved before `path` existed are filled once, later saves keep it current
+    from .models import Category
+    from .utils.category_service import rebuild_category_paths
+    if Category.objects.filter(path='').exists():
+        rebuild_category_paths()
@@ -1,4 +1,8 @@
 from django_filters import rest_framework as filters
+from django.db.models import Q
+from .utils.search_service import search_products
+from .utils.tag_service import filter_by_tags
+from .utils.category_service import subtree_filter
 from .models import (
     Category, Product, ProductImage, ProductAttribute,
     Coupon, CategoryCoupon, ProductCoupon, Review, ReviewImage,
@@ -8,9 +12,10 @@ from .models import (
 
 class ProductListFilter(filters.FilterSet):
     tags = filters.CharFilter(method='filter_by_tags')
-    name = filters.CharFilter(field_name='name', lookup_expr='icontains')
-    category = filters.CharFilter(
-        field_name='category__name', lookup_expr='icontains')
+    tags_all = filters.CharFilter(method='filter_by_tags')
+    search = filters.CharFilter(method='filter_by_search')
+    name = filters.CharFilter(method='filter_by_name')
+    category = filters.CharFilter(method='filter_by_category')
 
     class Meta:
         model = Product
@@ -20,4 +25,19 @@ class ProductListFilter(filters.FilterSet):
         }
 
     def filter_by_tags(self, queryset, name, value):
-        return queryset.filter(tags__name__in=value.split(',')).distinct()
+        # `tags` matches any of the tags, `tags_all` matches all of them
+        return filter_by_tags(queryset, value.split(','), match_all=name == 'tags_all')
+
+    def filter_by_category(self, queryset, name, value):
+        # matching categories and all of their subcategories
+        paths = Category.objects.filter(
+            Q(name__iexact=value) | Q(slug=value)).values_list('path', flat=True)
+        return queryset.filter(subtree_filter(paths))
+
+    def filter_by_search(self, queryset, name, value):
+        # ranked over name, sku, tags, attributes and description
+        return search_products(queryset, value)
+
+    def filter_by_name(self, queryset, name, value):
+        # words starting with the terms, from the search index: "phone" does not match "iPhone"
+        return search_products(queryset, value, name_only=True, rank=False)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from product.utils.explain_service import get_hot_queries, explain
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN on the querysets of the busiest endpoints and flags full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true',
+                            help='Print the plan of every query, not only the flagged ones')
+
+    def handle(self, *args, **options):
+        flagged = []
+        for name, queryset in get_hot_queries().items():
+            plan, scans = explain(queryset)
+            if scans:
+                flagged.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: full scan"))
+                for line in scans:
+                    self.stdout.write(f"    {line.strip()}")
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{name}: ok"))
+            if options['verbose_plans']:
+                self.stdout.write(plan)
+
+        if flagged:
+            raise CommandError(f"{len(flagged)} queries read a whole table: {', '.join(flagged)}")
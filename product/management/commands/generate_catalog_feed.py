@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from product.utils.feed_service import generate_catalog_feed
+
+
+class Command(BaseCommand):
+    help = 'Regenerates the jsonl and xml catalog feeds from the products changed since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Rebuild the feeds from every product')
+
+    def handle(self, *args, **options):
+        state = generate_catalog_feed(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Catalog feed of {state['generated_at']}: {', '.join(state['paths'].values())}"))
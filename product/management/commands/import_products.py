@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from product.utils.import_service import import_products, IMPORT_CHUNK_SIZE
+import os
+
+
+class Command(BaseCommand):
+    help = 'Imports products from a csv or jsonl file, upserting on slug in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if format not in ('csv', 'jsonl'):
+            raise CommandError('Use a .csv or .jsonl file or pass --format.')
+
+        def progress(report):
+            self.stdout.write(
+                f"{report['rows']} rows: {report['created']} created, "
+                f"{report['updated']} updated, {report['failed']} failed")
+
+        try:
+            with open(path, 'rb') as file:
+                report = import_products(
+                    file, format, chunk_size=options['chunk_size'], progress=progress)
+        except OSError as error:
+            raise CommandError(error)
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report['created'] + report['updated']} of {report['rows']} rows."))
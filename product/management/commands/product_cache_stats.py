@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from product.utils.cache_service import product_detail_stats
+
+
+class Command(BaseCommand):
+    help = 'Shows the hit and miss counters of the product detail cache'
+
+    def handle(self, *args, **options):
+        stats = product_detail_stats()
+        self.stdout.write(
+            f"hits: {stats['hits']}, misses: {stats['misses']}, hit ratio: {stats['hit_ratio']:.2%}")
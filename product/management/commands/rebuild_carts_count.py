@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from product.utils.counter_service import rebuild_carts_count
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored carts_count of products from cart items, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = rebuild_carts_count(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Fixed carts_count of {fixed} products."))
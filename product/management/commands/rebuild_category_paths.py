@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from product.utils.category_service import rebuild_category_paths
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the materialized path of all categories'
+
+    def handle(self, *args, **options):
+        fixed = rebuild_category_paths()
+        self.stdout.write(self.style.SUCCESS(
+            f"Fixed path of {fixed} categories."))
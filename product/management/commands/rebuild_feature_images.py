@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from product.utils.image_service import rebuild_feature_images
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored feature_image of products from product images, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = rebuild_feature_images(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Fixed feature_image of {fixed} products."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from product.utils.search_service import setup_search_index, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Creates the product full-text index if needed and reindexes all products, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        setup_search_index()
+        indexed = rebuild_search_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} products."))
@@ -6,6 +6,9 @@ from product.models import (
     Category, Product, ProductImage, ProductAttribute, Cart,
     Coupon, ProductCoupon, CategoryCoupon, CartItem, ReviewImage
 )
+from product.utils.counter_service import rebuild_carts_count
+from product.utils.image_service import rebuild_feature_images
+from product.utils.search_service import rebuild_search_index
 import random
 from datetime import timedelta, datetime
 from django.utils import timezone
@@ -46,7 +49,6 @@ class Command(BaseCommand):
 
     def create_products(self, categories, count=100):
         products = []
-        year = timezone.now().year
         for i in range(count):
             name = fake.unique.catch_phrase()
             slug = slugify(name, allow_unicode=True)
@@ -54,8 +56,6 @@ class Command(BaseCommand):
             product = Product(
                 name=name,
                 slug=slug,
-                # bulk_create not call save() method
-                sku=f"PRD-{year}-{i:05d}",
                 category=random.choice(categories),
                 description=fake.paragraph(nb_sentences=5),
                 price=random.randint(2, 20000) * 10000,
@@ -107,6 +107,8 @@ class Command(BaseCommand):
                 ]
                 ReviewImage.objects.bulk_create(review_images)
 
+        rebuild_feature_images()
+        rebuild_search_index()
         self.stdout.write(
             f"Created {count} products with images, attributes, tags, and reviews.")
         return products
@@ -162,6 +164,8 @@ class Command(BaseCommand):
                     quantity=random.randint(1, min(7, product.stock))
                 ))
         CartItem.objects.bulk_create(cart_items)
+        # bulk_create does not send post_save, so counters are rebuilt once
+        rebuild_carts_count()
         self.stdout.write("Created cart items.")
 
     def handle(self, *args, **options):
@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+import hashlib
+from .utils import cart_service
+
+
+class SparseFieldsMixin:
+    """
+    `?fields=id,name,price` limits both the serializer output and the queryset.
+
+    `sparse_fields` maps a serializer field to what the queryset needs to render it:
+    `only` columns, `select_related`, `prefetch_related` and `annotate`.
+    Fields which are not listed there need only the model column of the same name.
+    Without `?fields=` every plan is applied and the base queryset columns are kept.
+    `required_fields` are columns the view reads besides the serializer.
+    """
+    fields_query_param = 'fields'
+    sparse_fields = {}
+    required_fields = ()
+
+    def get_requested_fields(self):
+        request = getattr(self, 'request', None)
+        if request is None:
+            return None
+        value = request.query_params.get(self.fields_query_param)
+        if not value:
+            return None
+        return {name.strip() for name in value.split(',') if name.strip()}
+
+    def get_queryset(self):
+        return self.get_sparse_queryset(super().get_queryset())
+
+    def get_sparse_queryset(self, queryset):
+        requested = self.get_requested_fields()
+        names = self.sparse_fields.keys() if requested is None else requested
+
+        only, select_related, prefetch_related, annotate = {'id'}, [], [], {}
+        concrete = {f.name for f in queryset.model._meta.concrete_fields}
+        for name in names:
+            plan = self.sparse_fields.get(name)
+            if plan is None:
+                if name in concrete:
+                    only.add(name)
+                continue
+            only.update(plan.get('only', ()))
+            select_related += plan.get('select_related', [])
+            prefetch_related += plan.get('prefetch_related', [])
+            annotate.update(plan.get('annotate', {}))
+
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        if annotate:
+            queryset = queryset.annotate(**annotate)
+        if requested is not None:
+            # ordering columns are read by the keyset pagination cursor
+            only.update(f for f in getattr(self, 'ordering_fields', None) or () if f in concrete)
+            only.update(self.required_fields)
+            queryset = queryset.only(*only)
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_requested_fields()
+        return context
+
+
+class SparseFieldsSerializerMixin:
+    """
+    Drops the fields which are not in `context['fields']`, set by `SparseFieldsMixin`
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields is None:
+            return
+        for name in set(self.fields) - fields:
+            self.fields.pop(name)
+
+
+class ConditionalGetMixin:
+    """
+    Answers `If-None-Match` / `If-Modified-Since` with 304 before anything is serialized.
+
+    Views implement `get_validators()` returning `(parts, last_modified)`, where `parts`
+    is a cheap summary of everything rendered (hashed into the ETag, together with the
+    query string and the media type) or None to skip, and `last_modified` is a datetime or None.
+    A view which summarizes what it has read instead skips here, and answers with
+    `get_etag()` and `set_validators()` itself.
+    """
+    cache_control = {'max_age': 0, 'must_revalidate': True}
+
+    def get_validators(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        parts, last_modified = self.get_validators()
+        if parts is None:
+            return super().get(request, *args, **kwargs)
+        etag = self.get_etag(parts)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return self.set_validators(response, etag, timestamp)
+
+    def get_etag(self, parts):
+        return quote_etag(hashlib.md5(repr(
+            [parts, self.request.get_full_path(), self.request.accepted_media_type]
+        ).encode()).hexdigest())
+
+    def set_validators(self, response, etag, timestamp=None):
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+            patch_cache_control(response, **self.cache_control)
+        return response
+
+
+GUEST_CART_SALT = 'guest_cart'
+
+
+def get_guest_token(request):
+    """
+    return: the guest cart token of the signed cookie, None if it is missing, forged or expired
+    """
+    return request.get_signed_cookie(
+        settings.GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT,
+        max_age=settings.GUEST_CART_TIMEOUT)
+
+
+class GuestCartMixin:
+    """
+    Lets anonymous users keep a cart, held in the cache under the token of a signed cookie.
+    The cookie is renewed with every response, as the cart is with every change.
+    """
+
+    def get_cart_owner(self):
+        """
+        return: the user id, or the guest cart token, a new one if the request has none
+        """
+        if self.request.user.is_authenticated:
+            return self.request.user.id
+        if not hasattr(self, 'guest_token'):
+            self.guest_token = get_guest_token(self.request) or cart_service.new_guest_token()
+        return self.guest_token
+
+    def uses_cart_cache(self):
+        return cart_service.uses_cache(self.get_cart_owner())
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'guest_token', None):
+            response.set_signed_cookie(
+                settings.GUEST_CART_COOKIE, self.guest_token, salt=GUEST_CART_SALT,
+                max_age=settings.GUEST_CART_TIMEOUT, httponly=True, samesite='Lax')
+        return response
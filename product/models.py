@@ -4,6 +4,8 @@ from django.contrib.auth import get_user_model
 from django.utils import timezone
 from taggit.managers import TaggableManager
 from django.core.exceptions import ValidationError
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 import random
 import string
 
@@ -18,6 +20,9 @@ class Category(models.Model):
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True,
                                blank=True, related_name='children', verbose_name=_('Parent Category'))
     is_active = models.BooleanField(default=True, verbose_name=_('Is Active'))
+    # ids from the root to this category, like "1/4/9/", a subtree is `path__startswith`
+    path = models.CharField(max_length=255, db_index=True,
+                            editable=False, verbose_name=_('Path'))
 
     class Meta:
         verbose_name = _('Category')
@@ -27,6 +32,44 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        parent_path = self.parent.path if self.parent_id else ''
+        if self.path and parent_path.startswith(self.path):
+            raise ValidationError("A category can not be moved under itself.")
+
+        super().save(*args, **kwargs)
+
+        old_path = self.path
+        self.path = f"{parent_path}{self.pk}/"
+        if self.path != old_path:
+            Category.objects.filter(pk=self.pk).update(path=self.path)
+            if old_path:
+                Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(self.path), Substr('path', len(old_path) + 1)))
+
+
+class Sequence(models.Model):
+    """
+    Named counters handed out in blocks, see utils/sku_service.py
+    """
+    name = models.CharField(max_length=50, primary_key=True, verbose_name=_('Name'))
+    value = models.PositiveBigIntegerField(default=0, verbose_name=_('Value'))
+
+    class Meta:
+        verbose_name = _('Sequence')
+        verbose_name_plural = _('Sequences')
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class ProductQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        from .utils.sku_service import assign_skus
+        objs = list(objs)
+        assign_skus(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
 
 class Product(models.Model):
     name = models.CharField(max_length=200, verbose_name=_('Name'))
@@ -42,22 +85,55 @@ class Product(models.Model):
     tags = TaggableManager(blank=True, verbose_name=_('Tags'))
     is_available = models.BooleanField(
         default=True, verbose_name=_('Is Available'))
+    # maintained by CartItem signals, see utils/counter_service.py
+    carts_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Carts Count'))
+    # maintained by Review signals, see utils/counter_service.py
+    rating_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Rating Count'))
+    rating_sum = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Rating Sum'))
+    rating_avg = models.FloatField(
+        default=0, editable=False, verbose_name=_('Rating Average'))
+    rating_1_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('1 Star Ratings'))
+    rating_2_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('2 Star Ratings'))
+    rating_3_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('3 Star Ratings'))
+    rating_4_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('4 Star Ratings'))
+    rating_5_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('5 Star Ratings'))
+    # maintained by ProductImage signals, see utils/image_service.py
+    feature_image = models.ImageField(
+        upload_to='products/images/', blank=True, editable=False, verbose_name=_('Feature Image'))
+    feature_image_variants = models.JSONField(
+        default=dict, blank=True, editable=False, verbose_name=_('Feature Image Variants'))
     created_at = models.DateTimeField(
         auto_now_add=True, verbose_name=_('Created At'))
     updated_at = models.DateTimeField(
         auto_now=True, verbose_name=_('Updated At'))
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Product')
         verbose_name_plural = _('Products')
         ordering = ('name',)
+        # the orderings of ProductList, `id` is the keyset pagination tiebreaker
+        indexes = [
+            models.Index(fields=[field, 'id'], condition=models.Q(is_available=True),
+                         name=f'product_avail_{field}_idx')
+            for field in ('name', 'price', 'created_at', 'rating_avg')
+        ]
 
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if not self.sku and (update_fields is None or 'sku' in update_fields):
+            from .utils.sku_service import assign_skus
+            assign_skus([self])
         super().save(*args, **kwargs)
-        if not self.sku:
-            year = timezone.now().year
-            self.sku = f"PRD-{year}-{self.id:05d}"
-            super().save(update_fields=['sku'])
 
     def __str__(self):
         return f"{self.name} ({self.sku})"
@@ -69,6 +145,9 @@ class ProductImage(models.Model):
     )
     image = models.ImageField(
         upload_to='products/images/', verbose_name=_('Image'))
+    # resized copies, written by the generate_image_variants task
+    variants = models.JSONField(
+        default=dict, blank=True, editable=False, verbose_name=_('Variants'))
     is_feature = models.BooleanField(
         default=False, verbose_name=_('Is Featured'))
 
@@ -201,16 +280,32 @@ class Review(models.Model):
         verbose_name_plural = _('Reviews')
         unique_together = ('product', 'user')
         ordering = ('rating',)
+        # the review list of a product, see ProductReviewList
+        indexes = [
+            models.Index(fields=['product', 'created_at', 'id']),
+            models.Index(fields=['product', 'rating', 'id']),
+        ]
 
     def __str__(self):
         return f'{self.user.email} - {self.product.name} - {self.rating}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # for moving the rating aggregates when the rating or product changes
+        if 'rating' in instance.__dict__ and 'product_id' in instance.__dict__:
+            instance._loaded_rating = (instance.product_id, instance.rating)
+        return instance
+
 
 class ReviewImage(models.Model):
     review = models.ForeignKey(
         Review, on_delete=models.CASCADE, related_name='images', verbose_name=_('Review'))
     image = models.ImageField(
         upload_to='reviews/images/', verbose_name=_('Image'))
+    # resized copies, written by the generate_image_variants task
+    variants = models.JSONField(
+        default=dict, blank=True, editable=False, verbose_name=_('Variants'))
 
     class Meta:
         verbose_name = _('Product Image')
@@ -239,6 +334,13 @@ class Cart(models.Model):
         return f"Cart {self.id} - {self.user}"
 
 
+class CartItemQuerySet(models.QuerySet):
+    def delete(self):
+        from .utils.counter_service import defer_carts_count
+        with defer_carts_count():
+            return super().delete()
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey(
         Cart, on_delete=models.CASCADE, related_name='items', verbose_name=_('Cart'))
@@ -247,6 +349,8 @@ class CartItem(models.Model):
     quantity = models.PositiveSmallIntegerField(
         default=1, verbose_name=_('Quantity'))
 
+    objects = CartItemQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Cart Item')
         verbose_name_plural = _('Cart Items')
@@ -255,6 +359,14 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.product.name} ({self.quantity})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # for moving carts_count when the product of an item changes
+        if 'product_id' in instance.__dict__:
+            instance._loaded_product_id = instance.product_id
+        return instance
+
     def save(self, *args, **kwargs):
         if self.product.stock < self.quantity:
             self.quantity = self.product.stock
@@ -262,6 +374,11 @@ class CartItem(models.Model):
         return super().save()
 
 
+def tracking_code_range(prefix):
+    # `startswith` as a range, which any database answers from the unique index
+    return {'tracking_code__gte': prefix, 'tracking_code__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
 class Order(models.Model):
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='orders', verbose_name=_('User'))
@@ -289,10 +406,16 @@ class Order(models.Model):
         null=True, blank=True, default=0, verbose_name=_('Discount Amount'))
     final_amount = models.PositiveBigIntegerField(
         verbose_name=_('Final Amount'))
+    coupon = models.CharField(
+        max_length=50, blank=True, verbose_name=_('Coupon'))
 
     class Meta:
         verbose_name = _('Order')
         verbose_name_plural = _('Orders')
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id']),
+            models.Index(fields=['user', 'status']),
+        ]
 
     def __str__(self):
         return f"Order {self.id} - {self.user}"
@@ -301,7 +424,7 @@ class Order(models.Model):
         if not self.tracking_code and self.status == 'pending':
             today = timezone.now().strftime('%Y%m%d')
             last_order = Order.objects.filter(
-                tracking_code__startswith=f"ORD-{today}-"
+                **tracking_code_range(f"ORD-{today}-")
             ).order_by('-tracking_code').first()
             serial = 1
             if last_order:
@@ -327,6 +450,26 @@ class OrderItem(models.Model):
         return f"{self.product} --> {self.quantity}"
 
 
+class StockReservation(models.Model):
+    # stock taken for a pending order, see utils/stock_service.py
+    order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, related_name='reservations', verbose_name=_('Order'))
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='reservations', verbose_name=_('Product'))
+    quantity = models.PositiveIntegerField(verbose_name=_('Quantity'))
+    expires_at = models.DateTimeField(verbose_name=_('Expires At'))
+
+    class Meta:
+        verbose_name = _('Stock Reservation')
+        verbose_name_plural = _('Stock Reservations')
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} --> {self.quantity} for order {self.order_id}"
+
+
 class Payment(models.Model):
     order = models.OneToOneField(
         Order, on_delete=models.CASCADE, related_name='payment', verbose_name=_('Order'))
@@ -346,7 +489,7 @@ class Payment(models.Model):
         verbose_name=_('Status')
     )
     transaction_id = models.CharField(
-        max_length=255, blank=True, verbose_name=_('Transaction ID'))
+        max_length=255, blank=True, db_index=True, verbose_name=_('Transaction ID'))
     tracking_code = models.CharField(
         max_length=50, unique=True, blank=True, verbose_name=_('Tracking Code'))
     created_at = models.DateTimeField(
@@ -363,7 +506,7 @@ class Payment(models.Model):
         if not self.tracking_code and self.status == 'pending':
             today = timezone.now().strftime('%Y%m%d')
             last_payment = Payment.objects.filter(
-                tracking_code__startswith=f"PAY-{today}-"
+                **tracking_code_range(f"PAY-{today}-")
             ).order_by('-tracking_code').first()
             serial = 1
             if last_payment:
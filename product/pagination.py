@@ -0,0 +1,234 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import datetime
+import json
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Q, QuerySet
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    Limit/offset by default, keyset (cursor) mode with `?pagination=cursor` or `?cursor=`.
+
+    In cursor mode a page is fetched with `WHERE (field, id) > (value, last_id)`
+    instead of OFFSET, and no COUNT(*) is executed, so deep pages cost the same as the first.
+    The ordering comes from `?ordering=` if it is listed in the view `ordering_fields`,
+    otherwise from the view `ordering` or the model Meta ordering, with `id` as tiebreaker.
+    A ranked search, the view `rank_query_param`, has no key to seek on, so without
+    `?ordering=` it is paginated with limit/offset to keep its rank order.
+    """
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    ordering_query_param = 'ordering'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def is_cursor_mode(self, request):
+        return (
+            self.cursor_query_param in request.query_params
+            or request.query_params.get(self.mode_query_param) == 'cursor'
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.uses_keyset(queryset, request, view)
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        page_queryset, cursor = self.get_keyset_queryset(queryset, request, view)
+        results = list(page_queryset)
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+        reverse = bool(cursor and cursor['r'])
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = results
+        return results
+
+    def uses_keyset(self, queryset, request, view):
+        # a list, like a cart served from the cache, has no keyset to seek on
+        return (
+            self.is_cursor_mode(request) and isinstance(queryset, QuerySet)
+            and not self.is_ranked(request, view)
+        )
+
+    def get_keyset_queryset(self, queryset, request, view):
+        """
+        return: (the query of the page and one more row, the decoded cursor or None)
+        """
+        self.limit = self.get_limit(request)
+        self.page_model = queryset.model
+        self.ordering = self.get_ordering(queryset, request, view)
+        field_name, descending = self.ordering
+        cursor = self.decode_cursor(request)
+
+        reverse = bool(cursor and cursor['r'])
+        order = [f'-{field_name}', '-id'] if descending != reverse else [field_name, 'id']
+        if field_name == 'id':
+            order = order[:1]
+        queryset = queryset.order_by(*order)
+
+        if cursor:
+            queryset = queryset.filter(self.get_position_filter(
+                field_name, descending != reverse, cursor['v'], cursor['id']))
+        return queryset[:self.limit + 1], cursor
+
+    def get_requested_ordering(self, request, view):
+        allowed = getattr(view, 'ordering_fields', None) or []
+        requested = request.query_params.get(self.ordering_query_param, '').split(',')[0].strip()
+        if requested and requested.lstrip('-') in allowed:
+            return requested
+        return None
+
+    def is_ranked(self, request, view):
+        rank_query_param = getattr(view, 'rank_query_param', None)
+        return bool(
+            rank_query_param and request.query_params.get(rank_query_param, '').strip()
+            and not self.get_requested_ordering(request, view)
+        )
+
+    def get_ordering(self, queryset, request, view):
+        ordering = self.get_requested_ordering(request, view)
+        if not ordering:
+            ordering = getattr(view, 'ordering', None) or queryset.model._meta.ordering or ('id',)
+            if not isinstance(ordering, str):
+                ordering = ordering[0]
+
+        field_name = ordering.lstrip('-')
+        try:
+            field = queryset.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or field.null or not field.concrete:
+            # nullable or computed keys can not be compared with `>`
+            return 'id', ordering.startswith('-')
+        return field_name, ordering.startswith('-')
+
+    @staticmethod
+    def get_position_filter(field_name, descending, value, pk):
+        lookup = 'lt' if descending else 'gt'
+        if field_name == 'id':
+            return Q(**{f'id__{lookup}': pk})
+        return Q(**{f'{field_name}__{lookup}': value}) | Q(**{field_name: value, f'id__{lookup}': pk})
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            if cursor['o'] != self.ordering_key():
+                raise ValueError
+            field_name = self.ordering[0]
+            cursor['v'] = self.field_to_python(field_name, cursor['v'])
+            cursor['id'] = int(cursor['id'])
+            cursor['r'] = bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, DjangoValidationError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, obj, reverse=False):
+        field_name = self.ordering[0]
+        value = getattr(obj, self.model_field(field_name).attname)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        payload = {'o': self.ordering_key(), 'v': value, 'id': obj.pk}
+        if reverse:
+            payload['r'] = 1
+        encoded = urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode('ascii'))
+
+    def ordering_key(self):
+        field_name, descending = self.ordering
+        return f'-{field_name}' if descending else field_name
+
+    def model_field(self, field_name):
+        return self.page_model._meta.get_field(field_name)
+
+    def field_to_python(self, field_name, value):
+        if field_name == 'id':
+            return value
+        return self.model_field(field_name).to_python(value)
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1])
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super().get_previous_link()
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                'name': self.mode_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Set to `cursor` to use keyset pagination instead of limit/offset.',
+                'schema': {'type': 'string', 'enum': ['cursor']},
+            },
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+        ]
+
+
+class CursorPagination(KeysetPagination):
+    """
+    Always in cursor mode, for lists that are too long to be counted or offset into.
+    """
+
+    def is_cursor_mode(self, request):
+        return True
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.limit_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+        ]
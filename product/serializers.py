@@ -3,13 +3,17 @@ from rest_framework.exceptions import PermissionDenied
 from django.contrib.auth import get_user_model
 from django.utils.translation import gettext_lazy as _
 from drf_spectacular.utils import extend_schema_field
+from .mixins import SparseFieldsSerializerMixin
 from .models import (
     Category, Product, ProductImage, ProductAttribute,
     Coupon, CategoryCoupon, ProductCoupon, UserCoupon, Review,
     ReviewImage, CartItem, Order, OrderItem, Payment
 )
+from .utils.image_service import get_srcset
 
 User = get_user_model()
+# {"webp": "<url> 320w, <url> 640w", "jpeg": ...}
+SRCSET_SCHEMA = serializers.DictField(child=serializers.CharField())
 
 
 # Category Section
@@ -27,14 +31,14 @@ class CategorySerializer(serializers.ModelSerializer):
 
 
 # Product Section
-class ProductSerializer(serializers.ModelSerializer):
-    carts_count = serializers.IntegerField()
+class ProductSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
         fields = ['id', 'url', 'name', 'slug', 'sku',
-                  'price', 'stock', 'carts_count', 'image']
+                  'price', 'stock', 'carts_count', 'rating_avg', 'rating_count', 'image', 'srcset']
         depth = 1
         extra_kwargs = {
             'url': {'view_name': 'product-detail', 'lookup_field': 'slug'},
@@ -42,14 +46,25 @@ class ProductSerializer(serializers.ModelSerializer):
 
     @extend_schema_field(serializers.URLField)
     def get_image(self, obj):
-        if obj.images.exists():
-            return obj.images.first().image.url
+        if obj.feature_image:
+            return obj.feature_image.url
+        return None
+
+    @extend_schema_field(SRCSET_SCHEMA)
+    def get_srcset(self, obj):
+        return get_srcset(obj.feature_image_variants, obj.feature_image.storage)
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = ProductImage
-        fields = ['image']
+        fields = ['image', 'srcset']
+
+    @extend_schema_field(SRCSET_SCHEMA)
+    def get_srcset(self, obj):
+        return get_srcset(obj.variants, obj.image.storage)
 
 
 class ProductAttributeSerializer(serializers.ModelSerializer):
@@ -64,16 +79,24 @@ class ProductReviewSerializer(serializers.ModelSerializer):
         fields = ['user', 'rating', 'title', 'comment', 'created_at']
 
 
-class ProductDetailSerializer(serializers.ModelSerializer):
-    carts_count = serializers.IntegerField()
+class ProductDetailSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     attributes = ProductAttributeSerializer(many=True, read_only=True)
-    reviews = ProductReviewSerializer(many=True, read_only=True)
+    # only the latest reviews, see ProductDetail
+    reviews = ProductReviewSerializer(source='latest_reviews', many=True, read_only=True)
+    reviews_url = serializers.HyperlinkedIdentityField(
+        view_name='product-review-list', lookup_field='slug')
+    rating_histogram = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
         fields = ['name', 'slug', 'price', 'stock', 'carts_count', 'category',
-                  'description', 'images', 'attributes', 'reviews']
+                  'description', 'rating_avg', 'rating_count', 'rating_histogram',
+                  'images', 'attributes', 'reviews', 'reviews_url']
+
+    @extend_schema_field(serializers.DictField(child=serializers.IntegerField()))
+    def get_rating_histogram(self, obj):
+        return {str(i): getattr(obj, f'rating_{i}_count') for i in range(1, 6)}
 
 
 class AdminProductSerializer(serializers.ModelSerializer):
@@ -92,6 +115,57 @@ class AdminProductAttributeSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductAttribute
         fields = '__all__'
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    """
+    One row of a bulk import, see utils/import_service.py.
+    category is a category slug, images are storage paths.
+    A missing key keeps the value of an existing product, name and price are required for a new one.
+    """
+    name = serializers.CharField(max_length=200, required=False)
+    slug = serializers.SlugField(max_length=220, allow_unicode=True)
+    sku = serializers.CharField(max_length=20, required=False, allow_null=True, allow_blank=True)
+    category = serializers.SlugField(required=False, allow_null=True, allow_unicode=True)
+    description = serializers.CharField(required=False, allow_blank=True)
+    price = serializers.IntegerField(min_value=0, required=False)
+    stock = serializers.IntegerField(min_value=0, required=False)
+    is_available = serializers.BooleanField(required=False)
+    tags = serializers.ListField(child=serializers.CharField(max_length=100), required=False)
+    images = serializers.ListField(child=serializers.CharField(max_length=100), required=False)
+    attributes = serializers.DictField(
+        child=serializers.CharField(max_length=100, allow_blank=True), required=False)
+
+    def validate_attributes(self, value):
+        if any(not key or len(key) > 100 for key in value):
+            raise serializers.ValidationError(_('Attribute keys must have 1 to 100 characters.'))
+        return value
+
+
+class ProductImportSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    format = serializers.ChoiceField(choices=['csv', 'jsonl'], required=False)
+
+
+class ProductBatchUpdateItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField(required=False)
+    sku = serializers.CharField(max_length=20, required=False)
+    price = serializers.IntegerField(min_value=0, required=False)
+    stock = serializers.IntegerField(min_value=0, required=False)
+    is_available = serializers.BooleanField(required=False)
+
+    def validate(self, attrs):
+        if ('id' in attrs) == ('sku' in attrs):
+            raise serializers.ValidationError(_('Pass either id or sku.'))
+        if not {'price', 'stock', 'is_available'} & attrs.keys():
+            raise serializers.ValidationError(_('Pass at least one of price, stock and is_available.'))
+        return attrs
+
+
+class ProductBatchUpdateSerializer(serializers.Serializer):
+    # validated one by one in utils/batch_service.py, to report every row
+    items = serializers.ListField(
+        child=serializers.DictField(), allow_empty=False, max_length=5000)
 # ______________________________________
 
 
@@ -160,9 +234,15 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 
 class ReviewImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = ReviewImage
-        fields = '__all__'
+        exclude = ['variants']
+
+    @extend_schema_field(SRCSET_SCHEMA)
+    def get_srcset(self, obj):
+        return get_srcset(obj.variants, obj.image.storage)
 
 
 class AdminReviewSerializer(serializers.ModelSerializer):
@@ -181,26 +261,25 @@ class AdminReviewImageSerializer(serializers.ModelSerializer):
 # Cart Section
 class CartProductSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
-    carts_count = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
         fields = ProductSerializer.Meta.fields
+        extra_kwargs = ProductSerializer.Meta.extra_kwargs
 
     @extend_schema_field(serializers.URLField)
     def get_image(self, obj):
-        if obj.prefetched_feature_image:
-            return obj.prefetched_feature_image[0].image.url
+        if obj.feature_image:
+            return obj.feature_image.url
         return None
 
-    @extend_schema_field(serializers.IntegerField)
-    def get_carts_count(self, obj):
-        if hasattr(obj, 'prefetched_cart_items'):
-            return len(obj.prefetched_cart_items)
-        return obj.cart_items.count()
+    @extend_schema_field(SRCSET_SCHEMA)
+    def get_srcset(self, obj):
+        return get_srcset(obj.feature_image_variants, obj.feature_image.storage)
 
 
-class CartItemsListSerializer(serializers.ModelSerializer):
+class CartItemsListSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     product = CartProductSerializer()
 
     class Meta:
@@ -262,6 +341,22 @@ class CartItemsUpdateSerializer(serializers.ModelSerializer):
         model = CartItem
         fields = ['id', 'quantity']
 
+
+class CartOperationSerializer(serializers.Serializer):
+    # add: to the quantity in the cart, set: replaces it
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product_id = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1, max_value=32767, required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] != 'remove' and 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': _('This field is required.')})
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=100)
+
 # ______________________________________
 
 
@@ -272,7 +367,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'price']
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)
     items = OrderItemSerializer(many=True, read_only=True)
     payment_method = serializers.ChoiceField(
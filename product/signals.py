@@ -1,7 +1,18 @@
 from django.dispatch import Signal, receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.contrib.auth import get_user_model
-from .models import Cart
+from django.db import transaction
+from taggit.models import Tag
+from .models import Cart, CartItem, Category, Product, ProductImage, ProductAttribute, Review, ReviewImage
+from .tasks import generate_image_variants
+from .utils import cart_service
+from .utils.counter_service import change_carts_count, change_rating
+from .utils.image_service import refresh_feature_image
+from .utils.import_service import is_importing
+from .utils.search_service import index_product, remove_product
+from .utils.tag_service import invalidate_tags, invalidate_tag_names
+from .utils.category_service import bump_category_tree_version
+from .utils.cache_service import touch_product, invalidate_product_detail
 
 User = get_user_model()
 
@@ -10,3 +21,127 @@ User = get_user_model()
 def create_cart(sender, instance, created, **kwargs):
     if created:
         Cart.objects.create(user=instance)
+
+
+@receiver(post_save, sender=CartItem)
+def cart_item_saved(sender, instance, created, **kwargs):
+    loaded_product_id = getattr(
+        instance, '_loaded_product_id', instance.product_id)
+    if created:
+        change_carts_count(instance.product_id, 1)
+
+    elif instance.product_id != loaded_product_id:
+        change_carts_count(loaded_product_id, -1)
+        change_carts_count(instance.product_id, 1)
+        cart_service.item_written(instance.cart_id, loaded_product_id)
+
+    cart_service.item_written(instance.cart_id, instance.product_id, instance.quantity)
+    instance._loaded_product_id = instance.product_id
+
+
+@receiver(post_delete, sender=CartItem)
+def cart_item_deleted(sender, instance, **kwargs):
+    change_carts_count(instance.product_id, -1)
+    cart_service.item_written(instance.cart_id, instance.product_id)
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def product_image_changed(sender, instance, **kwargs):
+    refresh_feature_image(instance.product_id)
+    invalidate_product_detail([instance.product_id])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=ReviewImage)
+def image_saved(sender, instance, **kwargs):
+    if instance.image and instance.variants.get('source') != instance.image.name:
+        transaction.on_commit(lambda: generate_image_variants.delay(sender.__name__, [instance.pk]))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    index_product(instance)
+    invalidate_product_detail([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    remove_product(instance.pk)
+    invalidate_product_detail([instance.pk])
+
+
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+def product_attribute_changed(sender, instance, **kwargs):
+    if is_importing():
+        return
+    index_product(instance.product)
+    touch_product(instance.product_id)
+    invalidate_product_detail([instance.product_id])
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, **kwargs):
+    loaded = getattr(instance, '_loaded_rating', None)
+    current = (instance.product_id, instance.rating)
+    if created:
+        change_rating(*current, 1)
+
+    elif loaded and loaded != current:
+        change_rating(*loaded, -1)
+        change_rating(*current, 1)
+
+    instance._loaded_rating = current
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    change_rating(instance.product_id, instance.rating, -1)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def review_changed(sender, instance, **kwargs):
+    touch_product(instance.product_id)
+    invalidate_product_detail([instance.product_id])
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if not isinstance(instance, Product):
+        return
+
+    if action == 'pre_clear':
+        # the cleared tags are not known after the clear
+        instance._cleared_tag_names = list(
+            instance.tags.values_list('name', flat=True))
+
+    elif action in ('post_add', 'post_remove') and pk_set:
+        invalidate_tags(pk_set)
+
+    elif action == 'post_clear':
+        invalidate_tag_names(getattr(instance, '_cleared_tag_names', []))
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        index_product(instance)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    invalidate_tag_names([instance.name])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    bump_category_tree_version()
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def category_products_changed(sender, instance, **kwargs):
+    # before the delete, products still point to the category
+    invalidate_product_detail(
+        Product.objects.filter(category=instance).values_list('id', flat=True))
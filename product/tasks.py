@@ -0,0 +1,66 @@
+from celery import shared_task
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from .models import ProductImage, ReviewImage
+from .utils.cache_service import invalidate_product_detail
+from .utils.cart_service import flush_cart as flush_cached_cart
+from .utils.stock_service import release_expired_reservations as release_expired
+from .utils.image_service import build_variants, refresh_feature_images
+from .utils.import_service import import_products
+from .utils.feed_service import FEED_INTERVAL, FEED_LOCK_KEY, generate_catalog_feed as generate_feed
+
+
+@shared_task(bind=True)
+def import_products_file(self, path, format):
+    def progress(report):
+        self.update_state(state='PROGRESS', meta=report)
+
+    try:
+        with default_storage.open(path, 'rb') as file:
+            return import_products(file, format, progress=progress)
+    finally:
+        default_storage.delete(path)
+
+
+@shared_task
+def generate_catalog_feed(full=False):
+    # a run still writing the feed makes this one redundant
+    if not cache.add(FEED_LOCK_KEY, True, FEED_INTERVAL):
+        return None
+    try:
+        state = generate_feed(full=full)
+    finally:
+        cache.delete(FEED_LOCK_KEY)
+    return state['paths']
+
+
+IMAGE_MODELS = {'ProductImage': ProductImage, 'ReviewImage': ReviewImage}
+
+
+@shared_task
+def generate_image_variants(model_name, pks):
+    model = IMAGE_MODELS[model_name]
+    images = model.objects.filter(pk__in=pks)
+    for instance in images:
+        try:
+            variants = build_variants(instance.image)
+        except OSError:
+            # missing or not an image, keeps being served as uploaded
+            variants = {'source': instance.image.name}
+        # an image replaced in between has a task of its own
+        model.objects.filter(pk=instance.pk, image=instance.image.name).update(variants=variants)
+
+    if model is ProductImage:
+        product_ids = list({instance.product_id for instance in images})
+        refresh_feature_images(product_ids)
+        invalidate_product_detail(product_ids)
+
+
+@shared_task
+def flush_cart(user_id):
+    flush_cached_cart(user_id)
+
+
+@shared_task
+def release_expired_reservations():
+    return release_expired()
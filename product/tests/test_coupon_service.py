@@ -3,8 +3,10 @@ from django.utils import timezone
 from datetime import timedelta
 from decimal import Decimal
 from django.contrib.auth import get_user_model
-from product.models import Category, Product, Coupon, CategoryCoupon, ProductCoupon, Cart, CartItem
-from product.utils.coupon_service import verify_coupon
+from django.test import override_settings
+from django.core.cache import cache
+from product.models import Category, Product, Coupon, CategoryCoupon, ProductCoupon, UserCoupon, Cart, CartItem
+from product.utils.coupon_service import check_coupon, verify_coupon
 
 
 User = get_user_model()
@@ -84,6 +86,29 @@ class CouponServiceTests(TestCase):
         status, result = verify_coupon(self.user, coupon2.code)
         self.assertEqual(status, 200)
 
+    def test_verify_coupon_category_applies_to_subcategories(self):
+        parent = Category.objects.create(name="Shop", slug="shop")
+        other = Category.objects.create(name="Books", slug="books")
+        cat = Category.objects.get(pk=self.cat.pk)
+        cat.parent = parent
+        cat.save()
+
+        coupon = Coupon.objects.create(
+            code="TREE10", discount_value=10, start_date=timezone.now(), max_usage=5, is_active=True)
+        CategoryCoupon.objects.create(category=parent, coupon=coupon)
+        status, result = verify_coupon(self.user, coupon.code)
+        self.assertEqual(status, 200)
+
+        coupon2 = Coupon.objects.create(
+            code="BOOK10", discount_value=10, start_date=timezone.now(), max_usage=5, is_active=True)
+        CategoryCoupon.objects.create(category=other, coupon=coupon2)
+        status, result = verify_coupon(self.user, coupon2.code)
+        self.assertEqual(status, 400)
+        # a category without a path yet is not the parent of every category
+        Category.objects.filter(pk=other.pk).update(path="")
+        status, result = verify_coupon(self.user, coupon2.code)
+        self.assertEqual(status, 400)
+
     def test_verify_coupon_calculates_final_amount_percent(self):
         coupon = Coupon.objects.create(
             code="OFF20", discount_value=20, start_date=timezone.now(), max_usage=5, is_active=True)
@@ -99,3 +124,46 @@ class CouponServiceTests(TestCase):
         self.assertEqual(status, 200)
         self.assertEqual(result["coupon_value"], Decimal("100"))
         self.assertEqual(result["final_amount"], Decimal("900"))
+
+    def test_check_coupon_runs_two_queries(self):
+        other = User.objects.create_user(email="other@example.com", password="Testpass123!")
+        coupon = Coupon.objects.create(
+            code="ALL10", discount_value=15, start_date=timezone.now(), max_usage=5, is_active=True)
+        ProductCoupon.objects.create(product=self.product, coupon=coupon)
+        CategoryCoupon.objects.create(category=self.cat, coupon=coupon)
+        UserCoupon.objects.create(user=self.user, coupon=coupon)
+
+        with self.assertNumQueries(2):
+            result = check_coupon(self.user, coupon.code)
+        self.assertTrue(result["valid"])
+        self.assertEqual((result["cart_amount"], result["discount_amount"], result["final_amount"]),
+                         (1000, 150, 850))
+        self.assertEqual(result["items"][0]["product_id"], self.product.id)
+
+        with self.assertNumQueries(2):
+            result = check_coupon(other, coupon.code)
+        self.assertEqual(result["error"], "empty_cart")
+        CartItem.objects.create(cart=other.cart, product=self.product, quantity=1)
+        self.assertEqual(check_coupon(other, coupon.code)["error"], "user")
+
+    def test_fixed_discount_is_capped_at_the_cart_amount(self):
+        coupon = Coupon.objects.create(
+            code="FIX5000", discount_value=5000, discount_type='fixed', start_date=timezone.now(), is_active=True)
+        result = check_coupon(self.user, coupon.code)
+        self.assertEqual((result["discount_amount"], result["final_amount"]), (1000, 0))
+
+    @override_settings(CART_STORAGE="cache")
+    def test_check_coupon_reads_the_cached_cart(self):
+        cache.clear()
+        other = Product.objects.create(name="Book", slug="book", price=50, stock=5)
+        coupon = Coupon.objects.create(
+            code="PHONE", discount_value=10, start_date=timezone.now(), is_active=True)
+        ProductCoupon.objects.create(product=self.product, coupon=coupon)
+        self.assertTrue(check_coupon(self.user, coupon.code)["valid"])
+
+        items = cache.get(f"cart_{self.user.id}")
+        items[other.id] = 1
+        cache.set(f"cart_{self.user.id}", items)
+        with self.assertNumQueries(2):
+            result = check_coupon(self.user, coupon.code)
+        self.assertEqual((result["error"], result["cart_amount"]), ("products", 1050))
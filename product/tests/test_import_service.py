@@ -0,0 +1,94 @@
+from io import BytesIO
+import json
+from unittest.mock import patch
+from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from product.models import Category, Product, ProductAttribute
+from product.tasks import import_products_file
+from product.utils.import_service import import_products
+from product.utils.search_service import search_products
+from product.utils.tag_service import filter_by_tags
+
+
+class ImportServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cat = Category.objects.create(name="Phones", slug="phones")
+        cls.existing = Product.objects.create(
+            name="Old Phone", slug="old-phone", sku="SKU-OLD", category=cls.cat, price=10, stock=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_csv_import_creates_and_updates_products(self):
+        file = BytesIO(
+            b"name,slug,sku,category,price,stock,tags,images,attributes\n"
+            b"Galaxy,galaxy,,phones,1000,3,android|samsung,products/images/g.jpg,Color:Black|Ram:8GB\n"
+            b"Old Phone v2,old-phone,,phones,20,0,,,\n"
+        )
+        reports = []
+        report = import_products(file, 'csv', chunk_size=1, progress=lambda r: reports.append(dict(r)))
+
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['updated'], 1)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual([r['rows'] for r in reports], [1, 2])
+
+        galaxy = Product.objects.get(slug="galaxy")
+        self.assertTrue(galaxy.sku.startswith(f"PRD-{galaxy.created_at.year}-"))
+        self.assertEqual(galaxy.category, self.cat)
+        self.assertEqual(galaxy.feature_image.name, "products/images/g.jpg")
+        self.assertEqual(dict(galaxy.attributes.values_list('key', 'value')),
+                         {"Color": "Black", "Ram": "8GB"})
+        self.assertEqual(sorted(galaxy.tags.names()), ["android", "samsung"])
+        self.assertEqual(list(filter_by_tags(Product.objects.all(), ["samsung"])), [galaxy])
+        self.assertEqual(list(search_products(Product.objects.all(), "galaxy")), [galaxy])
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.name, "Old Phone v2")
+        self.assertEqual(self.existing.sku, "SKU-OLD")
+        self.assertEqual(self.existing.stock, 0)
+
+    def test_partial_row_keeps_the_other_fields(self):
+        Product.objects.filter(pk=self.existing.pk).update(description="Dual sim", is_available=False)
+        file = BytesIO(b'{"slug": "old-phone", "price": 15}\n{"slug": "new-phone", "price": 5}\n')
+        report = import_products(file, 'jsonl')
+
+        self.assertEqual(report['updated'], 1)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['errors'][0]['errors'], {'name': ['This field is required.']})
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.price, 15)
+        self.assertEqual(self.existing.name, "Old Phone")
+        self.assertEqual(self.existing.sku, "SKU-OLD")
+        self.assertEqual(self.existing.category, self.cat)
+        self.assertEqual(self.existing.description, "Dual sim")
+        self.assertEqual(self.existing.stock, 1)
+        self.assertFalse(self.existing.is_available)
+
+    def test_jsonl_import_reports_invalid_rows(self):
+        rows = [
+            {"name": "Pixel", "slug": "pixel", "price": 900, "category": "phones",
+             "attributes": {"Color": "White"}},
+            {"name": "No Price", "slug": "no-price"},
+            {"name": "Taken", "slug": "taken", "sku": "SKU-OLD", "price": 1},
+            {"name": "Nowhere", "slug": "nowhere", "price": 1, "category": "missing"},
+        ]
+        file = BytesIO(("\n".join(json.dumps(row) for row in rows) + "\nnot json\n").encode())
+        report = import_products(file, 'jsonl')
+
+        self.assertEqual(report['rows'], 5)
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['failed'], 4)
+        self.assertEqual(sorted(error['line'] for error in report['errors']), [2, 3, 4, 5])
+        self.assertEqual(ProductAttribute.objects.get(product__slug="pixel").value, "White")
+        self.assertFalse(Product.objects.filter(slug__in=["no-price", "taken", "nowhere"]).exists())
+
+    @patch("product.tasks.import_products", side_effect=ValueError)
+    def test_failed_import_task_deletes_the_upload(self, mock_import):
+        path = default_storage.save("imports/failed.csv", ContentFile(b"name\n"))
+        with self.assertRaises(ValueError):
+            import_products_file.apply(args=(path, "csv"), throw=True)
+        self.assertFalse(default_storage.exists(path))
@@ -1,7 +1,13 @@
+from io import StringIO
 from django.test import TestCase
+from django.core.management import call_command
 from django.contrib.auth import get_user_model
 from django.db.utils import IntegrityError
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from product.apps import fill_category_paths
 from product.models import (
     Category,
     Product,
@@ -37,6 +43,33 @@ class CategoryModelTests(TestCase):
             name="Child", slug="child", parent=self.cat)
         self.assertEqual(child.parent, self.cat)
 
+    def test_category_path_follows_reparent(self):
+        child = Category.objects.create(
+            name="Child", slug="child", parent=self.cat)
+        leaf = Category.objects.create(
+            name="Leaf", slug="leaf", parent=child)
+        self.assertEqual(leaf.path, f"{self.cat.pk}/{child.pk}/{leaf.pk}/")
+
+        child.parent = None
+        child.save()
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, f"{child.pk}/{leaf.pk}/")
+
+    def test_post_migrate_fills_missing_paths(self):
+        child = Category.objects.create(
+            name="Child", slug="child", parent=self.cat)
+        Category.objects.update(path="")
+        fill_category_paths(sender=None)
+        child.refresh_from_db()
+        self.assertEqual(child.path, f"{self.cat.pk}/{child.pk}/")
+
+    def test_category_can_not_move_under_itself(self):
+        child = Category.objects.create(
+            name="Child", slug="child", parent=self.cat)
+        self.cat.parent = child
+        with self.assertRaises(ValidationError):
+            self.cat.save()
+
 
 class ProductModelTests(TestCase):
     @classmethod
@@ -58,6 +91,27 @@ class ProductModelTests(TestCase):
         self.assertEqual(p.stock, 0)
         self.assertTrue(p.is_available)
 
+    def test_sku_is_assigned_before_the_insert(self):
+        with CaptureQueriesContext(connection) as ctx:
+            p = Product.objects.create(
+                name="Tablet", slug="tablet", category=self.cat, price=500)
+        writes = [q['sql'] for q in ctx.captured_queries
+                  if 'product_product' in q['sql'].split(' WHERE')[0]
+                  and q['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(p.sku.startswith(f"PRD-{timezone.now().year}-"))
+        self.assertEqual(Product.objects.get(pk=p.pk).sku, p.sku)
+
+    def test_bulk_create_assigns_unique_skus(self):
+        products = Product.objects.bulk_create([
+            Product(name=f"Item {i}", slug=f"item-{i}", category=self.cat, price=10)
+            for i in range(60)
+        ] + [Product(name="Manual", slug="manual", sku="MANUAL-1", price=10)])
+        skus = [p.sku for p in products]
+        self.assertEqual(len(set(skus)), 61)
+        self.assertEqual(skus[-1], "MANUAL-1")
+        self.assertEqual(set(Product.objects.values_list('sku', flat=True)), set(skus))
+
 
 class ProductImageModelTests(TestCase):
     def test_unique_featured_per_product_constraint(self):
@@ -184,6 +238,14 @@ class OrderModelTests(TestCase):
         self.assertEqual(order.total_amount, 200)
         self.assertEqual(order.final_amount, 200)
 
+    def test_tracking_code_serial_follows_last_order_of_the_day(self):
+        first = Order.objects.create(
+            user=self.user, total_amount=200, final_amount=200)
+        second = Order.objects.create(
+            user=self.user, total_amount=200, final_amount=200)
+        self.assertEqual(int(first.tracking_code.split('-')[-1]) + 1,
+                         int(second.tracking_code.split('-')[-1]))
+
 
 class OrderItemModelTests(TestCase):
     def test_order_item_price_snapshot(self):
@@ -209,3 +271,14 @@ class PaymentModelTests(TestCase):
             order=order, amount=100, status="pending")
         self.assertEqual(payment.order, order)
         self.assertIn(payment.status, ["pending", "paid", "failed"])
+
+
+class HotQueryIndexTests(TestCase):
+    def test_hot_queries_do_not_scan_whole_tables(self):
+        category = Category.objects.create(name="Phones", slug="phones")
+        Product.objects.create(name="Phone", slug="phone", category=category, price=1)
+        out = StringIO()
+        call_command('explain_hot_queries', stdout=out)
+        self.assertIn('product-list?category: ok', out.getvalue())
+        self.assertIn('product-review-list: ok', out.getvalue())
+        self.assertNotIn('full scan', out.getvalue())
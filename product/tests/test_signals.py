@@ -1,8 +1,24 @@
-from django.test import TestCase
+from io import BytesIO, StringIO
+from unittest.mock import patch
+from PIL import Image
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.db import connection
 from django.contrib.auth import get_user_model
-from product.models import Cart
+from product.apps import create_search_index
+from product.models import Cart, CartItem, Product, ProductImage, Review
+from product.serializers import ProductImageSerializer, ProductSerializer
+from product.tasks import generate_image_variants
+from product.utils.search_service import SEARCH_TABLE, search_products
 
 User = get_user_model()
+IN_MEMORY_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
 
 
 class SignalsTests(TestCase):
@@ -13,3 +29,247 @@ class SignalsTests(TestCase):
         self.assertTrue(cart_exists)
         cart = Cart.objects.get(user=user)
         self.assertEqual(cart.user, user)
+
+
+class CartsCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="counter@example.com", password="Testpass123!")
+        cls.other = User.objects.create_user(
+            email="counter2@example.com", password="Testpass123!")
+        cls.phone = Product.objects.create(
+            name="Phone", slug="phone", price=1000, stock=5)
+        cls.laptop = Product.objects.create(
+            name="Laptop", slug="laptop", price=2000, stock=5)
+
+    def test_carts_count_follows_cart_item_create_and_delete(self):
+        item = CartItem.objects.create(
+            cart=self.user.cart, product=self.phone, quantity=1)
+        CartItem.objects.create(
+            cart=self.other.cart, product=self.phone, quantity=1)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.carts_count, 2)
+
+        item.delete()
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.carts_count, 1)
+
+    def test_carts_count_moves_when_item_product_changes(self):
+        item = CartItem.objects.create(
+            cart=self.user.cart, product=self.phone, quantity=1)
+        item = CartItem.objects.get(pk=item.pk)
+        item.product = self.laptop
+        item.save()
+        self.phone.refresh_from_db()
+        self.laptop.refresh_from_db()
+        self.assertEqual(self.phone.carts_count, 0)
+        self.assertEqual(self.laptop.carts_count, 1)
+
+    def test_bulk_delete_updates_carts_count_once(self):
+        CartItem.objects.create(
+            cart=self.user.cart, product=self.phone, quantity=1)
+        CartItem.objects.create(
+            cart=self.user.cart, product=self.laptop, quantity=1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.user.cart.items.all().delete()
+        updates = [q for q in ctx.captured_queries
+                   if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+        self.phone.refresh_from_db()
+        self.laptop.refresh_from_db()
+        self.assertEqual(self.phone.carts_count, 0)
+        self.assertEqual(self.laptop.carts_count, 0)
+
+    def test_rebuild_carts_count_command_fixes_drift(self):
+        CartItem.objects.create(
+            cart=self.user.cart, product=self.phone, quantity=1)
+        Product.objects.filter(pk=self.phone.pk).update(carts_count=7)
+        Product.objects.filter(pk=self.laptop.pk).update(carts_count=3)
+
+        out = StringIO()
+        call_command('rebuild_carts_count', batch_size=1, stdout=out)
+        self.assertIn('2 products', out.getvalue())
+        self.phone.refresh_from_db()
+        self.laptop.refresh_from_db()
+        self.assertEqual(self.phone.carts_count, 1)
+        self.assertEqual(self.laptop.carts_count, 0)
+
+
+class FeatureImageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(
+            name="Phone", slug="phone", price=1000, stock=5)
+
+    def test_feature_image_follows_product_images(self):
+        first = ProductImage.objects.create(
+            product=self.product, image="products/images/a.jpg")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.feature_image.name,
+                         "products/images/a.jpg")
+
+        featured = ProductImage.objects.create(
+            product=self.product, image="products/images/b.jpg", is_feature=True)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.feature_image.name,
+                         "products/images/b.jpg")
+
+        featured.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.feature_image.name,
+                         "products/images/a.jpg")
+
+        first.delete()
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.feature_image)
+
+    def test_rebuild_feature_images_command_fixes_drift(self):
+        ProductImage.objects.create(product=self.product, image="products/images/a.jpg")
+        Product.objects.filter(pk=self.product.pk).update(feature_image="")
+        updated_at = Product.objects.get(pk=self.product.pk).updated_at
+
+        out = StringIO()
+        with patch("product.utils.cache_service.invalidate_product_detail") as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_feature_images', stdout=out)
+        self.assertIn('1 products', out.getvalue())
+        invalidate.assert_called_once_with([self.product.pk])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.feature_image.name, "products/images/a.jpg")
+        self.assertGreater(self.product.updated_at, updated_at)
+
+    def test_post_migrate_backfills_a_new_search_index(self):
+        # an fts table can't be dropped inside the test transaction, a new one is empty as well
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        self.assertEqual(list(search_products(Product.objects.all(), "phone")), [])
+        with patch.object(connection.introspection, "table_names", side_effect=[[], [SEARCH_TABLE]]):
+            create_search_index(sender=None)
+        self.assertEqual(list(search_products(Product.objects.all(), "phone")), [self.product])
+
+        # an existing table is left as it is
+        with patch("product.utils.search_service.rebuild_search_index") as rebuild:
+            create_search_index(sender=None)
+        rebuild.assert_not_called()
+
+
+class ImageVariantsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(
+            name="Phone", slug="phone", price=1000, stock=5)
+
+    def upload(self, width, height):
+        buffer = BytesIO()
+        Image.new("RGBA", (width, height), (200, 30, 30, 128)).save(buffer, "PNG")
+        return SimpleUploadedFile("photo.png", buffer.getvalue(), content_type="image/png")
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    @patch("product.signals.generate_image_variants.delay")
+    def test_upload_queues_variants_after_commit(self, mock_delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image=self.upload(400, 200))
+        mock_delay.assert_called_once_with("ProductImage", [image.pk])
+
+        generate_image_variants("ProductImage", [image.pk])
+        image.refresh_from_db()
+        self.assertEqual(image.variants["source"], image.image.name)
+        # never scaled up past the original width
+        self.assertEqual(list(image.variants["webp"]), ["320"])
+        self.assertEqual(list(image.variants["jpeg"]), ["320"])
+        with default_storage.open(image.variants["jpeg"]["320"]) as file:
+            self.assertEqual(Image.open(file).size, (320, 160))
+
+        # the task saves with update(), so it queues nothing again
+        with self.captureOnCommitCallbacks(execute=True):
+            image.save()
+        mock_delay.assert_called_once()
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.feature_image_variants, image.variants)
+        webp = default_storage.url(image.variants["webp"]["320"])
+        self.assertEqual(ProductSerializer(self.product, context={"request": None}).data["srcset"]["webp"], f"{webp} 320w")
+        self.assertEqual(ProductImageSerializer(image).data["srcset"]["webp"], f"{webp} 320w")
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    @patch("product.signals.generate_image_variants.delay")
+    def test_variants_are_named_by_content(self, mock_delay):
+        first = ProductImage.objects.create(product=self.product, image=self.upload(1500, 1000))
+        second = ProductImage.objects.create(product=self.product, image=self.upload(1500, 1000))
+        generate_image_variants("ProductImage", [first.pk, second.pk])
+        first.refresh_from_db()
+        second.refresh_from_db()
+
+        self.assertEqual(list(first.variants["webp"]), ["320", "640", "1280"])
+        self.assertNotEqual(first.image.name, second.image.name)
+        self.assertEqual(first.variants["webp"], second.variants["webp"])
+        self.assertEqual(first.variants["jpeg"], second.variants["jpeg"])
+
+    def test_unreadable_image_is_marked_done(self):
+        image = ProductImage.objects.create(product=self.product, image="products/images/missing.jpg")
+        generate_image_variants("ProductImage", [image.pk])
+        image.refresh_from_db()
+        self.assertEqual(image.variants, {"source": "products/images/missing.jpg"})
+        self.assertEqual(ProductImageSerializer(image).data["srcset"], {})
+
+
+class RatingAggregatesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="rating@example.com", password="Testpass123!")
+        cls.other = User.objects.create_user(
+            email="rating2@example.com", password="Testpass123!")
+        cls.product = Product.objects.create(
+            name="Phone", slug="phone", price=1000, stock=5)
+
+    def test_rating_aggregates_follow_reviews(self):
+        review = Review.objects.create(
+            product=self.product, user=self.user, rating=5, title="t", comment="c")
+        Review.objects.create(
+            product=self.product, user=self.other, rating=2, title="t", comment="c")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 2)
+        self.assertEqual(self.product.rating_sum, 7)
+        self.assertEqual(self.product.rating_avg, 3.5)
+        self.assertEqual(self.product.rating_5_count, 1)
+        self.assertEqual(self.product.rating_2_count, 1)
+
+        review = Review.objects.get(pk=review.pk)
+        review.rating = 4
+        review.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_avg, 3)
+        self.assertEqual(self.product.rating_5_count, 0)
+        self.assertEqual(self.product.rating_4_count, 1)
+
+        Review.objects.all().delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 0)
+        self.assertEqual(self.product.rating_sum, 0)
+        self.assertEqual(self.product.rating_avg, 0)
+        self.assertEqual(self.product.rating_4_count, 0)
+
+    def test_rebuild_ratings_command_fixes_drift(self):
+        Review.objects.create(
+            product=self.product, user=self.user, rating=3, title="t", comment="c")
+        Product.objects.filter(pk=self.product.pk).update(
+            rating_count=9, rating_avg=1, rating_1_count=9)
+        updated_at = Product.objects.get(pk=self.product.pk).updated_at
+
+        out = StringIO()
+        with patch("product.utils.cache_service.invalidate_product_detail") as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_ratings', stdout=out)
+        self.assertIn('1 products', out.getvalue())
+        # the validators and the cached detail follow the fix
+        invalidate.assert_called_once_with([self.product.pk])
+        self.product.refresh_from_db()
+        self.assertGreater(self.product.updated_at, updated_at)
+        self.assertEqual(self.product.rating_count, 1)
+        self.assertEqual(self.product.rating_avg, 3)
+        self.assertEqual(self.product.rating_1_count, 0)
+        self.assertEqual(self.product.rating_3_count, 1)
@@ -0,0 +1,67 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import TestCase
+from django.utils import timezone
+from product.models import Order, Payment, Product, StockReservation
+from product.utils.stock_service import (
+    OutOfStock, commit_reservations, release_expired_reservations, release_reservations, reserve_stock
+)
+
+User = get_user_model()
+
+
+class StockServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="stock@example.com", password="Testpass123!")
+        cls.phone = Product.objects.create(name="Phone", slug="phone", price=100, stock=5)
+        cls.case = Product.objects.create(name="Case", slug="case", price=10, stock=1)
+
+    def create_order(self):
+        order = Order.objects.create(user=self.user, total_amount=100, final_amount=100)
+        Payment.objects.create(order=order, amount=100, method='card', transaction_id="AUTH")
+        return order
+
+    def stocks(self):
+        return dict(Product.objects.values_list("slug", "stock"))
+
+    def test_reserve_release_and_commit(self):
+        order = self.create_order()
+        reserve_stock(order, {self.phone.id: 2, self.case.id: 1})
+        self.assertEqual(self.stocks(), {"phone": 3, "case": 0})
+        self.assertEqual(order.reservations.count(), 2)
+
+        self.assertEqual(release_reservations(order.id), 2)
+        self.assertEqual(self.stocks(), {"phone": 5, "case": 1})
+        self.assertEqual(release_reservations(order.id), 0)
+
+        reserve_stock(order, {self.phone.id: 2})
+        self.assertEqual(commit_reservations(order.id), 1)
+        self.assertEqual(release_reservations(order.id), 0)
+        self.assertEqual(self.stocks(), {"phone": 3, "case": 1})
+
+    def test_short_stock_takes_nothing(self):
+        order = self.create_order()
+        with self.assertRaises(OutOfStock) as raised, transaction.atomic():
+            reserve_stock(order, {self.phone.id: 2, self.case.id: 2})
+        self.assertEqual(raised.exception.product_ids, [self.case.id])
+        self.assertEqual(self.stocks(), {"phone": 5, "case": 1})
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_sweeper_cancels_expired_orders(self):
+        expired = self.create_order()
+        reserve_stock(expired, {self.phone.id: 2})
+        StockReservation.objects.filter(order=expired).update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+        fresh = self.create_order()
+        reserve_stock(fresh, {self.case.id: 1})
+
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(self.stocks(), {"phone": 5, "case": 0})
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, "canceled")
+        self.assertEqual(expired.payment.status, "failed")
+        self.assertEqual(Order.objects.get(pk=fresh.pk).status, "pending")
+        self.assertEqual(release_expired_reservations(), 0)
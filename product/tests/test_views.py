@@ -2,11 +2,28 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
 from unittest.mock import patch
+from django.conf import settings
+from django.test import override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
 from django.db import reset_queries, connection
 from django.utils import timezone
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from taggit.models import Tag, TaggedItem
+from product.utils import cart_service
+from product.utils.tag_service import get_tag_product_ids, invalidate_tag_names
+from product.utils.cache_service import invalidate_product_detail, product_detail_stats
+from product.tasks import generate_catalog_feed as generate_catalog_feed_task
+from product.utils.feed_service import FEED_LOCK_KEY, generate_catalog_feed, get_feed_state
+from product.views import ProductDetail
+from django.test.utils import CaptureQueriesContext
+import json
 from product.models import (
     Category,
     Product,
+    ProductImage,
+    ProductAttribute,
     Coupon,
     Review,
     Cart,
@@ -17,6 +34,10 @@ from product.models import (
 
 User = get_user_model()
 connection.force_debug_cursor = True
+IN_MEMORY_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
 
 
 class CategoryViewTests(APITestCase):
@@ -49,6 +70,37 @@ class CategoryViewTests(APITestCase):
         self.assertEqual(res2.status_code, 200)
         self.assertEqual(res3.status_code, 200)
 
+    def test_category_tree_is_nested_and_cached(self):
+        cache.clear()
+        child = Category.objects.create(
+            name="Child", slug="child", parent=self.cat)
+        url = reverse("category-tree")
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        root = next(c for c in res.data if c['slug'] == self.cat.slug)
+        self.assertEqual(root['children'][0]['slug'], "child")
+
+        reset_queries()
+        self.client.get(url)
+        self.assertEqual(len(connection.queries), 0)
+
+        child.name = "Renamed"
+        child.save()
+        res = self.client.get(url)
+        root = next(c for c in res.data if c['slug'] == self.cat.slug)
+        self.assertEqual(root['children'][0]['name'], "Renamed")
+
+    def test_category_list_conditional_get(self):
+        etag = self.client.get(self.url)['ETag']
+        reset_queries()
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(len(connection.queries), 0)
+
+        Category.objects.create(name="New", slug="new")
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
     def test_admin_category_management_crud(self):
         url = reverse("admin-category-list")
         self.client.force_authenticate(self.admin)
@@ -81,18 +133,462 @@ class ProductViewTests(APITestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(res.data['results']), 1)
 
+    def test_product_list_ordering_by_rating(self):
+        user = User.objects.create_user(
+            email="rater@example.com", password="Testpass123!")
+        Review.objects.create(user=user, product=self.product2,
+                              rating=5, title="t", comment="c")
+        Review.objects.create(user=user, product=self.product1,
+                              rating=2, title="t", comment="c")
+        res = self.client.get(self.url, {"ordering": "-rating_avg"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([p['slug'] for p in res.data['results']],
+                         ["macbook", "iphone"])
+        self.assertEqual(res.data['results'][0]['rating_avg'], 5)
+        self.assertEqual(res.data['results'][0]['rating_count'], 1)
+
+        res = self.client.get(reverse("product-detail", args=["macbook"]))
+        self.assertEqual(res.data['rating_histogram'],
+                         {"1": 0, "2": 0, "3": 0, "4": 0, "5": 1})
+
+    def test_product_list_full_text_search(self):
+        ProductAttribute.objects.create(
+            product=self.product2, key="Color", value="Silver")
+        self.product1.tags.add("smartphone")
+
+        res = self.client.get(self.url, {"search": "silver"})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["macbook"])
+        res = self.client.get(self.url, {"search": "smart"})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["iphone"])
+        res = self.client.get(self.url, {"search": self.product2.sku})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["macbook"])
+
+    def test_product_list_search_ranks_name_first(self):
+        Product.objects.create(
+            name="Case", slug="case", description="fits the iphone", price=10)
+        res = self.client.get(self.url, {"search": "iphone"})
+        self.assertEqual([p['slug'] for p in res.data['results']],
+                         ["iphone", "case"])
+        # not sorted by name in cursor mode either
+        res = self.client.get(self.url, {"search": "iphone", "pagination": "cursor"})
+        self.assertEqual([p['slug'] for p in res.data['results']],
+                         ["iphone", "case"])
+        res = self.client.get(self.url, {"name": "iph"})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["iphone"])
+
+    def test_product_list_tags_any_and_all(self):
+        cache.clear()
+        self.product1.tags.add("apple", "phone")
+        self.product2.tags.add("apple")
+
+        res = self.client.get(self.url, {"tags": "phone,apple"})
+        self.assertEqual(len(res.data['results']), 2)
+        res = self.client.get(self.url, {"tags_all": "phone,apple"})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["iphone"])
+        res = self.client.get(self.url, {"tags": "missing"})
+        self.assertEqual(res.data['results'], [])
+
+        # the cached tag sets follow tag changes
+        self.product2.tags.add("phone")
+        res = self.client.get(self.url, {"tags_all": "phone,apple"})
+        self.assertEqual(len(res.data['results']), 2)
+        self.product1.tags.clear()
+        res = self.client.get(self.url, {"tags": "phone"})
+        self.assertEqual([p['slug'] for p in res.data['results']], ["macbook"])
+
+    def test_tag_index_rebuilt_during_an_invalidation_is_not_kept(self):
+        cache.clear()
+        self.product1.tags.add("phone")
+        content_type = ContentType.objects.get_for_model(Product)
+
+        def invalidated_meanwhile(model):
+            invalidate_tag_names(["phone"])
+            return content_type
+
+        with patch.object(ContentType.objects, "get_for_model", side_effect=invalidated_meanwhile):
+            self.assertEqual(get_tag_product_ids(["phone"]), {"phone": {self.product1.id}})
+        # tagged without a signal, only a rebuild sees it
+        TaggedItem.objects.create(tag=Tag.objects.get(name="phone"), content_object=self.product2)
+        self.assertEqual(get_tag_product_ids(["phone"]),
+                         {"phone": {self.product1.id, self.product2.id}})
+
+    def test_product_list_category_includes_subcategories(self):
+        android = Category.objects.create(
+            name="Android", slug="android", parent=self.cat1)
+        Product.objects.create(
+            name="Pixel", slug="pixel", category=android, price=900, stock=5)
+        # neither a category whose name contains it, nor one without a path yet
+        headphones = Category.objects.create(name="Headphones", slug="headphones")
+        Category.objects.filter(pk=headphones.pk).update(path="")
+        Product.objects.create(
+            name="Buds", slug="buds", category=headphones, price=90, stock=5)
+        res = self.client.get(self.url, {"category": "phones"})
+        self.assertEqual(sorted(p['slug'] for p in res.data['results']),
+                         ["iphone", "pixel"])
+        res = self.client.get(self.url, {"category": "headphones"})
+        self.assertEqual(res.data['results'], [])
+
+    def test_product_list_facets(self):
+        cache.clear()
+        android = Category.objects.create(
+            name="Android", slug="android", parent=self.cat1)
+        Product.objects.create(name="Pixel", slug="pixel", category=android,
+                               price=20_000_000, stock=0)
+        self.product1.tags.add("apple")
+        self.product2.tags.add("apple", "laptop")
+
+        reset_queries()
+        res = self.client.get(self.url, {"facets": "true", "limit": 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data['results']), 1)
+        facets = res.data['facets']
+        self.assertEqual(
+            [(c['slug'], c['count']) for c in facets['categories']],
+            [("phones", 2), ("android", 1), ("laptops", 1)])
+        self.assertEqual(facets['tags'], [
+            {"name": "apple", "count": 2}, {"name": "laptop", "count": 1}])
+        self.assertEqual([b['count'] for b in facets['price']], [2, 0, 1, 0, 0])
+        self.assertEqual(facets['availability'], {"in_stock": 2, "out_of_stock": 1})
+
+        res = self.client.get(self.url, {"facets": "true", "category": "phones"})
+        self.assertEqual(res.data['facets']['availability'],
+                         {"in_stock": 1, "out_of_stock": 1})
+        self.assertEqual([t['name'] for t in res.data['facets']['tags']], ["apple"])
+
+        res = self.client.get(self.url, {"facets": "true", "search": "macbook"})
+        self.assertEqual(res.data['facets']['categories'][0]['count'], 1)
+        self.assertEqual(res.data['facets']['price'][0]['count'], 1)
+
+        res = self.client.get(self.url)
+        self.assertNotIn("facets", res.data)
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    @patch("product.views.import_products_file.delay")
+    def test_admin_product_import_queues_the_file(self, mock_delay):
+        mock_delay.return_value.id = "task-1"
+        admin = User.objects.create_superuser(
+            email="importer@example.com", password="Testpass123!")
+        url = reverse("admin-product-import")
+        upload = SimpleUploadedFile("products.csv", b"name,slug,price\nA,a,1\n")
+
+        res = self.client.post(url, {"file": upload}, format="multipart")
+        self.assertEqual(res.status_code, 401)
+
+        self.client.force_authenticate(admin)
+        upload.seek(0)
+        res = self.client.post(url, {"file": upload}, format="multipart")
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.data, {"task_id": "task-1"})
+        path, format = mock_delay.call_args.args
+        self.assertEqual(format, "csv")
+        self.assertTrue(path.startswith("imports/"))
+
+        res = self.client.post(url, {"file": SimpleUploadedFile("products.xls", b"x")},
+                               format="multipart")
+        self.assertEqual(res.status_code, 400)
+
+    def test_admin_product_batch_update(self):
+        cache.clear()
+        admin = User.objects.create_superuser(
+            email="batch@example.com", password="Testpass123!")
+        self.client.force_authenticate(admin)
+        detail_url = reverse("product-detail", args=[self.product1.slug])
+        self.assertEqual(self.client.get(detail_url)['X-Cache'], "MISS")
+        self.assertEqual(self.client.get(detail_url)['X-Cache'], "HIT")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(reverse("admin-product-batch-update"), {"items": [
+                {"id": self.product1.id, "price": 1500, "stock": 0},
+                {"sku": self.product2.sku, "price": self.product2.price},
+                {"sku": "MISSING", "stock": 1},
+                {"id": self.product2.id},
+            ]}, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in res.data['results']],
+                         ["updated", "unchanged", "not_found", "invalid"])
+        self.assertEqual((res.data['updated'], res.data['failed']), (1, 2))
+
+        self.product1.refresh_from_db()
+        self.assertEqual((self.product1.price, self.product1.stock), (1500, 0))
+        res = self.client.get(detail_url)
+        self.assertEqual(res['X-Cache'], "MISS")
+        self.assertEqual(res.data['price'], 1500)
+
+        self.client.force_authenticate(None)
+        res = self.client.post(reverse("admin-product-batch-update"),
+                               {"items": [{"id": 1, "stock": 1}]}, format="json")
+        self.assertEqual(res.status_code, 401)
+
     def test_product_detail_retrieves_with_prefetch(self):
         url = reverse("product-detail", args=[self.product1.slug])
         res = self.client.get(url)
         self.assertEqual(res.status_code, 200)
         self.assertIn("attributes", res.data)
 
+    def test_product_reviews_endpoint_and_detail_preview(self):
+        for i in range(5):
+            user = User.objects.create_user(
+                email=f"reviewer{i}@example.com", password="Testpass123!")
+            Review.objects.create(user=user, product=self.product1,
+                                  rating=i + 1, title=f"r{i}", comment="c")
+
+        res = self.client.get(reverse("product-detail", args=[self.product1.slug]))
+        self.assertEqual(len(res.data['reviews']), 3)
+        self.assertEqual(res.data['reviews'][0]['title'], "r4")
+        self.assertEqual(res.data['rating_count'], 5)
+        self.assertTrue(res.data['reviews_url'].endswith("/products/iphone/reviews/"))
+
+        url = reverse("product-review-list", args=[self.product1.slug])
+        res = self.client.get(url, {"limit": 2})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("count", res.data)
+        self.assertEqual([r['title'] for r in res.data['results']], ["r4", "r3"])
+        res = self.client.get(res.data['next'])
+        self.assertEqual([r['title'] for r in res.data['results']], ["r2", "r1"])
+
+        res = self.client.get(url, {"rating__gte": 4, "ordering": "rating"})
+        self.assertEqual([r['rating'] for r in res.data['results']], [4, 5])
+
+        res = self.client.get(reverse("product-review-list", args=["missing"]))
+        self.assertEqual(res.status_code, 404)
+
     def test_product_query_number(self):
         reset_queries()
         url = reverse("product-list")
         self.client.get(url, {"category": self.cat1.name})
         self.assertTrue(len(connection.queries) <= 7)
 
+    def test_product_list_query_number_does_not_grow_with_page_size(self):
+        for i in range(5):
+            product = Product.objects.create(
+                name=f"Phone {i}", slug=f"phone-{i}", category=self.cat1, price=1000, stock=5)
+            ProductImage.objects.create(
+                product=product, image=f"products/images/{i}.jpg", is_feature=True)
+
+        reset_queries()
+        res = self.client.get(self.url, {"limit": 1})
+        small_page = len(connection.queries)
+        reset_queries()
+        res = self.client.get(self.url, {"limit": 7})
+        self.assertEqual(len(connection.queries), small_page)
+        self.assertTrue(all(p['image'] for p in res.data['results']
+                            if p['slug'].startswith('phone-')))
+
+    def test_product_list_sparse_fields(self):
+        res = self.client.get(self.url, {"fields": "id,name,price,image"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(res.data['results'][0]),
+                         {"id", "name", "price", "image"})
+
+        reset_queries()
+        self.client.get(self.url, {"fields": "id,name"})
+        product_query = [q['sql'] for q in connection.queries
+                         if 'FROM "product_product"' in q['sql']][-1]
+        self.assertNotIn('"description"', product_query)
+        self.assertNotIn('"stock"', product_query)
+
+    def test_product_detail_sparse_fields_skip_prefetches(self):
+        cache.clear()
+        url = reverse("product-detail", args=[self.product1.slug])
+        reset_queries()
+        res = self.client.get(url, {"fields": "name,price"})
+        self.assertEqual(res.data, {"name": "iPhone", "price": 1000})
+        # the conditional GET validator, read again under the cache version
+        # as the slug is not cached yet, and the product itself
+        self.assertEqual(len(connection.queries), 3)
+
+    def test_product_list_conditional_get(self):
+        res = self.client.get(self.url)
+        etag = res['ETag']
+        self.assertFalse(res.has_header('Last-Modified'))
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        # the page and its count, nothing aggregated over the catalog
+        self.assertFalse(any('MAX(' in query['sql'] for query in queries))
+
+        CartItem.objects.create(
+            cart=User.objects.create_user(
+                email="etag@example.com", password="Testpass123!").cart,
+            product=self.product1)
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
+    def test_product_detail_conditional_get(self):
+        cache.clear()
+        url = reverse("product-detail", args=[self.product1.slug])
+        etag = self.client.get(url)['ETag']
+        reset_queries()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        # the validators are cached with the response
+        self.assertEqual(len(connection.queries), 0)
+
+        ProductAttribute.objects.create(
+            product=self.product1, key="Color", value="Black")
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['attributes'], [
+                         {"key": "Color", "value": "Black"}])
+
+    def test_product_detail_response_cache(self):
+        cache.clear()
+        url = reverse("product-detail", args=[self.product2.slug])
+        res = self.client.get(url)
+        self.assertEqual(res['X-Cache'], "MISS")
+
+        reset_queries()
+        res = self.client.get(url)
+        self.assertEqual(res['X-Cache'], "HIT")
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(product_detail_stats()['hits'], 1)
+
+        user = User.objects.create_user(
+            email="reviewer@example.com", password="Testpass123!")
+        Review.objects.create(product=self.product2, user=user,
+                              rating=5, title="Great", comment="Great laptop")
+        res = self.client.get(url)
+        self.assertEqual(res['X-Cache'], "MISS")
+        self.assertEqual(res.data['reviews'][0]['title'], "Great")
+
+        self.client.get(url)
+        Category.objects.filter(pk=self.cat2.pk).first().save()
+        res = self.client.get(url)
+        self.assertEqual(res['X-Cache'], "MISS")
+
+    def test_product_detail_invalidated_while_rendering_is_not_cached(self):
+        cache.clear()
+        url = reverse("product-detail", args=[self.product2.slug])
+        self.client.get(url)
+        # another variant of a product whose slug is cached
+        url += "?fields=id,name"
+        serializer_data = ProductDetail.serializer_class.data
+
+        def invalidated_data(serializer):
+            # a change committed after the product was read
+            invalidate_product_detail([self.product2.id])
+            return serializer_data.fget(serializer)
+
+        with patch.object(ProductDetail.serializer_class, "data", property(invalidated_data)):
+            self.assertEqual(self.client.get(url)['X-Cache'], "MISS")
+        self.assertEqual(self.client.get(url)['X-Cache'], "MISS")
+
+    def test_product_list_cursor_pagination(self):
+        Product.objects.create(
+            name="Galaxy", slug="galaxy", category=self.cat1, price=1000, stock=5)
+        res = self.client.get(
+            self.url, {"pagination": "cursor", "ordering": "-price", "limit": 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("count", res.data)
+        self.assertIsNone(res.data['previous'])
+
+        slugs = [res.data['results'][0]['slug']]
+        next_url = res.data['next']
+        while next_url:
+            res = self.client.get(next_url)
+            slugs += [p['slug'] for p in res.data['results']]
+            next_url = res.data['next']
+        # equal prices fall back to the id tiebreaker in the same direction
+        self.assertEqual(slugs, ["macbook", "galaxy", "iphone"])
+
+        res = self.client.get(res.data['previous'])
+        self.assertEqual(res.data['results'][0]['slug'], slugs[1])
+
+    def test_product_list_invalid_cursor(self):
+        res = self.client.get(self.url, {"cursor": "not-a-cursor"})
+        self.assertEqual(res.status_code, 404)
+
+
+class CatalogFeedTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.cat = Category.objects.create(name="Phones", slug="phones")
+        self.phone = Product.objects.create(
+            name="iPhone", slug="iphone", category=self.cat, price=1000, stock=5)
+        self.pixel = Product.objects.create(
+            name="Pixel", slug="pixel", category=self.cat, price=900, stock=2)
+        self.hidden = Product.objects.create(
+            name="Hidden", slug="hidden", price=1, is_available=False)
+
+    def read_feed(self, feed_format="jsonl"):
+        res = self.client.get(reverse("catalog-feed", args=[feed_format]))
+        return res, b"".join(res.streaming_content)
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    def test_feed_is_generated_and_updated_incrementally(self):
+        res = self.client.get(reverse("catalog-feed", args=["jsonl"]))
+        self.assertEqual(res.status_code, 404)
+
+        generate_catalog_feed()
+        res, content = self.read_feed()
+        self.assertEqual(res.status_code, 200)
+        records = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([r["name"] for r in records], ["iPhone", "Pixel"])
+        self.assertEqual(records[0]["category"], "Phones")
+        self.assertTrue(records[0]["url"].endswith("/products/iphone/"))
+
+        self.phone.price = 1100
+        self.phone.save()
+        self.pixel.delete()
+        self.hidden.is_available = True
+        self.hidden.save()
+        with CaptureQueriesContext(connection) as ctx:
+            generate_catalog_feed()
+        # the changed products and one existence check of the unchanged ones
+        self.assertEqual(len(ctx.captured_queries), 2)
+
+        res, content = self.read_feed()
+        records = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([(r["name"], r["price"]) for r in records],
+                         [("iPhone", 1100), ("Hidden", 1)])
+
+        res, content = self.read_feed("xml")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b"<name>Hidden</name>", content)
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    def test_feed_conditional_get_without_queries(self):
+        generate_catalog_feed()
+        url = reverse("catalog-feed", args=["xml"])
+        res = self.client.get(url, HTTP_ACCEPT="application/xml")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("public", res["Cache-Control"])
+        self.assertEqual(res["Content-Type"], "application/xml; charset=utf-8")
+
+        with self.assertNumQueries(0):
+            res = self.client.get(url, HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(res.status_code, 304)
+
+        # an unchanged catalog keeps the validators
+        etag = res["ETag"]
+        generate_catalog_feed()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    def test_feed_keeps_the_previous_files_for_one_run(self):
+        first = generate_catalog_feed()
+        self.phone.price = 1100
+        self.phone.save()
+        second = generate_catalog_feed()
+        # a response may still be streaming them
+        self.assertTrue(default_storage.exists(first["paths"]["jsonl"]))
+
+        self.phone.price = 1200
+        self.phone.save()
+        generate_catalog_feed()
+        self.assertFalse(default_storage.exists(first["paths"]["jsonl"]))
+        self.assertTrue(default_storage.exists(second["paths"]["xml"]))
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES)
+    def test_overlapping_feed_runs_are_skipped(self):
+        cache.add(FEED_LOCK_KEY, True)
+        self.assertIsNone(generate_catalog_feed_task())
+        self.assertIsNone(get_feed_state())
+        cache.delete(FEED_LOCK_KEY)
+        self.assertEqual(generate_catalog_feed_task(), get_feed_state()["paths"])
 
 class CouponViewTests(APITestCase):
     @classmethod
@@ -160,6 +656,29 @@ class CartViewTests(APITestCase):
         res = self.client.get(url)
         self.assertEqual(res.status_code, 200)
 
+    def test_user_cart_list_queries_do_not_grow_with_other_carts(self):
+        CartItem.objects.create(cart=self.user.cart, product=self.product, quantity=2)
+        for i in range(5):
+            other = User.objects.create_user(email=f"other{i}@example.com", password="Testpass123!")
+            CartItem.objects.create(cart=other.cart, product=self.product, quantity=1)
+
+        # count, page and total
+        with self.assertNumQueries(3):
+            res = self.client.get(reverse("user-cart-list"))
+        self.assertEqual(res.data["total"], 1000)
+        self.assertEqual(res.data["results"][0]["product"]["carts_count"], 6)
+
+    def test_user_cart_list_sparse_fields(self):
+        CartItem.objects.create(
+            cart=self.user.cart, product=self.product, quantity=2)
+        res = self.client.get(reverse("user-cart-list"), {"fields": "quantity"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['results'], [{"quantity": 2}])
+
+        res = self.client.get(reverse("user-cart-list"),
+                              {"fields": "product,quantity"})
+        self.assertEqual(res.data['results'][0]['product']['slug'], "camera")
+
     def test_user_cart_item_create_adds_item(self):
         url = reverse("user-cart-item-create")
         res = self.client.post(
@@ -177,6 +696,182 @@ class CartViewTests(APITestCase):
         res = self.client.delete(url)
         self.assertEqual(res.status_code, 204)
 
+    def test_user_cart_batch_applies_operations(self):
+        products = [Product.objects.create(name=f"Lens {i}", slug=f"lens-{i}", category=self.cat,
+                                           price=100, stock=5) for i in range(3)]
+        CartItem.objects.create(cart=self.user.cart, product=self.product, quantity=1)
+        CartItem.objects.create(cart=self.user.cart, product=products[0], quantity=1)
+        operations = [
+            {"op": "add", "product_id": products[0].id, "quantity": 2},
+            {"op": "add", "product_id": products[1].id, "quantity": 1},
+            {"op": "add", "product_id": products[2].id, "quantity": 1},
+            {"op": "set", "product_id": products[1].id, "quantity": 4},
+            {"op": "remove", "product_id": self.product.id},
+        ]
+        res = self.client.post(reverse("user-cart-batch"), {"operations": operations}, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["total"], 800)
+        expected = {products[0].id: 3, products[1].id: 4, products[2].id: 1}
+        self.assertEqual({item["product_id"]: item["quantity"] for item in res.data["items"]}, expected)
+        self.assertEqual(dict(CartItem.objects.filter(cart__user=self.user)
+                              .values_list("product_id", "quantity")), expected)
+        products[1].refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((products[1].carts_count, self.product.carts_count), (1, 0))
+
+    def test_user_cart_batch_is_all_or_nothing(self):
+        CartItem.objects.create(cart=self.user.cart, product=self.product, quantity=1)
+        operations = [
+            {"op": "remove", "product_id": self.product.id},
+            {"op": "add", "product_id": 999999, "quantity": 1},
+            {"op": "set", "product_id": self.product.id, "quantity": 4},
+            {"op": "set", "product_id": self.product.id},
+        ]
+        res = self.client.post(reverse("user-cart-batch"), {"operations": operations}, format="json")
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("quantity", res.data["operations"][3])
+
+        res = self.client.post(reverse("user-cart-batch"), {"operations": operations[:3]}, format="json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([error["index"] for error in res.data["errors"]], [1, 2])
+        self.assertEqual(list(CartItem.objects.values_list("quantity", flat=True)), [1])
+
+    @override_settings(CART_STORAGE="cache")
+    @patch("product.tasks.flush_cart.apply_async")
+    def test_user_cart_batch_in_cache_mode(self, mock_flush):
+        cache.clear()
+        operations = [{"op": "add", "product_id": self.product.id, "quantity": 2}]
+        res = self.client.post(reverse("user-cart-batch"), {"operations": operations}, format="json")
+        self.assertEqual(res.data["items"], [{"product_id": self.product.id, "quantity": 2}])
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(cart_service.get_cart(self.user.id), {self.product.id: 2})
+        mock_flush.assert_called_once()
+
+    @override_settings(CART_STORAGE="cache")
+    @patch("product.tasks.flush_cart.apply_async")
+    def test_cache_cart_writes_behind(self, mock_flush):
+        cache.clear()
+        phone = Product.objects.create(
+            name="Phone", slug="phone", category=self.cat, price=200, stock=2)
+        CartItem.objects.create(cart=self.user.cart, product=self.product, quantity=1)
+
+        # the stock check, and the cart is loaded from CartItem on a miss
+        with self.assertNumQueries(2):
+            res = self.client.post(reverse("user-cart-item-create"),
+                                   {"product_id": phone.id, "quantity": 1})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.data["id"], phone.id)
+        with self.assertNumQueries(1):
+            res = self.client.post(reverse("user-cart-item-create"),
+                                   {"product_id": phone.id, "quantity": 1})
+        self.assertEqual(res.status_code, 400)
+        # one pending flush for all the changes
+        mock_flush.assert_called_once_with((self.user.id,), countdown=30)
+
+        url = reverse("cart-item-detail", args=[phone.id])
+        res = self.client.patch(url, {"quantity": 5})
+        self.assertEqual(res.data["quantity"], 2)
+        self.client.delete(reverse("cart-item-detail", args=[self.product.id]))
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(
+            self.client.delete(reverse("cart-item-detail", args=[self.product.id])).status_code, 404)
+
+        res = self.client.get(reverse("user-cart-list"))
+        self.assertEqual([(item["product"]["slug"], item["quantity"]) for item in res.data["results"]],
+                         [("phone", 2)])
+        self.assertEqual(res.data["total"], 400)
+        self.assertTrue(res.data["results"][0]["url"].endswith(url))
+        # nothing written yet
+        self.assertEqual(list(CartItem.objects.values_list("product__slug", flat=True)), ["camera"])
+
+        cart_service.flush_cart(self.user.id)
+        self.assertEqual(list(CartItem.objects.values_list("product__slug", "quantity")), [("phone", 2)])
+        phone.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((phone.carts_count, self.product.carts_count), (1, 0))
+
+    @override_settings(CART_STORAGE="cache")
+    @patch("product.tasks.flush_cart.apply_async")
+    def test_cache_cart_keeps_rows_written_elsewhere(self, mock_flush):
+        cache.clear()
+        phone = Product.objects.create(
+            name="Phone", slug="phone", category=self.cat, price=200, stock=2)
+        self.client.post(reverse("user-cart-item-create"), {"product_id": phone.id, "quantity": 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item = CartItem.objects.create(cart=self.user.cart, product=self.product, quantity=2)
+        cart_service.flush_cart(self.user.id)
+        self.assertEqual(dict(CartItem.objects.values_list("product_id", "quantity")),
+                         {phone.id: 1, self.product.id: 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()
+        self.assertEqual(cart_service.get_cart(self.user.id), {phone.id: 1})
+
+    @override_settings(CART_STORAGE="cache")
+    @patch("product.tasks.flush_cart.apply_async")
+    @patch("product.views.request_payment")
+    def test_order_is_made_of_the_cached_cart(self, mock_request_payment, mock_flush):
+        cache.clear()
+        mock_request_payment.return_value = ("AUTHORITY", "https://example.com")
+        self.client.post(reverse("user-cart-item-create"),
+                         {"product_id": self.product.id, "quantity": 2})
+
+        res = self.client.post(reverse("order-create"))
+        self.assertEqual(res.status_code, 201)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.total_amount, 1000)
+        self.assertEqual(list(order.items.values_list("quantity", flat=True)), [2])
+        self.assertFalse(CartItem.objects.exists())
+
+
+class GuestCartTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="guest@example.com", password="Testpass123!", is_active=True)
+        cls.camera = Product.objects.create(name="Camera", slug="camera", price=500, stock=3)
+        cls.lens = Product.objects.create(name="Lens", slug="lens", price=100, stock=5)
+        CartItem.objects.create(cart=cls.user.cart, product=cls.camera, quantity=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_guest_cart_never_touches_the_database(self):
+        with self.assertNumQueries(1):  # the stock check
+            res = self.client.post(reverse("user-cart-item-create"),
+                                   {"product_id": self.lens.id, "quantity": 2})
+        self.assertEqual(res.status_code, 201)
+        self.assertIn(settings.GUEST_CART_COOKIE, res.cookies)
+        self.client.patch(reverse("cart-item-detail", args=[self.lens.id]), {"quantity": 3})
+
+        res = self.client.get(reverse("user-cart-list"))
+        self.assertEqual([(item["product"]["slug"], item["quantity"]) for item in res.data["results"]],
+                         [("lens", 3)])
+        self.assertEqual(res.data["total"], 300)
+        self.assertEqual(CartItem.objects.count(), 1)
+
+        # a forged cookie is a new, empty cart
+        self.client.cookies[settings.GUEST_CART_COOKIE] = "forged"
+        self.assertEqual(self.client.get(reverse("user-cart-list")).data["results"], [])
+
+    def test_guest_cart_is_merged_when_tokens_are_issued(self):
+        operations = [{"op": "add", "product_id": self.camera.id, "quantity": 2},
+                      {"op": "add", "product_id": self.lens.id, "quantity": 1}]
+        self.client.post(reverse("user-cart-batch"), {"operations": operations}, format="json")
+        # sold meanwhile, the merged quantity is clamped
+        Product.objects.filter(pk=self.lens.pk).update(stock=0)
+
+        res = self.client.post(reverse("Token"), {"email": "guest@example.com", "password": "wrong"})
+        self.assertEqual(res.status_code, 401)
+        res = self.client.post(reverse("Token"), {"email": "guest@example.com", "password": "Testpass123!"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.cookies[settings.GUEST_CART_COOKIE].value, "")
+        self.assertEqual(dict(CartItem.objects.filter(cart__user=self.user).values_list("product__slug", "quantity")),
+                         {"camera": 2, "lens": 0})
+        self.lens.refresh_from_db()
+        self.assertEqual(self.lens.carts_count, 1)
+
 
 class OrderPaymentViewTests(APITestCase):
     @classmethod
@@ -208,6 +903,66 @@ class OrderPaymentViewTests(APITestCase):
         res = self.client.get(url, {"Authority": 'AUTHORITY', "Status": "OK"})
         self.assertEqual(res.status_code, 200)
 
+    @patch('product.views.request_payment')
+    @patch('product.views.verify_payment')
+    def test_order_holds_stock_until_payment(self, mock_verify_payment, mock_request_payment):
+        mock_request_payment.return_value = ("AUTHORITY", "https://example.com")
+        Product.objects.filter(pk=self.product.pk).update(stock=3)
+        CartItem.objects.filter(pk=self.item.pk).update(quantity=2)
+
+        self.assertEqual(self.client.post(reverse("order-create")).status_code, 201)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 1)
+        # a second checkout of the same cart finds too little stock, and takes none
+        res = self.client.post(reverse("order-create"))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.data["products"], [str(self.product.id)])
+        self.assertEqual(Order.objects.count(), 1)
+
+        res = self.client.get(reverse("payment-verify"), {"Authority": "AUTHORITY", "Status": "NOK"})
+        self.assertEqual(res.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        # verified once only
+        res = self.client.get(reverse("payment-verify"), {"Authority": "AUTHORITY", "Status": "OK"})
+        self.assertEqual(res.data, {"error": "Invalid payment"})
+        mock_verify_payment.assert_not_called()
+
+    @patch('product.views.request_payment')
+    def test_failed_payment_request_gives_stock_back(self, mock_request_payment):
+        mock_request_payment.return_value = (None, None)
+        Product.objects.filter(pk=self.product.pk).update(stock=3)
+        CartItem.objects.filter(pk=self.item.pk).update(quantity=2)
+
+        res = self.client.post(reverse("order-create"))
+        self.assertEqual(res.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(Order.objects.get(user=self.user).status, "canceled")
+
+    @patch('product.views.request_payment')
+    @patch('product.views.verify_payment')
+    def test_order_with_coupon(self, mock_verify_payment, mock_request_payment):
+        mock_request_payment.return_value = ("AUTHORITY", "https://example.com")
+        mock_verify_payment.return_value = ("REF_ID", "success")
+        Product.objects.filter(pk=self.product.pk).update(stock=3)
+        CartItem.objects.filter(pk=self.item.pk).update(quantity=2)
+        coupon = Coupon.objects.create(
+            code="OFF10", discount_value=10, start_date=timezone.now(), is_active=True)
+
+        res = self.client.post(reverse("order-create"), {"coupon": "NOPE"})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.post(reverse("order-create"), {"coupon": "OFF10"})
+        self.assertEqual(res.status_code, 201)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual((order.total_amount, order.discount_amount, order.final_amount, order.coupon),
+                         (200, 20, 180, "OFF10"))
+        self.assertEqual(list(order.items.values_list("quantity", "price")), [(2, 100)])
+
+        self.client.get(reverse("payment-verify"), {"Authority": "AUTHORITY", "Status": "OK"})
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.usage_count, 1)
+
     def test_order_list_and_detail(self):
         order = Order.objects.create(
             user=self.user, total_amount=100, final_amount=100)
@@ -218,6 +973,10 @@ class OrderPaymentViewTests(APITestCase):
         self.assertEqual(res1.status_code, 200)
         self.assertEqual(res2.status_code, 200)
 
+        res = self.client.get(url_list, {"fields": "id,status"})
+        self.assertEqual(res.data['results'][0],
+                         {"id": order.id, "status": "pending"})
+
     def test_payment_list(self):
         order = Order.objects.create(
             user=self.user, total_amount=50, final_amount=50)
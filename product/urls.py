@@ -35,12 +35,22 @@ admin_router.register(r'payments', views.AdminPaymentView,
 
 urlpatterns = [
     path('admin/', include(admin_router.urls),),
+    path('admin/product/import/', views.AdminProductImport.as_view(),
+         name='admin-product-import'),
+    path('admin/product/batch/', views.AdminProductBatchUpdate.as_view(),
+         name='admin-product-batch-update'),
+    path('admin/product/import/<str:task_id>/',
+         views.AdminProductImportStatus.as_view(), name='admin-product-import-status'),
 
     path('category/', views.CategoryList.as_view(), name='category-list'),
+    path('category/tree/', views.CategoryTree.as_view(), name='category-tree'),
 
     path('products/', views.ProductList.as_view(), name='product-list'),
+    path('products/feed.<str:feed_format>', views.CatalogFeed.as_view(), name='catalog-feed'),
     path('products/<slug:slug>/',
          views.ProductDetail.as_view(), name='product-detail'),
+    path('products/<slug:slug>/reviews/',
+         views.ProductReviewList.as_view(), name='product-review-list'),
 
     path('coupon/', views.CoupenVerify.as_view(), name='coupon-verify'),
 
@@ -49,6 +59,7 @@ urlpatterns = [
     path('review/image/', views.ReviweImageCreate.as_view(), name='review-image'),
 
     path('cart/', views.UserCartList.as_view(), name='user-cart-list'),
+    path('cart/batch/', views.UserCartBatch.as_view(), name='user-cart-batch'),
     path('cart/item/', views.UserCartItemCreate.as_view(),
          name='user-cart-item-create'),
     path('cart/item/<int:pk>/', views.UserCartItemDetail.as_view(),
@@ -0,0 +1,72 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from product.models import Product
+from product.serializers import ProductBatchUpdateItemSerializer
+from .cache_service import invalidate_product_detail
+from .import_service import chunked
+
+BATCH_CHUNK_SIZE = 500
+BATCH_FIELDS = ('price', 'stock', 'is_available')
+
+
+def batch_update_products(items):
+    """
+    Apply `{id|sku, price?, stock?, is_available?}` items in one transaction.
+    Each product is written with only the fields which change, so a price update
+    does not overwrite a stock change made in between, and once per chunk and field set.
+    return: one result per item, {index, id, sku, status, errors?}
+    status: updated, unchanged, not_found or invalid
+    """
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        serializer = ProductBatchUpdateItemSerializer(data=item)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'id': item.get('id'), 'sku': item.get('sku'),
+                              'status': 'invalid', 'errors': serializer.errors}
+
+    updated_ids = []
+    now = timezone.now()
+    with transaction.atomic():
+        for chunk in chunked(valid, BATCH_CHUNK_SIZE):
+            products = list(
+                Product.objects.select_for_update().filter(
+                    Q(pk__in=[data['id'] for _, data in chunk if 'id' in data])
+                    | Q(sku__in=[data['sku'] for _, data in chunk if 'sku' in data])
+                ).only('id', 'sku', *BATCH_FIELDS)
+            )
+            by_id = {product.pk: product for product in products}
+            by_sku = {product.sku: product for product in products}
+
+            changed = defaultdict(set)
+            for index, data in chunk:
+                product = by_id.get(data['id']) if 'id' in data else by_sku.get(data['sku'])
+                if product is None:
+                    results[index] = {'index': index, 'id': data.get('id'), 'sku': data.get('sku'),
+                                      'status': 'not_found'}
+                    continue
+                fields = {field for field in BATCH_FIELDS
+                          if field in data and getattr(product, field) != data[field]}
+                for field in fields:
+                    setattr(product, field, data[field])
+                changed[product.pk] |= fields
+                results[index] = {'index': index, 'id': product.pk, 'sku': product.sku,
+                                  'status': 'updated' if fields else 'unchanged'}
+
+            groups = defaultdict(list)
+            for product_id, fields in changed.items():
+                if fields:
+                    product = by_id[product_id]
+                    # bulk_update skips auto_now, updated_at is a validator of the product responses
+                    product.updated_at = now
+                    groups[tuple(sorted(fields))].append(product)
+            for fields, group in groups.items():
+                Product.objects.bulk_update(group, [*fields, 'updated_at'])
+                updated_ids += [product.pk for product in group]
+
+        transaction.on_commit(lambda: invalidate_product_detail(updated_ids))
+    return results
@@ -0,0 +1,104 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from product.models import Product
+import hashlib
+import time
+
+# carts_count of a cached detail may lag behind by this much, cart changes do not invalidate it
+PRODUCT_DETAIL_TIMEOUT = 60 * 5
+PRODUCT_DETAIL_HITS_KEY = 'product_detail_hits'
+PRODUCT_DETAIL_MISSES_KEY = 'product_detail_misses'
+
+
+def touch_product(product_id):
+    """
+    Bump `updated_at` when a row rendered with the product changes,
+    so it stays a validator of the product responses.
+    """
+    Product.objects.filter(pk=product_id).update(updated_at=timezone.now())
+
+
+def save_drifted_products(products, fields):
+    """
+    Write the products fixed by a rebuild, bumping `updated_at` and dropping their
+    cached details, so the validators and the feed see the fix.
+    """
+    now = timezone.now()
+    for product in products:
+        product.updated_at = now
+    Product.objects.bulk_update(products, [*fields, 'updated_at'])
+    product_ids = [product.pk for product in products]
+    if product_ids:
+        transaction.on_commit(lambda: invalidate_product_detail(product_ids))
+
+
+def product_slug_key(slug):
+    return f'product_detail_slug_{slug}'
+
+
+def product_version_key(product_id):
+    return f'product_detail_version_{product_id}'
+
+
+def get_product_version(product_id):
+    # a fresh version is never a reused one, even if the old key was evicted
+    key = product_version_key(product_id)
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def product_detail_key(product_id, version, variant):
+    variant = hashlib.md5(variant.encode()).hexdigest()
+    return f'product_detail_{product_id}_{version}_{variant}'
+
+
+def get_product_detail(slug, variant):
+    """
+    variant: everything besides the product that changes the response (query string, media type)
+    return: (the cached entry or None, the product id or None, its version),
+        the version is taken before the product is read, store the response under it
+    """
+    product_id = cache.get(product_slug_key(slug))
+    entry = version = None
+    if product_id is not None:
+        version = get_product_version(product_id)
+        entry = cache.get(product_detail_key(product_id, version, variant))
+
+    increment(PRODUCT_DETAIL_HITS_KEY if entry else PRODUCT_DETAIL_MISSES_KEY)
+    return entry, product_id, version
+
+
+def set_product_detail(slug, product_id, version, variant, entry):
+    # an invalidation since the version was taken makes the entry unreachable
+    cache.set_many({
+        product_slug_key(slug): product_id,
+        product_detail_key(product_id, version, variant): entry,
+    }, PRODUCT_DETAIL_TIMEOUT)
+
+
+def invalidate_product_detail(product_ids):
+    cache.delete_many([product_version_key(pk) for pk in product_ids])
+
+
+def increment(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def product_detail_stats():
+    stats = cache.get_many([PRODUCT_DETAIL_HITS_KEY, PRODUCT_DETAIL_MISSES_KEY])
+    hits = stats.get(PRODUCT_DETAIL_HITS_KEY, 0)
+    misses = stats.get(PRODUCT_DETAIL_MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else 0,
+    }
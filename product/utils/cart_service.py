@@ -0,0 +1,335 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.utils.translation import gettext_lazy as _
+from product.models import Cart, CartItem, Product
+from .counter_service import change_carts_count, defer_carts_count
+import time
+import uuid
+
+# a cached cart outlives its pending flush by far, an evicted one is reloaded from CartItem
+CART_TIMEOUT = 60 * 60 * 24 * 7
+# a lock left by a dead worker expires on its own
+CART_LOCK_TIMEOUT = 5
+CART_LOCK_WAIT = 0.01
+
+# set while write_cart makes the rows match the cached cart, see item_written
+_writing_cart = ContextVar('writing_cart', default=False)
+
+# The functions below take the owner of a cart: a user id, or the token of a guest cart.
+# Guest carts live only in the cache, for GUEST_CART_TIMEOUT after their last change.
+
+
+def is_cache_mode():
+    return settings.CART_STORAGE == 'cache'
+
+
+def is_guest(owner):
+    return isinstance(owner, str)
+
+
+def uses_cache(owner):
+    return is_guest(owner) or is_cache_mode()
+
+
+def new_guest_token():
+    return uuid.uuid4().hex
+
+
+def cart_key(owner):
+    if is_guest(owner):
+        return f'guest_cart_{owner}'
+    return f'cart_{owner}'
+
+
+def cart_flush_key(user_id):
+    return f'cart_flush_{user_id}'
+
+
+@contextmanager
+def cart_lock(owner):
+    """
+    A cached cart is read, changed and written back whole, so the changes of a
+    cart run one at a time, or two concurrent ones would lose one of them.
+    """
+    key = f'{cart_key(owner)}_lock'
+    token = uuid.uuid4().hex
+    while not cache.add(key, token, CART_LOCK_TIMEOUT):
+        time.sleep(CART_LOCK_WAIT)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def get_cart(owner):
+    """
+    return: {product id: quantity} of the cached cart, a user cart is loaded from CartItem on a miss
+    """
+    items = cache.get(cart_key(owner))
+    if items is None:
+        if is_guest(owner):
+            return {}
+        items = dict(
+            CartItem.objects.filter(cart__user_id=owner).order_by('id')
+            .values_list('product_id', 'quantity')
+        )
+        # a change saved since the rows were read wins
+        if not cache.add(cart_key(owner), items, CART_TIMEOUT):
+            return get_cart(owner)
+    return items
+
+
+def save_cart(owner, items):
+    if is_guest(owner):
+        cache.set(cart_key(owner), items, settings.GUEST_CART_TIMEOUT)
+        return
+    cache.set(cart_key(owner), items, CART_TIMEOUT)
+    schedule_flush(owner)
+
+
+def schedule_flush(user_id):
+    # one pending flush per cart, the changes made until it runs are written together.
+    # The flag expires on its own, so a lost task does not stop the next ones.
+    if cache.add(cart_flush_key(user_id), True, settings.CART_FLUSH_DELAY * 10):
+        # product.tasks imports this module
+        from product.tasks import flush_cart
+        flush_cart.apply_async((user_id,), countdown=settings.CART_FLUSH_DELAY)
+
+
+def get_cart_items(owner, products=None):
+    """
+    The cached cart as unsaved CartItems, the product id standing in for the item id.
+    products: Product queryset the products are read from, None leaves them out
+    """
+    items = get_cart(owner)
+    by_id = products.in_bulk(items.keys()) if products is not None else {}
+    cart_items = []
+    for product_id, quantity in items.items():
+        item = CartItem(pk=product_id, product_id=product_id, quantity=quantity)
+        if products is not None:
+            if product_id not in by_id:
+                # deleted since it was added, the flush drops it
+                continue
+            item.product = by_id[product_id]
+        cart_items.append(item)
+    return cart_items
+
+
+def get_cart_total(owner):
+    """
+    return: sum of quantity * price over the cart, with one query
+    """
+    if uses_cache(owner):
+        items = get_cart(owner)
+        prices = Product.objects.filter(pk__in=items.keys()).values_list('id', 'price')
+        return sum(items[product_id] * price for product_id, price in prices)
+    return CartItem.objects.filter(cart__user_id=owner).aggregate(
+        total=Coalesce(Sum(F('quantity') * F('product__price')), 0))['total']
+
+
+def add_item(owner, product, quantity):
+    """
+    return: False if the product is in the cart already
+    """
+    with cart_lock(owner):
+        items = get_cart(owner)
+        if product.pk in items:
+            return False
+        items[product.pk] = quantity
+        save_cart(owner, items)
+    return True
+
+
+def set_quantity(owner, product_id, quantity):
+    """
+    return: the quantity, clamped to the stock like CartItem.save does
+    """
+    stock = Product.objects.filter(pk=product_id).values_list('stock', flat=True).first() or 0
+    with cart_lock(owner):
+        items = get_cart(owner)
+        items[product_id] = min(quantity, stock)
+        save_cart(owner, items)
+    return items[product_id]
+
+
+def remove_item(owner, product_id):
+    with cart_lock(owner):
+        items = get_cart(owner)
+        if items.pop(product_id, None) is not None:
+            save_cart(owner, items)
+
+
+def apply_operations(owner, operations):
+    """
+    Apply add, set and remove operations in order, all or none: a product which
+    does not exist or has not the stock for its new quantity fails the batch.
+    The products are checked and priced with one query, and the rows are written
+    with one query per kind of change, see write_cart.
+    return: (items, total, errors), errors: [{index, errors}] of the failed operations
+    """
+    with transaction.atomic(), cart_lock(owner) if uses_cache(owner) else nullcontext():
+        if uses_cache(owner):
+            items = get_cart(owner)
+        else:
+            # the cart row, as the rows of products added meanwhile are not there to lock
+            Cart.objects.select_for_update().filter(user_id=owner).first()
+            items = dict(
+                CartItem.objects.filter(cart__user_id=owner).order_by('id')
+                .values_list('product_id', 'quantity')
+            )
+
+        # product id: index of the last operation which added to or set its quantity
+        touched = {}
+        for index, operation in enumerate(operations):
+            product_id = operation['product_id']
+            if operation['op'] == 'remove':
+                items.pop(product_id, None)
+                touched.pop(product_id, None)
+                continue
+            quantity = operation['quantity']
+            if operation['op'] == 'add':
+                quantity += items.get(product_id, 0)
+            items[product_id] = quantity
+            touched[product_id] = index
+
+        products = {
+            product_id: (stock, price) for product_id, stock, price in
+            Product.objects.filter(pk__in=items.keys()).values_list('id', 'stock', 'price')
+        }
+        errors = []
+        for product_id, index in touched.items():
+            if product_id not in products:
+                errors.append({'index': index, 'errors': {'product_id': [_('Product not found')]}})
+            elif items[product_id] > products[product_id][0]:
+                errors.append({'index': index, 'errors': {
+                    'quantity': [_('Quantity can not be greater than stock')]}})
+        if errors:
+            return None, None, sorted(errors, key=lambda error: error['index'])
+
+        items = {product_id: quantity for product_id, quantity in items.items() if product_id in products}
+        if uses_cache(owner):
+            save_cart(owner, items)
+        else:
+            write_cart(owner, items)
+    total = sum(quantity * products[product_id][1] for product_id, quantity in items.items())
+    return items, total, []
+
+
+def merge_guest_cart(token, user_id):
+    """
+    Move a guest cart into the cart of a user who just logged in, with one bulk
+    write of the rows. A product in both carts keeps the larger quantity, clamped
+    to the stock like CartItem.save does.
+    """
+    guest_items = cache.get(cart_key(token))
+    cache.delete(cart_key(token))
+    if not guest_items:
+        return
+    stocks = dict(Product.objects.filter(pk__in=guest_items.keys()).values_list('id', 'stock'))
+    with transaction.atomic(), cart_lock(user_id) if is_cache_mode() else nullcontext():
+        if is_cache_mode():
+            items = get_cart(user_id)
+        else:
+            # the cart row, as the rows of products added meanwhile are not there to lock
+            Cart.objects.select_for_update().filter(user_id=user_id).first()
+            items = dict(
+                CartItem.objects.filter(cart__user_id=user_id)
+                .values_list('product_id', 'quantity')
+            )
+        for product_id, quantity in guest_items.items():
+            if product_id in stocks:
+                items[product_id] = min(max(quantity, items.get(product_id, 0)), stocks[product_id])
+        if is_cache_mode():
+            save_cart(user_id, items)
+        else:
+            write_cart(user_id, items)
+
+
+def drop_cart(user_id):
+    # after the CartItem rows were deleted, the next read reloads the empty cart
+    cache.delete(cart_key(user_id))
+
+
+def flush_cart(user_id):
+    """
+    Write the cached cart to CartItem, if it is still cached.
+    """
+    # changes made from now on schedule the next flush
+    cache.delete(cart_flush_key(user_id))
+    with cart_lock(user_id):
+        items = cache.get(cart_key(user_id))
+        if items is not None:
+            write_cart(user_id, items)
+
+
+def item_written(cart_id, product_id, quantity=None):
+    """
+    Apply a CartItem row written outside this module, by the admin for one, to the
+    cached cart, which the next flush would write over it otherwise.
+    quantity: None for a deleted row
+    """
+    if not is_cache_mode() or _writing_cart.get():
+        return
+
+    def apply():
+        user_id = Cart.objects.filter(pk=cart_id).values_list('user_id', flat=True).first()
+        if user_id is None:
+            return
+        with cart_lock(user_id):
+            items = cache.get(cart_key(user_id))
+            if items is None:
+                # the next read loads the rows
+                return
+            if quantity is None:
+                items.pop(product_id, None)
+            else:
+                items[product_id] = quantity
+            save_cart(user_id, items)
+
+    transaction.on_commit(apply)
+
+
+def write_cart(user_id, items):
+    """
+    Make the CartItem rows of a user match `items`, with one query per kind of change.
+    """
+    token = _writing_cart.set(True)
+    try:
+        _write_cart(user_id, items)
+    finally:
+        _writing_cart.reset(token)
+
+
+def _write_cart(user_id, items):
+    with transaction.atomic(), defer_carts_count():
+        cart, _ = Cart.objects.get_or_create(user_id=user_id)
+        existing = {item.product_id: item for item in
+                    CartItem.objects.filter(cart=cart).only('id', 'product_id', 'quantity')}
+
+        CartItem.objects.filter(
+            pk__in=[item.pk for product_id, item in existing.items() if product_id not in items]
+        ).delete()
+
+        changed = []
+        for product_id, item in existing.items():
+            if product_id in items and item.quantity != items[product_id]:
+                item.quantity = items[product_id]
+                changed.append(item)
+        CartItem.objects.bulk_update(changed, ['quantity'])
+
+        new_ids = set(Product.objects.filter(
+            pk__in=[product_id for product_id in items if product_id not in existing]
+        ).values_list('id', flat=True))
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_id, quantity=items[product_id])
+            for product_id in new_ids
+        ])
+        # bulk_create sends no post_save, see signals.cart_item_saved
+        for product_id in new_ids:
+            change_carts_count(product_id, 1)
@@ -0,0 +1,98 @@
+from django.core.cache import cache
+from django.db.models import Q
+from product.models import Category
+
+CATEGORY_TREE_VERSION_KEY = 'category_tree_version'
+CATEGORY_TREE_TIMEOUT = 60 * 60 * 24
+
+
+def subtree_filter(paths, field='category__path'):
+    """
+    Q matching every row whose category is one of `paths` or below them
+    """
+    condition = Q(pk__in=[])
+    for path in paths:
+        # a path not backfilled yet is a prefix of every path
+        if path:
+            # `startswith` as a range, which the path index answers on every database
+            condition |= Q(**{f'{field}__gte': path, f'{field}__lt': path[:-1] + chr(ord(path[-1]) + 1)})
+    return condition
+
+
+def rebuild_category_paths():
+    """
+    Recompute the path of every category, level by level from the roots.
+    return: number of categories which were fixed
+    """
+    fixed = 0
+    parent_paths = {None: ''}
+    level = list(Category.objects.filter(parent__isnull=True))
+    while level:
+        drifted = []
+        next_paths = {}
+        for category in level:
+            path = f"{parent_paths[category.parent_id]}{category.pk}/"
+            next_paths[category.pk] = path
+            if category.path != path:
+                category.path = path
+                drifted.append(category)
+
+        Category.objects.bulk_update(drifted, ['path'], batch_size=1000)
+        fixed += len(drifted)
+        parent_paths = next_paths
+        level = list(Category.objects.filter(parent_id__in=list(next_paths)))
+    return fixed
+
+
+def bump_category_tree_version():
+    try:
+        cache.incr(CATEGORY_TREE_VERSION_KEY)
+    except ValueError:
+        cache.set(CATEGORY_TREE_VERSION_KEY, 1, None)
+
+
+def get_category_version():
+    """
+    Changes on every Category save or delete
+    """
+    version = cache.get(CATEGORY_TREE_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(CATEGORY_TREE_VERSION_KEY, version, None)
+    return version
+
+
+def build_category_tree():
+    """
+    Nested active categories from one query, a category under an inactive parent is hidden
+    """
+    nodes = {}
+    for category in Category.objects.filter(is_active=True).order_by('name'):
+        nodes[category.pk] = {
+            'id': category.pk,
+            'name': category.name,
+            'slug': category.slug,
+            'parent_id': category.parent_id,
+            'children': [],
+        }
+
+    tree = []
+    for node in nodes.values():
+        parent_id = node.pop('parent_id')
+        if parent_id is None:
+            tree.append(node)
+        elif parent_id in nodes:
+            nodes[parent_id]['children'].append(node)
+    return tree
+
+
+def get_category_tree():
+    """
+    The tree is cached under the current version, Category signals bump the version
+    """
+    key = f'category_tree_{get_category_version()}'
+    tree = cache.get(key)
+    if tree is None:
+        tree = build_category_tree()
+        cache.set(key, tree, CATEGORY_TREE_TIMEOUT)
+    return tree
@@ -0,0 +1,139 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db.models import Count, F, Case, When, Value, FloatField
+from django.db.models.functions import Cast
+from product.models import Product, CartItem, Review
+from .cache_service import save_drifted_products
+
+_pending_carts_count = ContextVar('pending_carts_count', default=None)
+
+
+@contextmanager
+def defer_carts_count():
+    """
+    Collect `carts_count` changes made inside the block and write them once on exit,
+    one UPDATE per distinct delta instead of one UPDATE per cart item.
+    """
+    if _pending_carts_count.get() is not None:
+        yield
+        return
+
+    deltas = Counter()
+    token = _pending_carts_count.set(deltas)
+    try:
+        yield
+    finally:
+        _pending_carts_count.reset(token)
+    apply_carts_count(deltas)
+
+
+def change_carts_count(product_id, delta):
+    deltas = _pending_carts_count.get()
+    if deltas is not None:
+        deltas[product_id] += delta
+        return
+    Product.objects.filter(pk=product_id).update(
+        carts_count=F('carts_count') + delta)
+
+
+def apply_carts_count(deltas):
+    by_delta = defaultdict(list)
+    for product_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(product_id)
+
+    for delta, product_ids in by_delta.items():
+        Product.objects.filter(pk__in=product_ids).update(
+            carts_count=F('carts_count') + delta)
+
+
+def rebuild_carts_count(batch_size=1000):
+    """
+    Recompute `carts_count` from CartItem in primary key batches and fix the drifted rows.
+    return: number of products which were fixed
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        products = list(
+            Product.objects.filter(pk__gt=last_id).order_by('pk')
+            .only('id', 'carts_count')[:batch_size]
+        )
+        if not products:
+            return fixed
+        last_id = products[-1].pk
+
+        counts = dict(
+            CartItem.objects.filter(product_id__in=[p.pk for p in products])
+            .order_by().values('product_id').annotate(count=Count('id'))
+            .values_list('product_id', 'count')
+        )
+        drifted = []
+        for product in products:
+            count = counts.get(product.pk, 0)
+            if product.carts_count != count:
+                product.carts_count = count
+                drifted.append(product)
+
+        save_drifted_products(drifted, ['carts_count'])
+        fixed += len(drifted)
+
+
+def change_rating(product_id, rating, delta):
+    """
+    Add (delta=1) or remove (delta=-1) one review of `rating` in the product aggregates
+    """
+    count = F('rating_count') + delta
+    total = F('rating_sum') + delta * rating
+    Product.objects.filter(pk=product_id).update(
+        rating_count=count,
+        rating_sum=total,
+        rating_avg=Case(
+            When(rating_count__gt=-delta, then=Cast(total, FloatField()) / count),
+            default=Value(0.0),
+        ),
+        **{f'rating_{rating}_count': F(f'rating_{rating}_count') + delta},
+    )
+
+
+def rebuild_ratings(batch_size=1000):
+    """
+    Recompute the rating aggregates from Review in primary key batches and fix the drifted rows.
+    return: number of products which were fixed
+    """
+    fields = ['rating_count', 'rating_sum', 'rating_avg'] + \
+        [f'rating_{i}_count' for i in range(1, 6)]
+    fixed = 0
+    last_id = 0
+    while True:
+        products = list(
+            Product.objects.filter(pk__gt=last_id).order_by('pk').only('id', *fields)[:batch_size]
+        )
+        if not products:
+            return fixed
+        last_id = products[-1].pk
+
+        histograms = defaultdict(dict)
+        for product_id, rating, count in (
+            Review.objects.filter(product_id__in=[p.pk for p in products])
+            .order_by().values('product_id', 'rating').annotate(count=Count('id'))
+            .values_list('product_id', 'rating', 'count')
+        ):
+            histograms[product_id][rating] = count
+
+        drifted = []
+        for product in products:
+            histogram = histograms.get(product.pk, {})
+            values = {f'rating_{i}_count': histogram.get(i, 0) for i in range(1, 6)}
+            values['rating_count'] = sum(histogram.values())
+            values['rating_sum'] = sum(r * c for r, c in histogram.items())
+            values['rating_avg'] = (values['rating_sum'] / values['rating_count']
+                                    if values['rating_count'] else 0)
+            if any(getattr(product, name) != value for name, value in values.items()):
+                for name, value in values.items():
+                    setattr(product, name, value)
+                drifted.append(product)
+
+        save_drifted_products(drifted, fields)
+        fixed += len(drifted)
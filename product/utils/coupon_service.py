@@ -1,84 +1,150 @@
-from product.models import Coupon, Cart, CartItem
+from product.models import Coupon, CartItem, CategoryCoupon, Product, ProductCoupon, UserCoupon
 from django.utils import timezone
-from django.db.models import Prefetch, F, Sum
-
-
-def verify_coupon(user, code, system=False):
+from django.db.models import Exists, F, OuterRef
+from django.db.models.lookups import StartsWith
+from . import cart_service
+
+COUPON_ERRORS = {
+    'invalid': 'Invalid coupon code',
+    'inactive': 'Coupon is not active',
+    'expired': 'Coupon expired or not valid yet',
+    'used_up': 'Coupon usage limit reached',
+    'empty_cart': 'Cart is empty',
+    'min_amount': 'Cart amount less than minimum amount required for this coupon',
+    'products': 'Coupon does not apply to products in the order',
+    'categories': 'Coupon does not apply to categories of products in the order',
+    'user': 'Coupon does not apply to this user',
+}
+
+
+def get_coupon(code, user_id):
     """
-    system: it is for system verify coupon, to execute less queries
+    The coupon with its rules, in one query: whether it is limited to products,
+    categories and users, and whether this user is one of them.
     """
+    return Coupon.objects.filter(code=code).annotate(
+        has_products=Exists(ProductCoupon.objects.filter(coupon=OuterRef('pk'))),
+        has_categories=Exists(CategoryCoupon.objects.filter(coupon=OuterRef('pk'))),
+        has_users=Exists(UserCoupon.objects.filter(coupon=OuterRef('pk'))),
+        for_user=Exists(UserCoupon.objects.filter(coupon=OuterRef('pk'), user_id=user_id)),
+    ).first()
 
-    now = timezone.now()
 
-    coupon = Coupon.objects.filter(code=code).prefetch_related(
-        'products', 'categories', 'users').first()
+def coupon_rules(code, product, category_path):
+    # whether the coupon applies to the product, a category coupon to its subcategories too
+    return {
+        'in_products': Exists(ProductCoupon.objects.filter(coupon__code=code, product=OuterRef(product))),
+        'in_categories': Exists(
+            CategoryCoupon.objects.filter(
+                StartsWith(OuterRef(category_path), F('category__path')), coupon__code=code)
+            # a path not backfilled yet is a prefix of every path
+            .exclude(category__path='')
+        ),
+    }
 
-    if not coupon:
-        return 400, {'error': 'Invalid coupon code'}
 
-    if not coupon.is_active:
-        return 400, {'error': 'Coupon is not active'}
+def get_cart_snapshot(user_id, code=None):
+    """
+    The cart with the prices, and whether the coupon applies to each product, in one query.
+    return: [{product_id, quantity, price, in_products, in_categories}]
+    """
+    fields = ['price']
+    if cart_service.uses_cache(user_id):
+        items = cart_service.get_cart(user_id)
+        queryset = Product.objects.filter(pk__in=items.keys()).order_by()
+        if code:
+            queryset = queryset.annotate(**coupon_rules(code, 'pk', 'category__path'))
+            fields += ['in_products', 'in_categories']
+        return [
+            {'product_id': row['id'], 'quantity': items[row['id']], **{field: row[field] for field in fields}}
+            for row in queryset.values('id', *fields)
+        ]
+
+    queryset = CartItem.objects.filter(cart__user_id=user_id).order_by('id').annotate(
+        price=F('product__price'))
+    if code:
+        queryset = queryset.annotate(**coupon_rules(code, 'product', 'product__category__path'))
+        fields += ['in_products', 'in_categories']
+    return list(queryset.values('product_id', 'quantity', *fields))
+
+
+def evaluate_coupon(coupon, items, now=None):
+    """
+    Check the coupon rules against a cart snapshot, in memory, in this order:
+    existence, activity, dates, usage, empty cart, minimum amount, products, categories, user.
+    return: {valid, error, code, discount_type, discount_value, cart_amount,
+             discount_amount, final_amount, items}, error is a COUPON_ERRORS key
+    """
+    now = now or timezone.now()
+    cart_amount = sum(item['quantity'] * item['price'] for item in items)
+    result = {
+        'valid': False,
+        'error': None,
+        'code': coupon.code if coupon else None,
+        'discount_type': coupon.discount_type if coupon else None,
+        'discount_value': coupon.discount_value if coupon else None,
+        'cart_amount': cart_amount,
+        'discount_amount': 0,
+        'final_amount': cart_amount,
+        'items': items,
+    }
 
-    if not (coupon.start_date <= now <= (coupon.end_date or now)):
-        return 400, {'error': 'Coupon expired or not valid yet'}
+    if not coupon:
+        error = 'invalid'
+    elif not coupon.is_active:
+        error = 'inactive'
+    elif not (coupon.start_date <= now <= (coupon.end_date or now)):
+        error = 'expired'
+    elif coupon.max_usage and coupon.usage_count >= coupon.max_usage:
+        error = 'used_up'
+    elif not items:
+        error = 'empty_cart'
+    elif cart_amount < coupon.min_order_amount:
+        error = 'min_amount'
+    elif coupon.has_products and not all(item['in_products'] for item in items):
+        error = 'products'
+    elif coupon.has_categories and not all(item['in_categories'] for item in items):
+        error = 'categories'
+    elif coupon.has_users and not coupon.for_user:
+        error = 'user'
+    else:
+        error = None
+
+    if error:
+        result['error'] = error
+        return result
+
+    if coupon.discount_type == 'percent':
+        # rounded up, the final amount is rounded down
+        discount = -(-cart_amount * coupon.discount_value // 100)
+    else:
+        discount = coupon.discount_value
+    discount = min(discount, cart_amount)
+    result.update(valid=True, discount_amount=discount, final_amount=cart_amount - discount)
+    return result
+
+
+def check_coupon(user, code):
+    """
+    Load the coupon rules and the cart once, two queries, and evaluate them.
+    """
+    return evaluate_coupon(get_coupon(code, user.id), get_cart_snapshot(user.id, code))
 
-    if coupon.max_usage and coupon.usage_count >= coupon.max_usage:
-        return 400, {'error': 'Coupon usage limit reached'}
 
-    cart = Cart.objects.filter(user=user).prefetch_related(
-        Prefetch('items', queryset=CartItem.objects.select_related(
-            'product__category'))
-    ).first()
+def verify_coupon(user, code):
+    """
+    return: (status code, response data) of CoupenVerify
+    """
+    result = check_coupon(user, code)
+    if not result['valid']:
+        return 400, {'error': COUPON_ERRORS[result['error']]}
 
-    if not cart.items.exists():
-        return 400, {'error': 'Cart is empty'}
-
-    cart_amount = cart.items.aggregate(total_amount=Sum(
-        F('quantity') * F('product__price')))['total_amount']
-
-    if cart_amount < coupon.min_order_amount:
-        return 400, {'error': 'Cart amount less than minimum amount required for this coupon'}
-
-    cart_product_ids = set(
-        cart.items.all().values_list('product__id', flat=True))
-
-    if coupon.products.exists():
-        coupon_product_ids = set(
-            coupon.products.all().values_list('id', flat=True))
-        if not cart_product_ids.issubset(coupon_product_ids):
-            return 400, {'error': 'Coupon does not apply to products in the order'}
-
-    if coupon.categories.exists():
-        coupon_category_ids = set(
-            coupon.categories.all().values_list('category__id', flat=True))
-        product_category_ids = set(cart.items.all().values_list(
-            'product__category__id', flat=True))
-        if not product_category_ids.issubset(coupon_category_ids):
-            return 400, {'error': 'Coupon does not apply to categories of products in the order'}
-
-    if coupon.users.exists():
-        coupon_user_ids = set(
-            coupon.users.all().values_list('user__id', flat=True))
-        if user.id not in coupon_user_ids:
-            return 400, {'error': 'Coupon does not apply to this user'}
-
-    discount_type = coupon.discount_type
-    discount_value = coupon.discount_value
-    if discount_type == 'percent':
-        final_amount = cart_amount - (cart_amount * (discount_value / 100))
-    elif discount_type == 'fixed':
-        final_amount = cart_amount - discount_value
-
-    response_data = {
+    return 200, {
         'status': 'Coupon is valid',
-        'cart_amount': cart_amount,
-        'coupon_type': discount_type,
-        'coupon_value': discount_value,
+        'cart_amount': result['cart_amount'],
+        'coupon_type': result['discount_type'],
+        'coupon_value': result['discount_value'],
         'coupon_code': code,
-        'final_amount': int(final_amount),
+        'discount_amount': result['discount_amount'],
+        'final_amount': result['final_amount'],
     }
-
-    if system:
-        response_data['cart'] = cart
-
-    return 200, response_data
@@ -0,0 +1,102 @@
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import RequestFactory
+from rest_framework.generics import RetrieveAPIView
+from product.models import Category, Order, Payment, Product, tracking_code_range
+import re
+
+# a plan line walking a whole table, or a whole index, which is searched with SEARCH otherwise
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN\b'),
+    'postgresql': re.compile(r'\bSeq Scan on\b'),
+    'mysql': re.compile(r'\btype: ALL\b|\bALL\b.*\bNULL\b'),
+}
+
+
+def view_page(view_class, query=None, **kwargs):
+    """
+    The query of the first page of a list view, or the object query of a detail view,
+    built by the view itself from a GET request with `query`.
+    """
+    view = view_class(args=(), kwargs=kwargs, format_kwarg=None)
+    view.request = view.initialize_request(RequestFactory().get('/', query or {}))
+    # a user who is not saved, only their id is read
+    view.request.user = get_user_model()(pk=1)
+    queryset = view.filter_queryset(view.get_queryset())
+    if issubclass(view_class, RetrieveAPIView):
+        lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+        return queryset.filter(**{view.lookup_field: view.kwargs[lookup_url_kwarg]})
+
+    paginator = view.paginator
+    if paginator.uses_keyset(queryset, view.request, view):
+        return paginator.get_keyset_queryset(queryset, view.request, view)[0]
+    return queryset[:paginator.get_limit(view.request)]
+
+
+def get_hot_queries():
+    """
+    The querysets behind the busiest endpoints, the values only have to be of the right type.
+    The category filter reads the paths of its categories, and the review list the id of
+    its product, so they are left out while there are none.
+    return: {name: queryset}
+    """
+    # product.views imports the services this module sits with
+    from product import views
+
+    queries = {
+        'product-list': view_page(views.ProductList),
+        'product-list?ordering=price': view_page(views.ProductList, {'ordering': 'price'}),
+        'product-list?ordering=-created_at': view_page(views.ProductList, {'ordering': '-created_at'}),
+        'product-list?ordering=-rating_avg': view_page(
+            views.ProductList, {'ordering': '-rating_avg', 'pagination': 'cursor'}),
+        'product-detail': view_page(views.ProductDetail, slug='slug'),
+        'user-cart-list': view_page(views.UserCartList),
+        'order-list': view_page(views.OrderListView),
+        'order-list?status': view_page(views.OrderListView, {'status': 'paid'}),
+        'payment-list': view_page(views.PaymentListView),
+        # PaymentVerifyView, and the tracking codes of Order.save and Payment.save
+        'payment-verify': Payment.objects.filter(transaction_id='authority'),
+        'order tracking code': Order.objects.filter(**tracking_code_range('ORD-20000101-'))
+        .order_by('-tracking_code')[:1],
+        'payment tracking code': Payment.objects.filter(**tracking_code_range('PAY-20000101-'))
+        .order_by('-tracking_code')[:1],
+    }
+    category = Category.objects.exclude(path='').values_list('slug', flat=True).first()
+    if category:
+        queries['product-list?category'] = view_page(views.ProductList, {'category': category})
+    slug = Product.objects.filter(is_available=True).values_list('slug', flat=True).first()
+    if slug:
+        queries['product-review-list'] = view_page(views.ProductReviewList, slug=slug)
+        queries['product-review-list?ordering=rating'] = view_page(
+            views.ProductReviewList, {'ordering': 'rating'}, slug=slug)
+    return queries
+
+
+def explain(queryset):
+    """
+    return: (plan, the plan lines which read a whole table)
+    """
+    pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # tiny tables are cheaper to scan, so only a missing index should make a seq scan win
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+    scans = [line for line in plan.splitlines() if pattern and pattern.search(line)]
+    if connection.vendor == 'sqlite' and is_page_walk(queryset, plan, scans):
+        scans = []
+    return plan, scans
+
+
+def is_page_walk(queryset, plan, scans):
+    """
+    A single table page read in the order of an index, which stops after the page:
+    the only plan line is `SCAN table USING INDEX`, there is no sort, and the query has a LIMIT.
+    """
+    lines = [line for line in plan.splitlines() if line.strip()]
+    return (
+        queryset.query.high_mark is not None
+        and len(lines) == 1 and len(scans) == 1
+        and re.search(r'\bUSING (COVERING )?INDEX\b', scans[0]) is not None
+    )
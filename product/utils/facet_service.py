@@ -0,0 +1,85 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Q
+from taggit.models import TaggedItem
+from product.models import Product
+from .category_service import get_category_tree
+
+# upper bounds of the price buckets, the last bucket has no upper bound
+PRICE_BUCKETS = (1_000_000, 10_000_000, 50_000_000, 100_000_000)
+# only the most used tags of the result are counted
+MAX_TAG_FACETS = 20
+
+
+def price_ranges():
+    lower = 0
+    for upper in PRICE_BUCKETS:
+        yield lower, upper
+        lower = upper
+    yield lower, None
+
+
+def price_condition(lower, upper):
+    condition = Q(price__gte=lower)
+    if upper is not None:
+        condition &= Q(price__lt=upper)
+    return condition
+
+
+def count_categories(queryset):
+    """
+    Products per category including subcategories, named from the cached category tree
+    """
+    counts = dict(
+        queryset.values('category_id').annotate(count=Count('id')).values_list('category_id', 'count')
+    )
+    facets = []
+
+    def walk(node):
+        count = counts.get(node['id'], 0) + sum(walk(child) for child in node['children'])
+        if count:
+            facets.append({'id': node['id'], 'name': node['name'], 'slug': node['slug'], 'count': count})
+        return count
+
+    for root in get_category_tree():
+        walk(root)
+    return sorted(facets, key=lambda facet: (-facet['count'], facet['name']))
+
+
+def count_tags(queryset):
+    return list(
+        TaggedItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(Product),
+            object_id__in=queryset.values('pk'),
+        ).values('tag__name').annotate(count=Count('id'))
+        .order_by('-count', 'tag__name')
+        .values('tag__name', 'count')[:MAX_TAG_FACETS]
+    )
+
+
+def get_facets(queryset):
+    """
+    Facet counts of a filtered product queryset with three grouped queries:
+    prices and availability in one aggregate, categories and tags grouped by their key.
+    """
+    queryset = queryset.order_by()
+    ranges = list(price_ranges())
+    aggregates = {
+        f'price_{i}': Count('id', filter=price_condition(lower, upper))
+        for i, (lower, upper) in enumerate(ranges)
+    }
+    aggregates['in_stock'] = Count('id', filter=Q(stock__gt=0))
+    aggregates['out_of_stock'] = Count('id', filter=Q(stock=0))
+    stats = queryset.aggregate(**aggregates)
+
+    return {
+        'categories': count_categories(queryset),
+        'tags': [{'name': tag['tag__name'], 'count': tag['count']} for tag in count_tags(queryset)],
+        'price': [
+            {'min': lower, 'max': upper, 'count': stats[f'price_{i}']}
+            for i, (lower, upper) in enumerate(ranges)
+        ],
+        'availability': {
+            'in_stock': stats['in_stock'],
+            'out_of_stock': stats['out_of_stock'],
+        },
+    }
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils import timezone
+from xml.sax.saxutils import XMLGenerator
+from product.models import Product
+from .category_service import get_category_version
+import hashlib
+import heapq
+import json
+import tempfile
+
+FEED_DIR = 'feeds'
+FEED_STATE_PATH = f'{FEED_DIR}/catalog.state.json'
+FEED_STATE_KEY = 'catalog_feed_state'
+# held by a run, an overlapping one is skipped, it expires on its own if the worker dies
+FEED_LOCK_KEY = 'catalog_feed_lock'
+FEED_CONTENT_TYPES = {
+    'jsonl': 'application/jsonl; charset=utf-8',
+    'xml': 'application/xml; charset=utf-8',
+}
+FEED_BATCH_SIZE = 1000
+# the feed is regenerated this often (see CELERY_BEAT_SCHEDULE), crawlers may cache it as long
+FEED_INTERVAL = 60 * 10
+# rows committed late by a transaction that started before the previous run
+FEED_OVERLAP = timedelta(minutes=1)
+
+
+def build_record(product):
+    return {
+        'id': product.pk,
+        'name': product.name,
+        'sku': product.sku,
+        'url': settings.SITE_URL + reverse('product-detail', args=[product.slug]),
+        'price': product.price,
+        'stock': product.stock,
+        'category': product.category.name if product.category else None,
+        'image': settings.SITE_URL + product.feature_image.url if product.feature_image else None,
+        'rating_avg': product.rating_avg,
+        'rating_count': product.rating_count,
+        'updated_at': product.updated_at.isoformat(),
+    }
+
+
+def feed_products():
+    return Product.objects.select_related('category').only(
+        'id', 'name', 'slug', 'sku', 'price', 'stock', 'is_available', 'feature_image',
+        'rating_avg', 'rating_count', 'updated_at', 'category__name')
+
+
+def iter_products(queryset):
+    # primary key batches, so the feed stays sorted by id
+    last_id = 0
+    while True:
+        products = list(queryset.filter(pk__gt=last_id).order_by('pk')[:FEED_BATCH_SIZE])
+        yield from products
+        if len(products) < FEED_BATCH_SIZE:
+            return
+        last_id = products[-1].pk
+
+
+def get_feed_state():
+    """
+    return: {generated_at, since, paths: {format: storage path}, previous_paths} of the current feed, or None
+    """
+    state = cache.get(FEED_STATE_KEY)
+    if state is None and default_storage.exists(FEED_STATE_PATH):
+        with default_storage.open(FEED_STATE_PATH, 'rb') as file:
+            state = json.load(file)
+        cache.set(FEED_STATE_KEY, state, None)
+    return state
+
+
+def save_feed_state(state):
+    if default_storage.exists(FEED_STATE_PATH):
+        default_storage.delete(FEED_STATE_PATH)
+    default_storage.save(FEED_STATE_PATH, ContentFile(json.dumps(state).encode('utf-8')))
+    cache.set(FEED_STATE_KEY, state, None)
+
+
+def iter_feed_lines(path):
+    """
+    yield: (product id, jsonl line) of a generated feed
+    """
+    with default_storage.open(path, 'rb') as file:
+        for line in file:
+            line = line.decode('utf-8')
+            yield json.loads(line)['id'], line
+
+
+def full_lines():
+    for product in iter_products(feed_products().filter(is_available=True)):
+        yield product.pk, json.dumps(build_record(product), ensure_ascii=False) + '\n'
+
+
+def unchanged_lines(old_path, changed):
+    """
+    The lines of the old feed which are not in `changed`, dropping deleted products.
+    Deleted products leave no updated_at behind, so the rest is looked up per batch.
+    """
+    def alive(batch):
+        ids = set(Product.objects.filter(pk__in=[pk for pk, _ in batch], is_available=True)
+                  .values_list('id', flat=True))
+        return [(pk, line) for pk, line in batch if pk in ids]
+
+    batch = []
+    for pk, line in iter_feed_lines(old_path):
+        if pk in changed:
+            continue
+        batch.append((pk, line))
+        if len(batch) >= FEED_BATCH_SIZE:
+            yield from alive(batch)
+            batch = []
+    yield from alive(batch)
+
+
+def merged_lines(old_path, since):
+    """
+    The old feed merged with the products changed since `since`, sorted by id
+    """
+    changed = {
+        product.pk: (json.dumps(build_record(product), ensure_ascii=False) + '\n'
+                     if product.is_available else None)
+        for product in iter_products(feed_products().filter(updated_at__gte=since))
+    }
+    updated = sorted((pk, line) for pk, line in changed.items() if line)
+    return heapq.merge(unchanged_lines(old_path, changed), updated)
+
+
+def write_xml(jsonl_file, xml_file, generated_at):
+    xml = XMLGenerator(xml_file, encoding='utf-8', short_empty_elements=True)
+    xml.startDocument()
+    xml.startElement('products', {'generated_at': generated_at})
+    for line in jsonl_file:
+        record = json.loads(line)
+        xml.startElement('product', {})
+        for name, value in record.items():
+            xml.startElement(name, {})
+            if value is not None:
+                xml.characters(str(value))
+            xml.endElement(name)
+        xml.endElement('product')
+    xml.endElement('products')
+    xml.endDocument()
+
+
+def generate_catalog_feed(full=False):
+    """
+    Rewrite the jsonl and xml feeds, from the products changed since the previous run
+    unless there is none or `full` is set. The files are written under new names and
+    the state is switched last, so a reader never sees half a feed.
+    An unchanged feed keeps its files and its `generated_at`, which is the validator of the feed.
+    The files of the previous feed are kept until the next one is generated, for the responses
+    still streaming them.
+    return: the new state
+    """
+    started_at = timezone.now()
+    since = (started_at - FEED_OVERLAP).isoformat()
+    category_version = get_category_version()
+    current = get_feed_state()
+    # category names are in every record, but renaming one does not touch its products
+    if current and not full and current.get('category_version') == category_version:
+        lines = merged_lines(current['paths']['jsonl'], datetime.fromisoformat(current['since']))
+    else:
+        lines = full_lines()
+
+    paths = {}
+    digest = hashlib.md5()
+    with tempfile.TemporaryFile() as jsonl_file, tempfile.TemporaryFile() as xml_file:
+        for _, line in lines:
+            line = line.encode('utf-8')
+            digest.update(line)
+            jsonl_file.write(line)
+
+        if current and current.get('digest') == digest.hexdigest():
+            state = dict(current, since=since, category_version=category_version)
+            save_feed_state(state)
+            return state
+
+        generated_at = started_at.isoformat()
+        suffix = started_at.strftime('%Y%m%d%H%M%S%f')
+        jsonl_file.seek(0)
+        write_xml((line.decode('utf-8') for line in jsonl_file), xml_file, generated_at)
+        for format, file in (('jsonl', jsonl_file), ('xml', xml_file)):
+            file.seek(0)
+            paths[format] = default_storage.save(
+                f'{FEED_DIR}/catalog-{suffix}.{format}', File(file))
+
+    state = {
+        'generated_at': generated_at,
+        'since': since,
+        'category_version': category_version,
+        'digest': digest.hexdigest(),
+        'paths': paths,
+        'previous_paths': current['paths'] if current else {},
+    }
+    save_feed_state(state)
+    if current:
+        for path in current.get('previous_paths', {}).values():
+            default_storage.delete(path)
+    return state
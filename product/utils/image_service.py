@@ -0,0 +1,126 @@
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps
+from product.models import Product, ProductImage
+from .cache_service import save_drifted_products
+from io import BytesIO
+import hashlib
+import posixpath
+
+# widths of the resized copies, an image is never scaled up
+VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def pick_feature_image(product_id):
+    # the featured image (at most one, see unique_featured_image_per_product), else the oldest one
+    return (
+        ProductImage.objects.filter(product_id=product_id)
+        .order_by('-is_feature', 'id')
+        .values_list('image', 'variants')
+        .first()
+    ) or ('', {})
+
+
+def refresh_feature_image(product_id):
+    image, variants = pick_feature_image(product_id)
+    Product.objects.filter(pk=product_id).update(
+        feature_image=image, feature_image_variants=variants, updated_at=timezone.now())
+
+
+def pick_feature_images(product_ids):
+    """
+    return: {product id: (image, variants)} for the products which have images
+    """
+    images = {}
+    for product_id, image, variants in (
+        ProductImage.objects.filter(product_id__in=product_ids)
+        .order_by('product_id', '-is_feature', 'id')
+        .values_list('product_id', 'image', 'variants')
+    ):
+        images.setdefault(product_id, (image, variants))
+    return images
+
+
+def refresh_feature_images(product_ids):
+    images = pick_feature_images(product_ids)
+    now = timezone.now()
+    products = []
+    for pk in product_ids:
+        image, variants = images.get(pk, ('', {}))
+        products.append(Product(pk=pk, feature_image=image, feature_image_variants=variants, updated_at=now))
+    Product.objects.bulk_update(
+        products, ['feature_image', 'feature_image_variants', 'updated_at'], batch_size=1000)
+
+
+def build_variants(image):
+    """
+    Save resized webp and jpeg copies of an image field next to it, named by the
+    hash of their content, so an unchanged copy is stored once and cached forever.
+    return: {'source': image name, format: {width: storage path}}
+    """
+    with image.open('rb') as file:
+        original = ImageOps.exif_transpose(Image.open(file))
+        original.load()
+
+    widths = [width for width in VARIANT_WIDTHS if width < original.width] or [original.width]
+    directory = posixpath.join(posixpath.dirname(image.name), 'variants')
+    variants = {'source': image.name}
+    for extension, (format, options) in VARIANT_FORMATS.items():
+        variants[extension] = {}
+        for width in widths:
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.Resampling.LANCZOS)
+            if format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+            buffer = BytesIO()
+            resized.save(buffer, format, **options)
+            content = buffer.getvalue()
+            path = f'{directory}/{hashlib.sha256(content).hexdigest()[:20]}.{extension}'
+            if not image.storage.exists(path):
+                path = image.storage.save(path, ContentFile(content))
+            variants[extension][str(width)] = path
+    return variants
+
+
+def get_srcset(variants, storage):
+    """
+    return: {format: 'url 320w, url 640w'} of the variants of an image
+    """
+    return {
+        extension: ', '.join(f'{storage.url(path)} {width}w' for width, path in paths.items())
+        for extension, paths in variants.items()
+        if extension in VARIANT_FORMATS
+    }
+
+
+def rebuild_feature_images(batch_size=1000):
+    """
+    Recompute `feature_image` of all products in primary key batches.
+    return: number of products which were fixed
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        products = list(
+            Product.objects.filter(pk__gt=last_id).order_by('pk')
+            .only('id', 'feature_image', 'feature_image_variants')[:batch_size]
+        )
+        if not products:
+            return fixed
+        last_id = products[-1].pk
+
+        images = pick_feature_images([p.pk for p in products])
+        drifted = []
+        for product in products:
+            image, variants = images.get(product.pk, ('', {}))
+            if product.feature_image.name != image or product.feature_image_variants != variants:
+                product.feature_image = image
+                product.feature_image_variants = variants
+                drifted.append(product)
+
+        save_drifted_products(drifted, ['feature_image', 'feature_image_variants'])
+        fixed += len(drifted)
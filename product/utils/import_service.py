@@ -0,0 +1,268 @@
+from contextvars import ContextVar
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from taggit.models import Tag, TaggedItem
+from product.models import Category, Product, ProductImage, ProductAttribute
+from product.serializers import ProductImportRowSerializer
+from .cache_service import invalidate_product_detail
+from .image_service import refresh_feature_images
+from .search_service import index_products
+from .tag_service import invalidate_tag_names
+from itertools import islice
+import codecs
+import csv
+import json
+
+IMPORT_CHUNK_SIZE = 500
+# the error list of the report is capped, the count is not
+MAX_REPORTED_ERRORS = 100
+PRODUCT_FIELDS = ['name', 'sku', 'category', 'description', 'price', 'stock', 'is_available']
+# the values of a new product for the keys missing in its row
+NEW_PRODUCT_DEFAULTS = {'category_id': None, 'description': '', 'stock': 0, 'is_available': True}
+REQUIRED_NEW_PRODUCT_FIELDS = ['name', 'price']
+# columns holding several values in a csv file
+LIST_SEPARATOR = '|'
+
+# set while the rows of a chunk are written, the chunk is reindexed and invalidated once
+_importing = ContextVar('importing', default=False)
+
+
+def is_importing():
+    return _importing.get()
+
+
+def parse_csv_row(row):
+    """
+    tags and images are `|` separated, attributes are `key:value|key:value`.
+    Empty scalar cells are left out, so they keep the values of an existing product.
+    """
+    data = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        value = (value or '').strip()
+        if key in ('tags', 'images'):
+            data[key] = [item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()]
+        elif key == 'attributes':
+            pairs = (item.partition(':') for item in value.split(LIST_SEPARATOR) if item.strip())
+            data[key] = {name.strip(): attribute.strip() for name, _, attribute in pairs}
+        elif value:
+            data[key] = value
+    return data
+
+
+def read_rows(file, format):
+    """
+    Stream the rows of a binary file object, one at a time.
+    yield: (line number, row dict or the decoding error)
+    """
+    lines = codecs.iterdecode(file, 'utf-8-sig')
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, parse_csv_row(row)
+        return
+
+    for line_num, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_num, error
+            continue
+        yield line_num, row if isinstance(row, dict) else ValueError('a row must be an object')
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_products(file, format, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    Upsert products on `slug` from a csv or jsonl file, chunk by chunk,
+    so memory does not grow with the file. Every chunk is written in its own transaction.
+    progress: called with the report after every chunk
+    return: the report, {rows, created, updated, failed, errors}
+    """
+    report = {'rows': 0, 'created': 0, 'updated': 0, 'failed': 0, 'errors': []}
+    for chunk in chunked(read_rows(file, format), chunk_size):
+        report['rows'] += len(chunk)
+        rows = validate_chunk(chunk, report)
+        if rows:
+            with transaction.atomic():
+                created, updated = write_chunk(rows)
+            report['created'] += created
+            report['updated'] += updated
+        if progress:
+            progress(report)
+    return report
+
+
+def add_error(report, line_num, errors):
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_num, 'errors': errors})
+
+
+def validate_chunk(chunk, report):
+    """
+    Validate the rows and check categories and skus with one query each.
+    return: {slug: validated row}, a later row wins over an earlier one of the same slug
+    """
+    rows = {}
+    for line_num, row in chunk:
+        if isinstance(row, Exception):
+            add_error(report, line_num, {'row': [str(row)]})
+            continue
+        serializer = ProductImportRowSerializer(data=row)
+        if not serializer.is_valid():
+            add_error(report, line_num, serializer.errors)
+            continue
+        data = serializer.validated_data
+        data['sku'] = data.get('sku') or None
+        if data['slug'] in rows:
+            add_error(report, rows[data['slug']][0], {'slug': ['Overridden by a later row.']})
+        rows[data['slug']] = (line_num, data)
+
+    categories = dict(
+        Category.objects.filter(slug__in={data['category'] for _, data in rows.values()
+                                          if data.get('category')})
+        .values_list('slug', 'id')
+    )
+    skus = {data['sku'] for _, data in rows.values() if data['sku']}
+    existing = list(
+        Product.objects.filter(Q(slug__in=rows.keys()) | Q(sku__in=skus))
+        .values('slug', 'sku', 'name', 'category_id', 'description', 'price', 'stock', 'is_available')
+    )
+    sku_owners = {product['sku']: product['slug'] for product in existing if product['sku']}
+    existing = {product['slug']: product for product in existing}
+
+    valid = {}
+    for slug, (line_num, data) in rows.items():
+        category = data.get('category')
+        if category and category not in categories:
+            add_error(report, line_num, {'category': [f'Unknown category "{category}".']})
+            continue
+        sku = data['sku']
+        if sku and sku_owners.setdefault(sku, slug) != slug:
+            add_error(report, line_num, {'sku': [f'"{sku}" belongs to another product.']})
+            continue
+        if 'category' in data:
+            data['category_id'] = categories.get(category)
+        data['exists'] = slug in existing
+        if data['exists']:
+            # the keys missing in the row keep the values of the product, a row without a sku too
+            current = existing[slug]
+            data['sku'] = sku or current['sku']
+        else:
+            missing = [field for field in REQUIRED_NEW_PRODUCT_FIELDS if field not in data]
+            if missing:
+                add_error(report, line_num, {field: ['This field is required.'] for field in missing})
+                continue
+            current = NEW_PRODUCT_DEFAULTS
+        for field, value in current.items():
+            data.setdefault(field, value)
+        valid[slug] = data
+    return valid
+
+
+def write_chunk(rows):
+    """
+    return: (created, updated)
+    """
+    # the rows without a sku get one from the sku allocator of Product.objects.bulk_create
+    Product.objects.bulk_create(
+        [
+            Product(slug=slug, name=data['name'], sku=data['sku'], category_id=data['category_id'],
+                    description=data['description'], price=data['price'], stock=data['stock'],
+                    is_available=data['is_available'])
+            for slug, data in rows.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['slug'],
+        update_fields=PRODUCT_FIELDS + ['updated_at'],
+    )
+    ids = dict(Product.objects.filter(slug__in=rows.keys()).values_list('slug', 'id'))
+
+    write_attributes({ids[slug]: data['attributes'] for slug, data in rows.items() if 'attributes' in data})
+    write_images({ids[slug]: data['images'] for slug, data in rows.items() if 'images' in data})
+    write_tags({ids[slug]: data['tags'] for slug, data in rows.items() if 'tags' in data})
+
+    product_ids = list(ids.values())
+    index_products(Product.objects.filter(pk__in=product_ids).prefetch_related('tags', 'attributes'))
+    transaction.on_commit(lambda: invalidate_product_detail(product_ids))
+
+    created = sum(not data['exists'] for data in rows.values())
+    return created, len(rows) - created
+
+
+def write_attributes(attributes):
+    """
+    attributes: {product id: {key: value}}, replaces the attributes of these products
+    """
+    if not attributes:
+        return
+    token = _importing.set(True)
+    try:
+        ProductAttribute.objects.filter(product_id__in=attributes.keys()).delete()
+    finally:
+        _importing.reset(token)
+    ProductAttribute.objects.bulk_create([
+        ProductAttribute(product_id=product_id, key=key, value=value)
+        for product_id, pairs in attributes.items()
+        for key, value in pairs.items()
+    ])
+
+
+def write_images(images):
+    """
+    images: {product id: [storage path]}, adds the images these products do not have yet
+    """
+    if not images:
+        return
+    existing = set(
+        ProductImage.objects.filter(product_id__in=images.keys()).values_list('product_id', 'image')
+    )
+    # product.tasks imports this module
+    from product.tasks import generate_image_variants
+
+    created = ProductImage.objects.bulk_create([
+        ProductImage(product_id=product_id, image=image)
+        for product_id, paths in images.items()
+        for image in dict.fromkeys(paths)
+        if (product_id, image) not in existing
+    ])
+    refresh_feature_images(list(images.keys()))
+    # bulk_create sends no post_save, see signals.image_saved
+    created_ids = [image.pk for image in created]
+    if created_ids:
+        transaction.on_commit(lambda: generate_image_variants.delay('ProductImage', created_ids))
+
+
+def write_tags(tags):
+    """
+    tags: {product id: [tag name]}, replaces the tags of these products
+    """
+    if not tags:
+        return
+    names = {name for product_tags in tags.values() for name in product_tags}
+    tag_ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+    for name in names - tag_ids.keys():
+        # save() makes the slug unique, new tags are rare next to the products
+        tag_ids[name] = Tag.objects.create(name=name).pk
+
+    content_type = ContentType.objects.get_for_model(Product)
+    tagged = TaggedItem.objects.filter(content_type=content_type, object_id__in=tags.keys())
+    old_names = set(tagged.values_list('tag__name', flat=True))
+    tagged.delete()
+    TaggedItem.objects.bulk_create([
+        TaggedItem(content_type=content_type, object_id=product_id, tag_id=tag_ids[name])
+        for product_id, product_tags in tags.items()
+        for name in dict.fromkeys(product_tags)
+    ])
+    changed = old_names | names
+    transaction.on_commit(lambda: invalidate_tag_names(changed))
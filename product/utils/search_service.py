@@ -0,0 +1,210 @@
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from product.models import Product
+import re
+
+SEARCH_TABLE = 'product_search'
+MAX_TERMS = 10
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def build_document(product):
+    """
+    Searchable text of a product, one entry per indexed column.
+    tags and attributes are read with `.all()` so they can be prefetched.
+    """
+    return {
+        'name': product.name,
+        'sku': product.sku or '',
+        'tags': ' '.join(tag.name for tag in product.tags.all()),
+        'attributes': ' '.join(attribute.value for attribute in product.attributes.all()),
+        'description': product.description,
+    }
+
+
+class SQLiteSearchBackend:
+    """
+    FTS5 virtual table, the rowid is the product id. Ranked with bm25.
+    """
+    weights = '10.0, 5.0, 3.0, 2.0, 1.0'
+
+    def setup(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "name, sku, tags, attributes, description, tokenize='unicode61')"
+        )
+
+    def index(self, cursor, product_id, document):
+        self.remove(cursor, product_id)
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, sku, tags, attributes, description) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            [product_id, document['name'], document['sku'], document['tags'],
+             document['attributes'], document['description']]
+        )
+
+    def remove(self, cursor, product_id):
+        cursor.execute(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [product_id])
+
+    def build_query(self, terms, name_only):
+        column = 'name : ' if name_only else ''
+        return ' AND '.join(f'{column}"{term}"*' for term in terms)
+
+    def search(self, queryset, terms, name_only=False, rank=True):
+        match = self.build_query(terms, name_only)
+        queryset = queryset.filter(pk__in=RawSQL(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", [match]))
+        if not rank:
+            return queryset
+        table = queryset.model._meta.db_table
+        # bm25 is negative, the best match is the lowest
+        return queryset.annotate(search_rank=RawSQL(
+            f"SELECT -bm25({SEARCH_TABLE}, {self.weights}) FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH %s AND rowid = {table}.id", [match]
+        )).order_by('-search_rank', 'id')
+
+
+class PostgresSearchBackend:
+    """
+    tsvector table with a GIN index, the columns are weighted A (name) to D (description).
+    """
+    config = 'simple'
+
+    def setup(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+            f"product_id bigint PRIMARY KEY REFERENCES {Product._meta.db_table} (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_gin "
+            f"ON {SEARCH_TABLE} USING gin (document)"
+        )
+
+    def index(self, cursor, product_id, document):
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, "
+            "setweight(to_tsvector(%s, %s), 'A') || setweight(to_tsvector(%s, %s), 'B') || "
+            "setweight(to_tsvector(%s, %s || ' ' || %s), 'C') || setweight(to_tsvector(%s, %s), 'D')) "
+            "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+            [product_id, self.config, document['name'], self.config, document['sku'],
+             self.config, document['tags'], document['attributes'],
+             self.config, document['description']]
+        )
+
+    def remove(self, cursor, product_id):
+        cursor.execute(
+            f"DELETE FROM {SEARCH_TABLE} WHERE product_id = %s", [product_id])
+
+    def build_query(self, terms, name_only):
+        weight = 'A' if name_only else ''
+        return ' & '.join(f'{term}:*{weight}' for term in terms)
+
+    def search(self, queryset, terms, name_only=False, rank=True):
+        tsquery = self.build_query(terms, name_only)
+        queryset = queryset.filter(pk__in=RawSQL(
+            f"SELECT product_id FROM {SEARCH_TABLE} "
+            f"WHERE document @@ to_tsquery('{self.config}', %s)", [tsquery]))
+        if not rank:
+            return queryset
+        table = queryset.model._meta.db_table
+        return queryset.annotate(search_rank=RawSQL(
+            f"SELECT ts_rank(document, to_tsquery('{self.config}', %s)) FROM {SEARCH_TABLE} "
+            f"WHERE product_id = {table}.id", [tsquery]
+        )).order_by('-search_rank', 'id')
+
+
+class LikeSearchBackend:
+    """
+    Fallback for databases without a supported full-text index.
+    """
+
+    def setup(self, cursor):
+        pass
+
+    def index(self, cursor, product_id, document):
+        pass
+
+    def remove(self, cursor, product_id):
+        pass
+
+    def search(self, queryset, terms, name_only=False, rank=True):
+        for term in terms:
+            condition = Q(name__icontains=term)
+            if not name_only:
+                condition |= (Q(sku__icontains=term) | Q(description__icontains=term)
+                              | Q(tags__name__icontains=term) | Q(attributes__value__icontains=term))
+            queryset = queryset.filter(
+                pk__in=Product.objects.filter(condition).values('pk'))
+        return queryset
+
+
+def get_backend():
+    if connection.vendor == 'sqlite':
+        return SQLiteSearchBackend()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return LikeSearchBackend()
+
+
+def setup_search_index():
+    """
+    return: True when the index table was created by this call, so it is still empty
+    """
+    existed = SEARCH_TABLE in connection.introspection.table_names()
+    with connection.cursor() as cursor:
+        get_backend().setup(cursor)
+    return not existed and SEARCH_TABLE in connection.introspection.table_names()
+
+
+def index_product(product):
+    with connection.cursor() as cursor:
+        get_backend().index(cursor, product.pk, build_document(product))
+
+
+def remove_product(product_id):
+    with connection.cursor() as cursor:
+        get_backend().remove(cursor, product_id)
+
+
+def index_products(products):
+    """
+    products: with tags and attributes prefetched
+    """
+    backend = get_backend()
+    with connection.cursor() as cursor:
+        for product in products:
+            backend.index(cursor, product.pk, build_document(product))
+
+
+def search_products(queryset, query, name_only=False, rank=True):
+    terms = tokenize(query)
+    if not terms:
+        return queryset
+    return get_backend().search(queryset, terms, name_only=name_only, rank=rank)
+
+
+def rebuild_search_index(batch_size=500):
+    """
+    Reindex all products in primary key batches.
+    return: number of indexed products
+    """
+    indexed = 0
+    last_id = 0
+    while True:
+        products = list(
+            Product.objects.filter(pk__gt=last_id).order_by('pk')
+            .prefetch_related('tags', 'attributes')[:batch_size]
+        )
+        if not products:
+            return indexed
+        last_id = products[-1].pk
+
+        index_products(products)
+        indexed += len(products)
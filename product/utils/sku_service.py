@@ -0,0 +1,71 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from product.models import Product, Sequence
+import threading
+
+SKU_SEQUENCE = 'product_sku'
+# numbers reserved at once for single saves, the unused ones are lost on restart
+SKU_BLOCK_SIZE = 50
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def format_sku(number, year=None):
+    return f"PRD-{year or timezone.now().year}-{number:05d}"
+
+
+def reserve_numbers(count):
+    """
+    Take `count` numbers from the sequence row. The UPDATE locks the row until the
+    surrounding transaction ends, so concurrent reservations never overlap.
+    return: range of the reserved numbers
+    """
+    with transaction.atomic():
+        updated = Sequence.objects.filter(name=SKU_SEQUENCE).update(value=F('value') + count)
+        if not updated:
+            # SKUs used to be made of the product id, so the sequence starts after it
+            start = Product.objects.aggregate(last=Max('id'))['last'] or 0
+            try:
+                with transaction.atomic():
+                    Sequence.objects.create(name=SKU_SEQUENCE, value=start + count)
+            except IntegrityError:
+                # created by a concurrent reservation in between
+                Sequence.objects.filter(name=SKU_SEQUENCE).update(value=F('value') + count)
+        end = Sequence.objects.filter(name=SKU_SEQUENCE).values_list('value', flat=True).get()
+    return range(end - count + 1, end + 1)
+
+
+def release_to_pool(numbers):
+    with _pool_lock:
+        _pool.extend(numbers)
+
+
+def allocate_numbers(count):
+    """
+    Numbers from the process pool, refilled with a block from the sequence when it runs low.
+    """
+    with _pool_lock:
+        if len(_pool) >= count:
+            numbers = _pool[:count]
+            del _pool[:count]
+            return numbers
+
+    reserved = reserve_numbers(max(count, SKU_BLOCK_SIZE))
+    # the rest of the block is usable only once the reservation is committed,
+    # a rolled back reservation may be handed out again by the database
+    transaction.on_commit(lambda: release_to_pool(reserved[count:]))
+    return list(reserved[:count])
+
+
+def assign_skus(products):
+    """
+    Set the sku of the products which have none, before they are inserted.
+    """
+    missing = [product for product in products if not product.sku]
+    if not missing:
+        return
+    year = timezone.now().year
+    for product, number in zip(missing, allocate_numbers(len(missing))):
+        product.sku = format_sku(number, year)
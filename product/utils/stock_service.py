@@ -0,0 +1,112 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from product.models import Order, Payment, Product, StockReservation
+from .cache_service import invalidate_product_detail
+
+# sweeper batches, the rest waits for the next run
+RELEASE_BATCH_SIZE = 100
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = product_ids
+
+
+def reserve_stock(order, quantities):
+    """
+    Take the stock of a new order with one conditional UPDATE per product,
+    `stock >= quantity`, so two checkouts can never both take the last items.
+    Only the product rows are locked, in id order, so checkouts do not deadlock.
+    Run it in the transaction creating the order, which gives the stock back on OutOfStock.
+    quantities: {product id: quantity}
+    """
+    now = timezone.now()
+    short = []
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        taken = Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+            stock=F('stock') - quantity, updated_at=now)
+        if not taken:
+            short.append(product_id)
+    if short:
+        raise OutOfStock(short)
+
+    expires_at = now + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        for product_id, quantity in quantities.items()
+    ])
+    product_ids = list(quantities)
+    transaction.on_commit(lambda: invalidate_product_detail(product_ids))
+
+
+def release_reservations(order_id):
+    """
+    Give the held stock of an order back, one UPDATE per distinct quantity.
+    return: number of released holds, 0 if they were committed or released in between
+    """
+    with transaction.atomic():
+        holds = list(
+            StockReservation.objects.select_for_update().filter(order_id=order_id)
+            .values_list('id', 'product_id', 'quantity')
+        )
+        if not holds:
+            return 0
+
+        by_quantity = defaultdict(list)
+        for _, product_id, quantity in holds:
+            by_quantity[quantity].append(product_id)
+        now = timezone.now()
+        for quantity, product_ids in by_quantity.items():
+            Product.objects.filter(pk__in=product_ids).update(
+                stock=F('stock') + quantity, updated_at=now)
+        StockReservation.objects.filter(pk__in=[pk for pk, _, _ in holds]).delete()
+
+        product_ids = [product_id for _, product_id, _ in holds]
+        transaction.on_commit(lambda: invalidate_product_detail(product_ids))
+    return len(holds)
+
+
+def commit_reservations(order_id):
+    """
+    Keep the held stock of a paid order for good.
+    return: number of committed holds
+    """
+    deleted, _ = StockReservation.objects.filter(order_id=order_id).delete()
+    return deleted
+
+
+def expire_order(order_id):
+    """
+    Cancel a pending order whose holds expired, and give its stock back.
+    return: False if the order was paid or released in between
+    """
+    with transaction.atomic():
+        # the payment row first, as PaymentVerifyView locks it first, so a verification in progress wins
+        pending = list(
+            Payment.objects.select_for_update().filter(order_id=order_id, status='pending')
+            .values_list('id', flat=True)
+        )
+        if not release_reservations(order_id):
+            return False
+        # an unverified payment is refunded by the gateway
+        Payment.objects.filter(pk__in=pending).update(status='failed')
+        Order.objects.filter(pk=order_id, status='pending').update(
+            status='canceled', updated_at=timezone.now())
+    return True
+
+
+def release_expired_reservations(batch_size=RELEASE_BATCH_SIZE):
+    """
+    return: number of orders canceled
+    """
+    order_ids = list(
+        StockReservation.objects.filter(expires_at__lte=timezone.now())
+        .order_by().values_list('order_id', flat=True).distinct()[:batch_size]
+    )
+    return sum(expire_order(order_id) for order_id in order_ids)
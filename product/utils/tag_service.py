@@ -0,0 +1,104 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from taggit.models import Tag, TaggedItem
+from product.models import Product
+import hashlib
+import time
+
+TAG_INDEX_TIMEOUT = 60 * 60 * 24
+# bigger sets are answered with a semi-join, to keep the IN list bounded
+MAX_INLINE_IDS = 5000
+
+
+def tag_hash(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def tag_version_key(name):
+    return f'tag_index_version_{tag_hash(name)}'
+
+
+def tag_index_key(name, version):
+    return f'tag_index_{tag_hash(name)}_{version}'
+
+
+def get_tag_versions(names):
+    """
+    return: {tag name: version}, a fresh version is never a reused one, even if the old key was evicted
+    """
+    keys = {tag_version_key(name): name for name in names}
+    versions = {keys[key]: version for key, version in cache.get_many(keys.keys()).items()}
+    for name in names:
+        if name not in versions:
+            version = time.time_ns()
+            if not cache.add(tag_version_key(name), version, None):
+                version = cache.get(tag_version_key(name), version)
+            versions[name] = version
+    return versions
+
+
+def get_tag_product_ids(names):
+    """
+    Product ids of each tag, from the cache or rebuilt with one query for the missing tags.
+    The versions are read before the query, so an invalidation made meanwhile leaves
+    the rebuilt sets unreachable instead of current.
+    return: {tag name: frozenset of product ids}
+    """
+    versions = get_tag_versions(names)
+    keys = {tag_index_key(name, versions[name]): name for name in names}
+    cached = cache.get_many(keys.keys())
+    index = {keys[key]: ids for key, ids in cached.items()}
+
+    missing = [name for name in names if name not in index]
+    if missing:
+        rebuilt = {name: set() for name in missing}
+        for name, product_id in (
+            TaggedItem.objects.filter(
+                content_type=ContentType.objects.get_for_model(Product),
+                tag__name__in=missing
+            ).values_list('tag__name', 'object_id')
+        ):
+            rebuilt[name].add(product_id)
+        rebuilt = {name: frozenset(ids) for name, ids in rebuilt.items()}
+        cache.set_many({tag_index_key(name, versions[name]): ids for name, ids in rebuilt.items()},
+                       TAG_INDEX_TIMEOUT)
+        index.update(rebuilt)
+    return index
+
+
+def invalidate_tags(tag_ids):
+    names = Tag.objects.filter(pk__in=tag_ids).values_list('name', flat=True)
+    invalidate_tag_names(names)
+
+
+def invalidate_tag_names(names):
+    cache.delete_many([tag_version_key(name) for name in names])
+
+
+def filter_by_tags(queryset, names, match_all=False):
+    """
+    match_all: products having every tag (intersection), otherwise any of them (union)
+    """
+    names = list(dict.fromkeys(name.strip() for name in names if name.strip()))
+    if not names:
+        return queryset
+
+    sets = get_tag_product_ids(names).values()
+    if match_all:
+        product_ids = frozenset.intersection(*sets)
+    else:
+        product_ids = frozenset().union(*sets)
+
+    if not product_ids:
+        return queryset.none()
+    if len(product_ids) <= MAX_INLINE_IDS:
+        return queryset.filter(pk__in=product_ids)
+
+    tagged = TaggedItem.objects.filter(
+        content_type=ContentType.objects.get_for_model(Product))
+    if match_all:
+        for name in names:
+            queryset = queryset.filter(
+                pk__in=tagged.filter(tag__name=name).values('object_id'))
+        return queryset
+    return queryset.filter(pk__in=tagged.filter(tag__name__in=names).values('object_id'))
@@ -1,17 +1,36 @@
 from rest_framework.views import APIView
 from .serializers import OrderSerializer, OrderDetailSerializer, PaymentSerializer, AdminOrderSerializer
 from rest_framework.generics import CreateAPIView, ListAPIView, RetrieveAPIView
-from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiResponse
+from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiResponse, OpenApiParameter
 from rest_framework.viewsets import ModelViewSet
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework import status
 from rest_framework.serializers import ValidationError
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from .utils.coupon_service import verify_coupon
+from rest_framework.filters import OrderingFilter
+from django_filters.rest_framework import DjangoFilterBackend
+from .utils.coupon_service import COUPON_ERRORS, check_coupon, get_cart_snapshot, verify_coupon
 from .utils.zarinpal import request_payment, verify_payment
-from django.db.models import Prefetch, Count, Sum, F
+from .utils.category_service import get_category_tree, get_category_version
+from .utils.cache_service import get_product_detail, get_product_version, set_product_detail
+from .utils.facet_service import get_facets
+from .utils.batch_service import batch_update_products
+from .utils.stock_service import OutOfStock, reserve_stock, release_reservations, commit_reservations
+from .utils import cart_service
+from .tasks import import_products_file
+from .utils.feed_service import get_feed_state, FEED_CONTENT_TYPES, FEED_INTERVAL
+from rest_framework.negotiation import BaseContentNegotiation
+from django.http import FileResponse, Http404
+from django.utils.cache import get_conditional_response
+from datetime import datetime
+from celery.result import AsyncResult
+from django.core.files.storage import default_storage
+import os
+import uuid
+from django.db.models import Prefetch, F
 from django.db import transaction
+from django.shortcuts import get_object_or_404
 from django.db.utils import IntegrityError
 from .serializers import (
     CategorySerializer, AdminCategorySerializer, ProductSerializer, ProductDetailSerializer,
@@ -19,25 +38,63 @@ from .serializers import (
     CouponSerializer, AdminCouponSerializer, AdminCategoryCouponSerializer, AdminProductCouponSerializer,
     ReviewSerializer, ReviewImageSerializer, AdminReviewSerializer, AdminReviewImageSerializer,
     CartItemsListSerializer, CartItemsCreateSerializer, AdminPaymentSerializer, AdminUserCouponSerializer,
-    CartItemsUpdateSerializer
+    CartItemsUpdateSerializer, CartBatchSerializer, ProductReviewSerializer, ProductImportSerializer,
+    ProductBatchUpdateSerializer
 )
 from .models import (
     Product, Category, ProductAttribute, Review,
     ProductImage, Coupon, ProductCoupon, CategoryCoupon, UserCoupon,
-    ReviewImage, Cart, CartItem, Order, Payment, OrderItem
+    ReviewImage, CartItem, Order, Payment, OrderItem
 )
 from rest_framework.generics import (
     ListAPIView, RetrieveAPIView, CreateAPIView, UpdateAPIView, ListCreateAPIView,
     RetrieveUpdateDestroyAPIView,
 )
 from .filters import ProductListFilter
+from .mixins import SparseFieldsMixin, ConditionalGetMixin, GuestCartMixin
+from .pagination import CursorPagination
 
 
 # Category Section
-class CategoryList(ListAPIView):
+class CategoryList(ConditionalGetMixin, ListAPIView):
     queryset = Category.objects.filter(is_active=True)
     serializer_class = CategorySerializer
 
+    def get_validators(self):
+        return [get_category_version()], None
+
+
+class CategoryTree(APIView):
+
+    @extend_schema(
+        description="Nested tree of active categories",
+        summary="Category Tree",
+        responses={
+            200: OpenApiResponse(
+                response=dict,
+                description="Root categories with their children",
+                examples=[
+                    OpenApiExample(
+                        name="Success Response",
+                        value=[
+                            {
+                                "id": 1,
+                                "name": "Electronics",
+                                "slug": "electronics",
+                                "children": [
+                                    {"id": 2, "name": "Phones",
+                                        "slug": "phones", "children": []},
+                                ],
+                            }
+                        ],
+                    )
+                ]
+            ),
+        }
+    )
+    def get(self, request):
+        return Response(get_category_tree())
+
 
 class AdminCategoryMangement(ModelViewSet):
     queryset = Category.objects.all()
@@ -47,35 +104,180 @@ class AdminCategoryMangement(ModelViewSet):
 
 
 # Product Section
-class ProductList(ListAPIView):
-    queryset = (
-        Product.objects.filter(is_available=True)
-        .prefetch_related(
-            'attributes',
-            'reviews',
-            Prefetch('images', queryset=ProductImage.objects.filter(
-                is_feature=True))
-        )
-        .annotate(carts_count=Count('cart_items'))
-        .defer('description')
-    )
+REVIEW_PREVIEW_SIZE = 3
+
+
+class ProductList(ConditionalGetMixin, SparseFieldsMixin, ListAPIView):
+    queryset = Product.objects.filter(is_available=True).defer('description')
     serializer_class = ProductSerializer
     filterset_class = ProductListFilter
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    # no default `ordering`, so `?search=` keeps its rank order
+    ordering_fields = ['name', 'price', 'created_at', 'rating_avg']
+    rank_query_param = 'search'
+    sparse_fields = {
+        'url': {'only': ('slug',)},
+        'image': {'only': ('feature_image',)},
+        'srcset': {'only': ('feature_image', 'feature_image_variants')},
+    }
 
+    # read by the ETag of the page
+    required_fields = ('updated_at', 'carts_count')
+
+    def get_validators(self):
+        # taken from the page in list, instead of an aggregate over the whole filtered catalog
+        return None, None
+
+    @extend_schema(parameters=[OpenApiParameter(
+        'facets', bool, description='Add category, tag, price and availability counts of the filtered products')])
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        facets = None
+        if request.query_params.get('facets') in ('1', 'true'):
+            facets = get_facets(queryset)
+
+        # only an ETag: Last-Modified would miss carts_count changes, which do not touch updated_at
+        products = page if page is not None else queryset
+        etag = self.get_etag([
+            [(product.pk, product.updated_at, product.carts_count) for product in products],
+            getattr(self.paginator, 'count', None),
+            self.paginator.get_next_link() if page is not None else None,
+            facets,
+        ])
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            serializer = self.get_serializer(products, many=True)
+            if page is None:
+                response = Response(serializer.data)
+            else:
+                response = self.get_paginated_response(serializer.data)
+            if facets is not None:
+                response.data['facets'] = facets
+        return self.set_validators(response, etag)
 
-class ProductDetail(RetrieveAPIView):
-    queryset = (Product.objects.filter(is_available=True)
-                .annotate(carts_count=Count('cart_items'))
-                .select_related('category')
-                .prefetch_related('attributes', 'reviews', 'images')
-                )
+
+class ProductDetail(ConditionalGetMixin, SparseFieldsMixin, RetrieveAPIView):
+    queryset = Product.objects.filter(is_available=True)
     serializer_class = ProductDetailSerializer
     lookup_field = 'slug'
+    sparse_fields = {
+        'images': {'prefetch_related': ['images']},
+        'attributes': {'prefetch_related': ['attributes']},
+        # the rest is served by ProductReviewList
+        'reviews': {'prefetch_related': [Prefetch(
+            'reviews', Review.objects.order_by('-created_at', '-id')[:REVIEW_PREVIEW_SIZE],
+            to_attr='latest_reviews')]},
+        'reviews_url': {'only': ('slug',)},
+        'rating_histogram': {'only': tuple(f'rating_{i}_count' for i in range(1, 6))},
+    }
+
+    def get_cache_variant(self):
+        return f'{self.request.get_full_path()}|{self.request.accepted_media_type}'
+
+    def get_validators(self):
+        self.cached, product_id, version = get_product_detail(
+            self.kwargs['slug'], self.get_cache_variant())
+        if self.cached:
+            return self.cached['parts'], self.cached['last_modified']
+
+        # images, attributes and reviews bump updated_at of their product
+        fields = ('id', 'updated_at', 'carts_count')
+        product = self.queryset.filter(slug=self.kwargs['slug']).values(*fields).first()
+        if product and product['id'] != product_id:
+            # the slug was not cached, the version has to be taken before the row is read
+            version = get_product_version(product['id'])
+            product = self.queryset.filter(pk=product['id']).values(*fields).first()
+        if not product:
+            return None, None
+        self.validators = {
+            'product_id': product['id'],
+            'version': version,
+            'parts': [product['id'], product['carts_count'], product['updated_at']],
+            'last_modified': product['updated_at'],
+        }
+        return self.validators['parts'], self.validators['last_modified']
+
+    def retrieve(self, request, *args, **kwargs):
+        if getattr(self, 'cached', None):
+            response = Response(self.cached['data'])
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = super().retrieve(request, *args, **kwargs)
+        validators = getattr(self, 'validators', None)
+        if validators:
+            entry = {
+                'data': response.data,
+                'parts': validators['parts'],
+                'last_modified': validators['last_modified'],
+            }
+            set_product_detail(self.kwargs['slug'], validators['product_id'], validators['version'],
+                               self.get_cache_variant(), entry)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class ProductReviewList(ListAPIView):
+    serializer_class = ProductReviewSerializer
+    pagination_class = CursorPagination
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
     filterset_fields = {
-        'reviews__rating': ['exact', 'gt', 'lt', 'gte', 'lte'],
-        'reviews__user__id': ['exact'],
-        'reviews__created_at': ['exact', 'gt', 'lt', 'gte', 'lte'],
+        'rating': ['exact', 'gt', 'lt', 'gte', 'lte'],
+        'user__id': ['exact'],
+        'created_at': ['exact', 'gt', 'lt', 'gte', 'lte'],
     }
+    ordering_fields = ['created_at', 'rating']
+    ordering = ('-created_at',)
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return Review.objects.none()
+        product_id = get_object_or_404(
+            Product.objects.filter(is_available=True).values_list('id', flat=True),
+            slug=self.kwargs['slug'])
+        return Review.objects.filter(product_id=product_id)
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    # the feed is a file whatever the crawler accepts, errors are rendered with the first renderer
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class CatalogFeed(ConditionalGetMixin, RetrieveAPIView):
+    """
+    The catalog feed files written by the `generate_catalog_feed` task, without touching the database
+    """
+    queryset = Product.objects.none()  # just for swagger
+    content_negotiation_class = IgnoreClientContentNegotiation
+    cache_control = {'public': True, 'max_age': FEED_INTERVAL}
+
+    def get_validators(self):
+        self.state = get_feed_state()
+        if not self.state or self.kwargs['feed_format'] not in FEED_CONTENT_TYPES:
+            return None, None
+        return [self.state['digest']], datetime.fromisoformat(self.state['generated_at'])
+
+    @extend_schema(
+        description="Whole catalog as jsonl or xml, regenerated every few minutes",
+        summary="Catalog Feed",
+        responses={200: OpenApiResponse(description="The feed file")}
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def retrieve(self, request, feed_format):
+        if not self.state or feed_format not in FEED_CONTENT_TYPES:
+            raise Http404
+        return FileResponse(default_storage.open(self.state['paths'][feed_format], 'rb'),
+                            content_type=FEED_CONTENT_TYPES[feed_format])
 
 
 class AdminProductMangement(ModelViewSet):
@@ -85,6 +287,94 @@ class AdminProductMangement(ModelViewSet):
     filterset_class = ProductListFilter
 
 
+class AdminProductImport(APIView):
+    permission_classes = [IsAdminUser]
+    parser_classes = (MultiPartParser, FormParser)
+
+    @extend_schema(
+        description="Upload a csv or jsonl file, the products are upserted on slug by a background task",
+        summary="Bulk Import Products",
+        request=ProductImportSerializer,
+        responses={
+            202: OpenApiResponse(
+                response=dict,
+                description="The import has been queued",
+                examples=[
+                    OpenApiExample(
+                        name="Queued Response",
+                        value={"task_id": "c5a0f0c2-6a3c-4b7e-9a51-3d1f0b6f2e11"},
+                    ),
+                ],
+            ),
+        }
+    )
+    def post(self, request):
+        serializer = ProductImportSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        file = serializer.validated_data['file']
+        format = serializer.validated_data.get('format') or \
+            os.path.splitext(file.name)[1].lstrip('.').lower()
+        if format not in ('csv', 'jsonl'):
+            raise ValidationError({'format': 'Use a .csv or .jsonl file or pass the format.'})
+
+        # the task streams the file from the storage, the request only stores it
+        path = default_storage.save(f'imports/{uuid.uuid4().hex}.{format}', file)
+        task = import_products_file.delay(path, format)
+        return Response({'task_id': task.id}, status=status.HTTP_202_ACCEPTED)
+
+
+class AdminProductImportStatus(APIView):
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        description="State of a bulk import and its report: rows, created, updated, failed and errors",
+        summary="Bulk Import Status",
+        responses={200: OpenApiResponse(response=dict)}
+    )
+    def get(self, request, task_id):
+        result = AsyncResult(task_id)
+        report = result.info if isinstance(result.info, dict) else None
+        return Response({'state': result.state, 'report': report})
+
+
+class AdminProductBatchUpdate(APIView):
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        description="Update price, stock and availability of many products, found by id or sku",
+        summary="Batch Update Products",
+        request=ProductBatchUpdateSerializer,
+        responses={
+            200: OpenApiResponse(
+                response=dict,
+                description="One result per item: updated, unchanged, not_found or invalid",
+                examples=[
+                    OpenApiExample(
+                        name="Success Response",
+                        value={
+                            "updated": 1,
+                            "failed": 1,
+                            "results": [
+                                {"index": 0, "id": 12, "sku": "PRD-2025-00012", "status": "updated"},
+                                {"index": 1, "id": None, "sku": "MISSING", "status": "not_found"},
+                            ],
+                        },
+                    ),
+                ],
+            ),
+        }
+    )
+    def post(self, request):
+        serializer = ProductBatchUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = batch_update_products(serializer.validated_data['items'])
+        return Response({
+            'updated': sum(result['status'] == 'updated' for result in results),
+            'failed': sum(result['status'] in ('not_found', 'invalid') for result in results),
+            'results': results,
+        })
+
+
 class AdminProductImageMangement(ModelViewSet):
     queryset = ProductImage.objects.all()
     serializer_class = AdminProductImageSerializer
@@ -342,36 +632,48 @@ class AdminReviewImageCreate(ModelViewSet):
 
 
 # Cart Section
-class UserCartList(ListAPIView):
+# With CART_STORAGE = 'cache' carts are served from the cache (see utils/cart_service.py),
+# and an item is identified by its product id. So are the carts of anonymous users, always.
+CART_PRODUCT_FIELDS = ('id', 'name', 'slug', 'sku', 'price', 'stock', 'carts_count', 'feature_image',
+                       'feature_image_variants', 'rating_avg', 'rating_count')
+
+
+class UserCartList(GuestCartMixin, SparseFieldsMixin, ListAPIView):
     serializer_class = CartItemsListSerializer
-    permission_classes = [IsAuthenticated]
+    permission_classes = [AllowAny]
     queryset = CartItem.objects.none()  # just for swagger
+    sparse_fields = {
+        'product': {
+            'only': ('product', *(f'product__{field}' for field in CART_PRODUCT_FIELDS)),
+            'select_related': ['product'],
+        },
+    }
 
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return self.queryset.none()
-        return (
-            CartItem.objects
-            .filter(cart__user=self.request.user)
-            .select_related('product')
-            .prefetch_related(
-                Prefetch(
-                    'product__images',
-                    queryset=ProductImage.objects.filter(is_feature=True),
-                    to_attr='prefetched_feature_image'
-                ),
-                Prefetch(
-                    'product__cart_items',
-                    queryset=CartItem.objects.all(),
-                    to_attr='prefetched_cart_items'
-                )
-            )
-        )
+        return self.get_sparse_queryset(
+            CartItem.objects.filter(cart__user=self.request.user))
+
+    def list(self, request, *args, **kwargs):
+        if self.uses_cart_cache():
+            requested = self.get_requested_fields()
+            products = None
+            if requested is None or 'product' in requested:
+                products = Product.objects.only(*CART_PRODUCT_FIELDS)
+            page = self.paginate_queryset(cart_service.get_cart_items(self.get_cart_owner(), products))
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+        else:
+            response = super().list(request, *args, **kwargs)
+        # of the whole cart, not only of the page
+        response.data['total'] = cart_service.get_cart_total(self.get_cart_owner())
+        return response
 
 
-class UserCartItemCreate(CreateAPIView):
+class UserCartItemCreate(GuestCartMixin, CreateAPIView):
     serializer_class = CartItemsCreateSerializer
-    permission_classes = [IsAuthenticated]
+    permission_classes = [AllowAny]
 
     @extend_schema(
         summary="Add Product to Cart",
@@ -408,19 +710,101 @@ class UserCartItemCreate(CreateAPIView):
         }
     )
     def post(self, request):
+        if self.uses_cart_cache():
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            product = serializer.validated_data['product']
+            quantity = serializer.validated_data['quantity']
+            if not cart_service.add_item(self.get_cart_owner(), product, quantity):
+                return Response({'error': 'Product already added to cart'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'id': product.pk, 'product_id': product.pk, 'quantity': quantity},
+                            status=status.HTTP_201_CREATED)
+
         try:
             return super().post(request)
         except IntegrityError as e:
             return Response({'error': 'Product already added to cart'}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserCartItemDetail(RetrieveUpdateDestroyAPIView):
+class UserCartItemDetail(GuestCartMixin, RetrieveUpdateDestroyAPIView):
     serializer_class = CartItemsUpdateSerializer
-    permission_classes = [IsAuthenticated]
+    permission_classes = [AllowAny]
 
     def get_queryset(self):
         return CartItem.objects.filter(cart__user=self.request.user)
 
+    def get_object(self):
+        if not self.uses_cart_cache():
+            return super().get_object()
+        product_id = self.kwargs['pk']
+        quantity = cart_service.get_cart(self.get_cart_owner()).get(product_id)
+        if quantity is None:
+            raise Http404
+        return CartItem(pk=product_id, product_id=product_id, quantity=quantity)
+
+    def perform_update(self, serializer):
+        if not self.uses_cart_cache():
+            return super().perform_update(serializer)
+        item = serializer.instance
+        item.quantity = cart_service.set_quantity(
+            self.get_cart_owner(), item.product_id, serializer.validated_data.get('quantity', item.quantity))
+
+    def perform_destroy(self, instance):
+        if not self.uses_cart_cache():
+            return super().perform_destroy(instance)
+        cart_service.remove_item(self.get_cart_owner(), instance.product_id)
+
+
+class UserCartBatch(GuestCartMixin, APIView):
+    permission_classes = [AllowAny]
+
+    @extend_schema(
+        description="Add to, set or remove many cart items at once, all or none",
+        summary="Batch Update Cart",
+        request=CartBatchSerializer,
+        responses={
+            200: OpenApiResponse(
+                response=dict,
+                description="The resulting cart",
+                examples=[
+                    OpenApiExample(
+                        name="Success Response",
+                        value={
+                            "items": [{"product_id": 1, "quantity": 2}, {"product_id": 4, "quantity": 1}],
+                            "total": 1500000,
+                        },
+                    ),
+                ],
+            ),
+            400: OpenApiResponse(
+                response=dict,
+                description="Nothing was changed",
+                examples=[
+                    OpenApiExample(
+                        name="Out of stock",
+                        value={
+                            "errors": [
+                                {"index": 1, "errors": {"quantity": ["Quantity can not be greater than stock"]}},
+                            ],
+                        },
+                    ),
+                ],
+            ),
+        }
+    )
+    def post(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items, total, errors = cart_service.apply_operations(
+            self.get_cart_owner(), serializer.validated_data['operations'])
+        if errors:
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'items': [{'product_id': product_id, 'quantity': quantity}
+                      for product_id, quantity in items.items()],
+            'total': total,
+        })
+
 
 class AdminCartItemCreate(ModelViewSet):
     queryset = CartItem.objects.all()
@@ -435,65 +819,61 @@ class CreateOrderView(CreateAPIView):
     serializer_class = OrderSerializer
 
     def perform_create(self, serializer):
+        user = self.request.user
         coupon = serializer.validated_data.get('coupon')
         if coupon:
-            user = self.request.user
-            status_code, response_data = verify_coupon(
-                user, coupon)
-
-            if status_code != 200:
-                raise ValidationError(response_data)
-
-            else:
-                cart = response_data.get('cart')
-                cart_amount = response_data.get('cart_amount')
-                coupon_value = response_data.get('coupon_value')
-                final_amount = response_data.get('final_amount')
+            result = check_coupon(user, coupon)
+            if not result['valid']:
+                raise ValidationError({'error': COUPON_ERRORS[result['error']]})
+            items = result['items']
+            discount_amount = result['discount_amount']
         else:
-            user = self.request.user
-            cart_qs = Cart.objects.filter(user=user).prefetch_related(Prefetch(
-                'items', queryset=CartItem.objects.select_related('product')))
-
-            cart = cart_qs.first()
-            if not cart.items.exists():
-                return Response({'error': 'Cart is empty'}, status=400)
-
-            cart_amount = cart.items.aggregate(total_amount=Sum(
-                F('quantity') * F('product__price')))['total_amount']
+            items = get_cart_snapshot(user.id)
+            discount_amount = 0
+        if not items:
+            raise ValidationError({'error': COUPON_ERRORS['empty_cart']})
+        cart_amount = sum(item['quantity'] * item['price'] for item in items)
 
         with transaction.atomic():
             order = Order.objects.create(
                 user=user,
                 total_amount=cart_amount,
-                discount_amount=coupon_value if coupon else 0,
-                final_amount=final_amount if coupon else cart_amount
-            )
-
-            for item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    quantity=item.quantity,
-                    price=item.product.price
-                )
-
-            authority, payment_url = request_payment(
-                order.final_amount,
-                f'Payment for order {order.id}',
-                order.id
-            )
-            if not authority:
-                raise ValidationError({'error': 'Failed to initiate payment'})
-
-            Payment.objects.create(
-                order=order,
-                amount=order.final_amount,
-                method='card',
-                status='pending',
-                transaction_id=authority
+                discount_amount=discount_amount,
+                final_amount=cart_amount - discount_amount,
+                coupon=coupon or '',
             )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_id=item['product_id'],
+                          quantity=item['quantity'], price=item['price'])
+                for item in items
+            ])
+
+            try:
+                reserve_stock(order, {item['product_id']: item['quantity'] for item in items})
+            except OutOfStock as e:
+                raise ValidationError({'error': 'Not enough stock', 'products': e.product_ids})
+
+        # the gateway is called once the holds are committed, so the product rows are not locked meanwhile
+        authority, payment_url = request_payment(
+            order.final_amount,
+            f'Payment for order {order.id}',
+            order.id
+        )
+        if not authority:
+            release_reservations(order.id)
+            order.status = 'canceled'
+            order.save()
+            raise ValidationError({'error': 'Failed to initiate payment'})
+
+        Payment.objects.create(
+            order=order,
+            amount=order.final_amount,
+            method='card',
+            status='pending',
+            transaction_id=authority
+        )
 
-            self.payment_url = payment_url
+        self.payment_url = payment_url
 
     @extend_schema(
         description="A callback for creating order",
@@ -595,7 +975,7 @@ class CreateOrderView(CreateAPIView):
         return response
 
 
-class OrderListView(ListAPIView):
+class OrderListView(SparseFieldsMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = OrderSerializer
     queryset = Order.objects.none()  # just for swagger
@@ -603,11 +983,19 @@ class OrderListView(ListAPIView):
         'status': ['exact'],
         'total_amount': ['exact', 'gt', 'lt', 'gte', 'lte'],
     }
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    ordering_fields = ['created_at']
+    ordering = ('-created_at',)
+    sparse_fields = {
+        'user': {'only': ('user',), 'select_related': ['user']},
+        'items': {'prefetch_related': ['items']},
+    }
 
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return self.queryset.none()
-        return Order.objects.filter(user=self.request.user).select_related('user')
+        return self.get_sparse_queryset(
+            Order.objects.filter(user=self.request.user))
 
 
 class OrderDetailView(RetrieveAPIView):
@@ -686,7 +1074,8 @@ class PaymentVerifyView(APIView):
         payment = Payment.objects.select_for_update().filter(
             transaction_id=authority).select_related('order__user').prefetch_related('order__user__cart__items').first()
 
-        if not payment:
+        # a payment which is not pending anymore was verified already, or expired with its holds
+        if not payment or payment.status != 'pending':
             return Response({'error': 'Invalid payment'}, status=status.HTTP_400_BAD_REQUEST)
 
         if status_param == 'NOK':
@@ -694,6 +1083,7 @@ class PaymentVerifyView(APIView):
             payment.order.status = 'canceled'
             payment.save()
             payment.order.save()
+            release_reservations(payment.order_id)
             return Response({'status': 'Payment canceled or failed'}, status=status.HTTP_400_BAD_REQUEST)
 
         ref_id, verify_status = verify_payment(authority, payment.amount)
@@ -704,17 +1094,17 @@ class PaymentVerifyView(APIView):
 
             payment.order.status = 'paid'
             payment.order.save()
+            commit_reservations(payment.order_id)
 
             cart = payment.order.user.cart
             cart.items.all().delete()
+            if cart_service.is_cache_mode():
+                user_id = payment.order.user_id
+                transaction.on_commit(lambda: cart_service.drop_cart(user_id))
 
-            if payment.order.discount_amount > 0:
-                coupon = Coupon.objects.select_for_update().filter(
-                    code=payment.order.coupon
-                ).first()
-                if coupon:
-                    coupon.usage_count += 1
-                    coupon.save()
+            if payment.order.coupon:
+                Coupon.objects.filter(code=payment.order.coupon).update(
+                    usage_count=F('usage_count') + 1)
 
             return Response({'status': 'Payment Successful', 'ref_id': ref_id}, status=status.HTTP_200_OK)
 
@@ -724,6 +1114,7 @@ class PaymentVerifyView(APIView):
             order = payment.order
             order.status = 'canceled'
             order.save()
+            release_reservations(order.id)
             return Response({'status': 'Payment failed'}, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -734,6 +1125,9 @@ class PaymentListView(ListAPIView):
     filterset_fields = {
         'status': ['exact'],
     }
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    ordering_fields = ['created_at']
+    ordering = ('-created_at',)
 
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):